@@ -0,0 +1,259 @@
+"""
+Structured access records and low-overhead logging setup.
+
+Each request gets one ``AccessRecord`` carrying its route, upstream host,
+status, bytes sent and per-phase timings; it is written as a single JSON
+line to the ``berry.access`` logger and folded into ``metrics`` when the
+response is closed. Per-step
+diagnostics go through ``diag``, which only logs for a sampled fraction of
+requests (or at DEBUG level) and never formats a message that is not
+emitted.
+
+``configure`` routes every log record through a bounded queue to a
+listener thread, so request threads never block on stderr. Records are
+formatted on the listener thread; when the queue is full they are dropped
+and counted rather than waiting. Forked workers restart the listener.
+"""
+import atexit
+import contextlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from contextvars import ContextVar
+
+import config
+import metrics
+
+access_logger = logging.getLogger('berry.access')
+
+_current = ContextVar('berry_access_record', default=None)
+
+
+class AccessRecord:
+    """Everything logged about one request"""
+
+    __slots__ = ('method', 'route', 'host', 'status', 'bytes', 'bytes_in', 'error', 'started', 'elapsed', 'phases',
+                 'fields', 'sampled')
+
+    def __init__(self, method, route, sampled=False):
+        self.method = method
+        self.route = route
+        self.host = None
+        self.status = None
+        self.bytes = None
+        self.bytes_in = 0
+        self.error = None
+        self.started = time.perf_counter()
+        self.elapsed = None
+        # Phase name -> milliseconds, in the order the phases first ran
+        self.phases = {}
+        self.fields = {}
+        self.sampled = sampled
+
+    def add_phase(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds * 1000
+
+    def count(self, chunks):
+        """Relay a streamed body, adding up the bytes actually sent"""
+        self.bytes = self.bytes or 0
+        try:
+            for chunk in chunks:
+                self.bytes += len(chunk)
+                yield chunk
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+
+    def as_dict(self):
+        entry = {
+            'method': self.method,
+            'route': self.route,
+            'host': self.host,
+            'status': self.status,
+            'bytes': self.bytes,
+            'bytes_in': self.bytes_in,
+            'ms': round(self.elapsed * 1000, 2) if self.elapsed is not None else None,
+            'phases': {name: round(ms, 2) for name, ms in self.phases.items()},
+        }
+        if self.error is not None:
+            entry['error'] = self.error
+        entry.update(self.fields)
+        return entry
+
+    def __str__(self):
+        return json.dumps(self.as_dict(), separators=(',', ':'))
+
+
+def begin(method, route):
+    """
+    Start the access record for the request running in this context.
+    ``route`` is the route pattern, not the concrete path, so it can label metrics.
+    """
+    record = AccessRecord(method, route, sampled=random.random() < config.LOG_DIAGNOSTIC_SAMPLE_RATE)
+    _current.set(record)
+    metrics.in_flight.inc((route,))
+    return record
+
+
+def current():
+    return _current.get()
+
+
+def finish(record, status=None, nbytes=None):
+    """Write ``record``; ``status`` and ``nbytes`` fill in what is not yet known"""
+    if record.status is None:
+        record.status = status
+    if record.bytes is None:
+        record.bytes = nbytes
+    record.elapsed = time.perf_counter() - record.started
+    metrics.in_flight.dec((record.route,))
+    metrics.observe_request(record)
+    if config.ACCESS_LOG_ENABLED:
+        # The record is rendered to JSON by the listener thread
+        access_logger.info('%s', record)
+
+
+def note_host(url):
+    record = _current.get()
+    if record is not None and url:
+        record.host = url.split('/', 3)[2] if '://' in url else None
+
+
+def add_bytes_in(nbytes):
+    """Count body bytes received from the origin for the current request"""
+    record = _current.get()
+    # A coalesced request reads another request's fetch, not the origin
+    if record is not None and 'coalesced' not in record.fields:
+        record.bytes_in += nbytes
+
+
+def note_error(exc):
+    """Classify the exception the current request failed with"""
+    record = _current.get()
+    if record is not None:
+        record.error = metrics.error_class(exc)
+
+
+def note(name, value):
+    """Add a field to the current access record"""
+    record = _current.get()
+    if record is not None:
+        record.fields[name] = value
+
+
+def note_coalesced():
+    """Mark the current request as served by another request's upstream fetch"""
+    note('coalesced', True)
+
+
+def add_phase(name, seconds):
+    """Add time measured elsewhere to phase ``name`` of the current request"""
+    record = _current.get()
+    if record is not None:
+        record.add_phase(name, seconds)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Time a block of the current request as phase ``name``"""
+    record = _current.get()
+    if record is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record.add_phase(name, time.perf_counter() - start)
+
+
+def diag(log, msg, *args):
+    """
+    Per-step diagnostic: logged at INFO for sampled requests, at DEBUG
+    otherwise, and formatted only if a handler will see it
+    """
+    record = _current.get()
+    if record is not None and record.sampled:
+        log.info(msg, *args)
+    elif log.isEnabledFor(logging.DEBUG):
+        log.debug(msg, *args)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that leaves formatting to the listener thread and drops
+    records instead of blocking when the queue is full
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_handler = None
+_listener = None
+_lock = threading.Lock()
+
+
+def configure():
+    """
+    Install the queue handler on the root logger (once) and start the
+    listener that writes to stderr
+    """
+    global _handler, _listener
+    with _lock:
+        if _handler is not None:
+            return
+        level = getattr(logging, str(config.LOG_LEVEL).upper(), logging.INFO)
+        log_queue = queue.Queue(maxsize=config.LOG_QUEUE_SIZE)
+        stream = logging.StreamHandler(sys.stderr)
+        stream.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+        _handler = _DeferredQueueHandler(log_queue)
+        root = logging.getLogger()
+        root.handlers[:] = [_handler]
+        root.setLevel(level)
+        access_logger.setLevel(logging.INFO if config.ACCESS_LOG_ENABLED else logging.WARNING)
+        _listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=_after_fork)
+
+
+def _after_fork():
+    """
+    A forked worker (gunicorn) inherits the queue but not the listener
+    thread: give it a fresh queue and a listener of its own
+    """
+    global _listener, _lock
+    _lock = threading.Lock()
+    atexit.unregister(_listener.stop)
+    log_queue = queue.Queue(maxsize=config.LOG_QUEUE_SIZE)
+    _handler.queue = log_queue
+    _handler.dropped = 0
+    _listener = logging.handlers.QueueListener(log_queue, *_listener.handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+def stats():
+    return {
+        'queued': _handler.queue.qsize() if _handler is not None else 0,
+        'dropped': _handler.dropped if _handler is not None else 0,
+    }
@@ -0,0 +1,891 @@
+"""
+asyncio serving mode for the BerryOS browser backend.
+
+Serves ``/proxy``, ``/proxy-resource``, ``/search``, ``/youtube``, the
+YouTube shortcut paths and ``/status`` on aiohttp with non-blocking upstream I/O, so a slow origin or a
+long video stream holds a coroutine instead of a worker thread. Rewriting
+still runs BeautifulSoup, so it is pushed onto a small thread pool, and
+video ranges share main's on-disk block cache, read and written on worker
+threads.
+
+The Flask app in ``main.py`` remains available; start this mode with::
+
+    python app/async_app.py
+"""
+import asyncio
+import codecs
+import contextvars
+import time
+import zlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from aiohttp import web
+from multidict import MultiDict
+
+import accesslog
+import config
+import metrics
+import main
+import profiling
+from compression import accepts, content_coding, decompressor, gzip_bytes, is_compressible
+from cache import DocumentCache, document_etag, is_not_modified, upstream_etag_for, validator_headers
+from html_stream import StreamingRewriter
+from charset import document_encoding
+from coalesce import FlightAborted, FlightTimeout, flight_key, flights
+from budget import RELAY, STREAM, TREE, document_plan
+from lite import wants_lite
+from prefetch import CLIENT_COOKIE, PrefetchClient
+from guard import UpstreamUnavailable, guard
+from upstream import shared_ssl_context
+from urls import ensure_https
+
+logger = logging.getLogger(__name__)
+
+# Per-read timeouts only: a total deadline would cut long video streams short
+UPSTREAM_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=config.ASYNC_CONNECT_TIMEOUT,
+                                         sock_read=config.ASYNC_READ_TIMEOUT)
+
+# Pages are fetched within one overall budget, as in main
+PAGE_TIMEOUT = aiohttp.ClientTimeout(total=config.UPSTREAM_PAGE_DEADLINE,
+                                     sock_connect=min(config.UPSTREAM_CONNECT_TIMEOUT, config.UPSTREAM_PAGE_DEADLINE))
+
+
+async def _connect_started(session, trace, params):
+    trace.connect_started = time.perf_counter()
+
+
+async def _connect_finished(session, trace, params):
+    accesslog.add_phase('connect', time.perf_counter() - trace.connect_started)
+
+
+# Times new upstream connections (DNS, TCP and TLS) into the access record
+CONNECT_TRACE = aiohttp.TraceConfig()
+CONNECT_TRACE.on_connection_create_start.append(_connect_started)
+CONNECT_TRACE.on_connection_create_end.append(_connect_finished)
+
+
+class UpstreamState:
+    """Shared connector, rewrite workers and in-flight counters for one app"""
+
+    def __init__(self):
+        self.connector = aiohttp.TCPConnector(
+            limit=config.ASYNC_MAX_CONNECTIONS,
+            limit_per_host=config.UPSTREAM_POOL_MAXSIZE,
+            ssl=shared_ssl_context(),
+            ttl_dns_cache=300,
+        )
+        self.rewrite_pool = ThreadPoolExecutor(max_workers=config.ASYNC_REWRITE_WORKERS,
+                                               thread_name_prefix='rewrite')
+        self.in_flight = 0
+        self.total = 0
+
+    def session(self, auto_decompress=True):
+        """
+        A client session for one proxied request. Sessions share the
+        connector (and its keep-alive pools) but never each other's cookies.
+        """
+        return aiohttp.ClientSession(connector=self.connector, connector_owner=False, timeout=UPSTREAM_TIMEOUT,
+                                     auto_decompress=auto_decompress, trace_configs=[CONNECT_TRACE])
+
+    async def run_cpu(self, fn, *args):
+        # Run in the caller's context so phases timed inside land in its
+        # access record, and the worker is sampled if the request is profiled
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self.rewrite_pool, context.run, profiling.call, fn,
+                                                                *args)
+
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'requests': self.total,
+            'max_connections': config.ASYNC_MAX_CONNECTIONS,
+            'max_connections_per_host': config.UPSTREAM_POOL_MAXSIZE,
+        }
+
+    async def close(self):
+        await self.connector.close()
+        self.rewrite_pool.shutdown(wait=False)
+
+
+class upstream_fetch:
+    """
+    Async context manager issuing one upstream request on its own session
+    and releasing both the response and the session on exit. With
+    ``decompress=False`` the body is read in the origin's content coding.
+    """
+
+    def __init__(self, state, method, url, decompress=True, **kwargs):
+        self.state = state
+        self.method = method
+        self.url = url
+        self.decompress = decompress
+        self.kwargs = kwargs
+        self.session = None
+        self.response = None
+        self.lease = None
+
+    async def __aenter__(self):
+        # Raises UpstreamUnavailable before anything is counted or opened
+        self.lease = await guard.acquire_async(self.url)
+        self.state.in_flight += 1
+        self.state.total += 1
+        self.session = self.state.session(auto_decompress=self.decompress)
+        try:
+            with accesslog.phase('upstream'):
+                self.response = await self.session.request(self.method, self.url, **self.kwargs)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.lease.failure()
+            await self._release()
+            raise
+        except BaseException:
+            await self._release()
+            raise
+        self.lease.record_status(self.response.status)
+        return self.response
+
+    async def __aexit__(self, *exc):
+        await self._release()
+
+    async def _release(self):
+        if self.response is not None:
+            self.response.release()
+        await self.session.close()
+        self.state.in_flight -= 1
+        self.lease.release()
+
+
+class SharedResponse:
+    """
+    A leader's upstream response that feeds its body to a ``coalesce``
+    flight as it is read. Offers what the handlers use of
+    ``aiohttp.ClientResponse``.
+    """
+
+    def __init__(self, response, flight):
+        self.response = response
+        self.flight = flight
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self.url = response.url
+        # Handlers read ``response.content.iter_chunked``
+        self.content = self
+
+    async def read(self):
+        try:
+            body = await self.response.read()
+        except Exception as e:
+            self.flight.fail(e)
+            raise
+        self.flight.append(body)
+        return body
+
+    async def iter_chunked(self, n):
+        try:
+            async for chunk in self.response.content.iter_chunked(n):
+                self.flight.append(chunk)
+                yield chunk
+        except Exception as e:
+            self.flight.fail(e)
+            raise
+
+    def at_eof(self):
+        return self.status in (204, 304) or self.response.content.at_eof()
+
+
+class FollowerResponse:
+    """
+    A leader's response as replayed to one follower, with the failures of
+    a real one: a stalled leader times out, a body cut short is a payload error
+    """
+
+    def __init__(self, flight, follower, timeout):
+        self.follower = follower
+        self.timeout = timeout
+        self.status = flight.status
+        self.reason = flight.reason
+        self.headers = flight.headers
+        self.url = flight.url
+        self.content = self
+
+    async def _read(self, n):
+        try:
+            return await self.follower.read_async(n, self.timeout)
+        except FlightTimeout as e:
+            raise aiohttp.ServerTimeoutError(str(e)) from None
+        except FlightAborted as e:
+            raise aiohttp.ClientPayloadError(str(e)) from None
+
+    async def read(self):
+        parts = []
+        while True:
+            data = await self._read(None)
+            if not data:
+                return b''.join(parts)
+            parts.append(data)
+
+    async def iter_chunked(self, n):
+        while True:
+            data = await self._read(n)
+            if not data:
+                return
+            yield data
+
+    def at_eof(self):
+        return self.follower.at_end()
+
+
+# Background downloads finishing a shared body for its followers
+_drains = set()
+
+
+class coalesced_fetch:
+    """
+    ``upstream_fetch`` for a GET that identical concurrent requests share
+    (see ``coalesce``): the first goes to the origin, the others read its
+    response as it arrives
+    """
+
+    def __init__(self, state, url, decompress=True, **kwargs):
+        self.state = state
+        self.url = url
+        self.decompress = decompress
+        self.kwargs = kwargs
+        self.flight = None
+        self.follower = None
+        self.fetch = None
+        self.response = None
+
+    async def __aenter__(self):
+        if config.COALESCE_ENABLED:
+            key = flight_key('GET', self.url, self.kwargs.get('headers'), self.decompress)
+            self.flight, self.follower = flights.join(key)
+            if self.follower is not None:
+                try:
+                    published = await self.flight.wait_published_async(flights.wait_timeout)
+                except BaseException:
+                    self.follower.close()
+                    raise
+                if published:
+                    accesslog.note_coalesced()
+                    timeout = self.kwargs.get('timeout') or UPSTREAM_TIMEOUT
+                    return FollowerResponse(self.flight, self.follower, timeout.sock_read or timeout.total)
+                # The leader took too long or gave up; fetch alone
+                self.follower.close()
+                self.flight = self.follower = None
+        self.fetch = upstream_fetch(self.state, 'GET', self.url, self.decompress, **self.kwargs)
+        try:
+            response = await self.fetch.__aenter__()
+        except Exception as e:
+            if self.flight is not None:
+                self.flight.fail(e)
+            raise
+        except BaseException:
+            if self.flight is not None:
+                self.flight.fail()
+            raise
+        if self.flight is None:
+            return response
+        self.flight.publish(response.status, response.reason, response.url, response.headers)
+        self.response = SharedResponse(response, self.flight)
+        return self.response
+
+    async def __aexit__(self, *exc):
+        if self.follower is not None:
+            self.follower.close()
+            return
+        if self.flight is not None and not self.flight.done:
+            if self.response.at_eof():
+                self.flight.finish()
+            elif self.flight.followers:
+                # The leader stopped early; finish the download for its followers
+                flights.record_drained()
+                task = asyncio.create_task(self._drain())
+                _drains.add(task)
+                task.add_done_callback(_drains.discard)
+                return
+            else:
+                self.flight.fail()
+        await self.fetch.__aexit__(*exc)
+
+    async def _drain(self):
+        try:
+            async for _ in self.response.iter_chunked(config.RESOURCE_STREAM_CHUNK_SIZE):
+                if not self.flight.followers:
+                    break
+        except Exception:
+            # iter_chunked has failed the flight already
+            pass
+        finally:
+            if self.response.at_eof():
+                self.flight.finish()
+            else:
+                self.flight.fail()
+            await self.fetch.__aexit__(None, None, None)
+
+
+def unavailable_error(e):
+    """Async counterpart of ``main.unavailable_page``"""
+    body, status, headers = main.unavailable_page(e)
+    return web.Response(text=body, status=status, headers=headers, content_type='text/html')
+
+
+def html_error(url, e):
+    return web.Response(
+        text=f"<html><body><h1>Error accessing {url}</h1><p>{str(e)}</p></body></html>",
+        status=500,
+        content_type='text/html',
+    )
+
+
+async def index(request):
+    return web.json_response({"status": "Server is running", "usage": "Use /proxy?url=https://example.com to proxy websites"})
+
+
+async def status(request):
+    return web.json_response(main.status_payload('async', request.app['upstream'].stats()))
+
+
+async def serve_route(request, path=None):
+    """Serve a request through main's internal router"""
+    form = await request.post() if request.method == 'POST' else MultiDict()
+    action = main.router.dispatch(request.method, path or request.path, request.query_string, form)
+    if action[0] == 'redirect':
+        raise web.HTTPFound(action[1])
+    if action[0] == 'error':
+        return web.json_response({"error": action[1]}, status=action[2])
+    if action[0] == 'youtube':
+        return web.Response(text=main.build_youtube_page(action[1], action[2]), content_type='text/html')
+    return await proxy_website_handler(request, action[1], action[2], form)
+
+
+async def metrics_endpoint(request):
+    return web.Response(body=metrics.render().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def youtube_catchall(request):
+    return await serve_route(request, f"/{request.match_info['youtube_path']}")
+
+
+def document_response(request, body, etag, compressed=None, subresources=(), encoding='utf-8', client=None):
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if client is not None and client.new:
+        headers['Set-Cookie'] = client.set_cookie()
+    if request.method == 'GET' and is_not_modified(request.headers, etag):
+        return web.Response(status=304, headers=headers)
+    if client is not None:
+        main.start_prefetch(client.key, subresources)
+    if compressed is not None and accepts(request.headers.get('Accept-Encoding'), 'gzip'):
+        headers.update({'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'})
+        body = compressed
+    return web.Response(body=body, headers=headers, content_type='text/html', charset=encoding)
+
+
+async def refresh_document(state, cache_key, url, entry, lite=False):
+    """Background refresh of a stale cached page"""
+    try:
+        headers = main.PAGE_HEADERS.copy()
+        if entry.upstream_etag:
+            headers['If-None-Match'] = entry.upstream_etag
+        async with upstream_fetch(state, 'GET', url, headers=headers, timeout=PAGE_TIMEOUT) as response:
+            if response.status == 304:
+                main.document_cache.touch(cache_key, entry)
+            elif response.status == 200 and 'text/html' in response.headers.get('Content-Type', ''):
+                raw_body = await response.read()
+                await state.run_cpu(main.cache_document, cache_key, url, raw_body, response.headers, entry, lite)
+    except Exception as e:
+        logger.error(f"Error refreshing cached page {url}: {str(e)}")
+    finally:
+        main.document_cache.end_refresh(cache_key)
+
+
+async def proxy_website_handler(request, url, args, form):
+    state = request.app['upstream']
+    url = ensure_https(url)
+    accesslog.note_host(url)
+    try:
+        # The client is leaving the page it navigated from; stop prefetching for it
+        client = None
+        if config.PREFETCH_ENABLED:
+            client = PrefetchClient(request.cookies.get(CLIENT_COOKIE), url)
+            leaving = client.leaving(request.headers.get('Referer'))
+            if leaving is not None:
+                main.prefetcher.cancel(leaving)
+
+        # Lite mode trims the page in the tree rewrite
+        lite = config.HTML_REWRITE_MODE == 'tree' and wants_lite(url, args.get('lite'))
+        signature = main.document_signature(lite)
+
+        # Plain GETs of rewritten pages can be answered from the document cache
+        cache_key = None
+        cached = None
+        if request.method == 'GET' and config.DOCUMENT_CACHE_ENABLED and config.HTML_REWRITE_MODE == 'tree':
+            cache_key = main.document_cache_key(url, lite)
+            cached, cache_state = main.document_cache.lookup(cache_key)
+            if cache_state == DocumentCache.FRESH:
+                return document_response(request, cached.body, cached.etag, cached.compressed, cached.subresources, cached.encoding, client=client)
+            if cache_state == DocumentCache.STALE:
+                if main.document_cache.begin_refresh(cache_key):
+                    asyncio.create_task(refresh_document(state, cache_key, url, cached, lite))
+                return document_response(request, cached.body, cached.etag, cached.compressed, cached.subresources, cached.encoding, client=client)
+
+        headers = main.PAGE_HEADERS.copy()
+        browser_etag = None
+        if request.method == 'POST':
+            fetch = upstream_fetch(state, 'POST', url, data=dict(form), headers=headers, timeout=PAGE_TIMEOUT)
+        else:
+            browser_etag = upstream_etag_for(request.headers.get('If-None-Match'), signature)
+            if browser_etag:
+                headers['If-None-Match'] = browser_etag
+            elif cached is not None and cached.upstream_etag:
+                headers['If-None-Match'] = cached.upstream_etag
+            fetch = coalesced_fetch(state, url, headers=headers, timeout=PAGE_TIMEOUT)
+
+        async with fetch as response:
+            if response.status == 304 and 'If-None-Match' in headers:
+                if browser_etag:
+                    return web.Response(status=304, headers={
+                        'ETag': document_etag(signature, browser_etag), 'Cache-Control': 'no-cache'})
+                cached = main.document_cache.touch(cache_key, cached)
+                return document_response(request, cached.body, cached.etag, cached.compressed, cached.subresources, cached.encoding, client=client)
+
+            # Process only HTML content
+            content_type = response.headers.get('Content-Type', '')
+            if 'text/html' not in content_type:
+                return web.Response(body=await response.read(), status=response.status,
+                                    headers={'Content-Type': content_type})
+
+            upstream_etag = response.headers.get('ETag') if request.method == 'GET' and response.status == 200 else None
+
+            # Oversized pages skip the parse tree: past the soft limit they are
+            # rewritten incrementally, past the hard limit relayed unmodified
+            plan = document_plan(main.declared_length(response.headers))
+            if plan == RELAY:
+                accesslog.note('document', RELAY)
+                return await relay_document(request, response, content_type)
+
+            raw_body = b''
+            complete = False
+            if config.HTML_REWRITE_MODE == 'tree' and plan == TREE:
+                with accesslog.phase('transfer'):
+                    raw_body, complete = await read_document(response, config.DOCUMENT_SOFT_LIMIT_BYTES)
+                if not complete:
+                    plan = STREAM
+
+            # Incremental mode: rewrite and flush while the body is still arriving
+            if not complete:
+                if plan == STREAM:
+                    accesslog.note('document', STREAM)
+                stream_headers = {'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+                if upstream_etag:
+                    stream_headers['ETag'] = document_etag(signature, upstream_etag)
+                return await stream_document(request, response, url, stream_headers, head=raw_body)
+
+        if cache_key is not None and response.status == 200:
+            body, etag, compressed, subresources, encoding = await state.run_cpu(
+                main.cache_document, cache_key, url, raw_body, response.headers, cached, lite)
+            return document_response(request, body, etag, compressed, subresources, encoding, client)
+
+        body, _, subresources, encoding = await state.run_cpu(main.build_document, url, raw_body, content_type,
+                                                              None, lite)
+        return document_response(request, body, document_etag(signature, upstream_etag, body),
+                                 subresources=subresources, encoding=encoding, client=client)
+
+    except UpstreamUnavailable as e:
+        accesslog.note_error(e)
+        return unavailable_error(e)
+    except Exception as e:
+        accesslog.note_error(e)
+        logger.error(f"Error in proxy_website_handler: {str(e)}", exc_info=True)
+        return html_error(url, e)
+
+
+async def read_document(response, limit):
+    """
+    Read a page's body, stopping once more than ``limit`` bytes have
+    arrived. Returns ``(body, complete)``.
+    """
+    chunks = []
+    size = 0
+    async for chunk in response.content.iter_chunked(config.RESOURCE_STREAM_CHUNK_SIZE):
+        accesslog.add_bytes_in(len(chunk))
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > limit:
+            return b''.join(chunks), False
+    return b''.join(chunks), True
+
+
+async def relay_document(request, response, content_type):
+    """Async counterpart of ``main.relay_document``"""
+    out = web.StreamResponse(status=response.status,
+                             headers={'Content-Type': content_type, 'Cache-Control': 'no-cache'})
+    await out.prepare(request)
+    async for chunk in response.content.iter_chunked(config.RESOURCE_STREAM_CHUNK_SIZE):
+        accesslog.add_bytes_in(len(chunk))
+        await out.write(chunk)
+    await out.write_eof()
+    return out
+
+
+async def stream_document(request, response, url, headers, head=b''):
+    """
+    Relay a page through the incremental rewriter as it downloads, starting
+    with ``head`` when part of it has already been read. The page is sent in
+    its own encoding, settled from its first chunk. Past
+    ``config.DOCUMENT_HARD_LIMIT_BYTES`` the rest is passed through unmodified.
+    """
+    if not head:
+        async for head in response.content.iter_chunked(config.HTML_STREAM_CHUNK_SIZE):
+            accesslog.add_bytes_in(len(head))
+            break
+    encoding = document_encoding(head, response.headers.get('Content-Type'))
+    headers['Content-Type'] = f'text/html; charset={encoding}'
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    encoder = codecs.getincrementalencoder(encoding)(errors='xmlcharrefreplace')
+    rewriter = StreamingRewriter(url)
+    seen = 0
+    compressor = None
+    if config.COMPRESSION_ENABLED and accepts(request.headers.get('Accept-Encoding'), 'gzip'):
+        compressor = zlib.compressobj(config.COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        headers['Content-Encoding'] = 'gzip'
+    out = web.StreamResponse(status=200, headers=headers)
+    await out.prepare(request)
+
+    async def emit(output, final=False):
+        data = encoder.encode(output, final)
+        if not data:
+            return
+        if compressor is not None:
+            data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        await out.write(data)
+
+    def rewrite(chunk):
+        nonlocal rewriter, seen
+        seen += len(chunk)
+        if rewriter is None:
+            return decoder.decode(chunk)
+        output = rewriter.feed_text(decoder.decode(chunk))
+        if seen > config.DOCUMENT_HARD_LIMIT_BYTES:
+            logger.info(f"Page {url} passed {config.DOCUMENT_HARD_LIMIT_BYTES} bytes; relaying the rest unmodified")
+            output += rewriter.detach()
+            rewriter = None
+        return output
+
+    try:
+        if head:
+            output = rewrite(head)
+            if output:
+                await emit(output)
+        async for chunk in response.content.iter_chunked(config.HTML_STREAM_CHUNK_SIZE):
+            accesslog.add_bytes_in(len(chunk))
+            output = rewrite(chunk)
+            if output:
+                await emit(output)
+        output = decoder.decode(b'', final=True)
+        if rewriter is not None:
+            output = rewriter.feed_text(output) + rewriter.finish()
+        await emit(output, final=True)
+    except Exception as e:
+        logger.error(f"Error while streaming rewritten HTML for {url}: {str(e)}")
+    if compressor is not None:
+        await out.write(compressor.flush())
+    await out.write_eof()
+    return out
+
+
+def cached_resource_response(request, entry):
+    headers = validator_headers(entry.headers)
+    if is_not_modified(request.headers, entry.headers.get('ETag'), entry.headers.get('Last-Modified')):
+        return web.Response(status=304, headers=headers)
+    if config.REWRITE_STYLESHEETS and main.is_stylesheet(entry.headers):
+        stylesheet = main.stylesheet_response(entry.url, entry.body, entry.headers, request.headers)
+        if stylesheet is not None:
+            return web.Response(body=stylesheet[0], headers=stylesheet[1])
+    headers['Content-Type'] = entry.headers.get('Content-Type', 'application/octet-stream')
+    return web.Response(body=main.encoded_resource_body(entry, request.headers, headers), headers=headers)
+
+
+async def segmented_video_response(request, url, headers, meta, range_header):
+    """
+    Async counterpart of ``main.segmented_video_response``. Returns None for
+    ranges the segment cache cannot serve.
+    """
+    plan = main.segment_plan(meta, range_header)
+    if plan is None:
+        return None
+    status, start, end, response_headers = plan
+    if status == 416:
+        return web.Response(status=416, headers=response_headers)
+    state = request.app['upstream']
+
+    async def fetch(first, last):
+        async with upstream_fetch(state, 'GET', url, headers=main.segment_fetch_headers(headers, meta, first, last),
+                                  timeout=UPSTREAM_TIMEOUT) as response:
+            main.check_segment_fetch(url, response.status, response.headers, first, last)
+            async for chunk in response.content.iter_chunked(config.RESOURCE_STREAM_CHUNK_SIZE):
+                accesslog.add_bytes_in(len(chunk))
+                yield chunk
+
+    out = web.StreamResponse(status=status, headers=response_headers)
+    await out.prepare(request)
+    try:
+        async for piece in main.segment_cache.read_range_async(meta, start, end, fetch):
+            await out.write(piece)
+    except Exception as e:
+        # The length is promised already; closing the connection tells the browser the body is short
+        accesslog.note_error(e)
+        logger.error(f"Error serving video {url} from the segment cache: {str(e)}")
+        out.force_close()
+        return out
+    await out.write_eof()
+    return out
+
+
+async def relay_resource(request, response, url, request_headers, buffer_limit, passthrough, writer=None):
+    """
+    Async counterpart of ``main.relay_resource``. The upstream body arrives
+    still encoded and is decoded here unless it is passed through.
+    """
+    coding = content_coding(response.headers)
+    decoder = decompressor(coding) if coding != 'identity' and not passthrough else None
+    compressor = None
+    if main.should_compress_relay(response.status, response.headers, request.headers.get('Accept-Encoding')):
+        compressor = zlib.compressobj(config.COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    out = web.StreamResponse(status=response.status,
+                             headers=main.relay_headers(response.headers, passthrough, compressor is not None))
+    await out.prepare(request)
+    buffered = [] if buffer_limit else None
+    size = 0
+    async for chunk in response.content.iter_chunked(config.RESOURCE_STREAM_CHUNK_SIZE):
+        accesslog.add_bytes_in(len(chunk))
+        if decoder is not None:
+            chunk = decoder.decompress(chunk)
+        if writer is not None:
+            await writer.feed_async(chunk)
+        if buffered is not None:
+            size += len(chunk)
+            if size > buffer_limit:
+                buffered = None
+            else:
+                buffered.append(chunk)
+        if compressor is not None:
+            chunk = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        await out.write(chunk)
+    if decoder is not None:
+        await out.write(decoder.flush())
+    if compressor is not None:
+        await out.write(compressor.flush())
+    await out.write_eof()
+    if buffered is not None:
+        main.resource_cache.store(url, request_headers, response.status, response.headers, b''.join(buffered))
+    return out
+
+
+async def proxy_resource(request):
+    url = request.query.get('url')
+    if not url:
+        return web.json_response({"error": "No URL provided"}, status=400)
+
+    state = request.app['upstream']
+    try:
+        url = ensure_https(url)
+        accesslog.note_host(url)
+        headers = main.resource_request_headers(url)
+
+        range_header = request.headers.get('Range')
+        if range_header:
+            headers['Range'] = range_header
+
+        # Videos already in the segment cache are assembled from their disk blocks
+        if config.VIDEO_CACHE_ENABLED:
+            meta = main.segment_cache.lookup(url)
+            if meta is not None:
+                segmented = await segmented_video_response(request, url, headers, meta, range_header)
+                if segmented is not None:
+                    accesslog.note('cache', 'segments')
+                    return segmented
+
+        # Serve fresh copies straight from the cache (ranged requests always go upstream)
+        use_cache = config.RESOURCE_CACHE_ENABLED and not range_header
+        cached = main.resource_cache.lookup(url, headers, allow_stale=True) if use_cache else None
+        if cached is not None and cached.is_fresh():
+            return cached_resource_response(request, cached)
+
+        upstream_headers = headers.copy()
+        if cached is not None:
+            upstream_headers.update(cached.conditional_headers())
+        else:
+            for name in main.CONDITIONAL_HEADERS:
+                if request.headers.get(name):
+                    upstream_headers[name] = request.headers[name]
+
+        async with coalesced_fetch(state, url, decompress=False, headers=upstream_headers) as response:
+            if response.status == 304:
+                if cached is not None:
+                    return cached_resource_response(request, main.resource_cache.refresh(cached, headers, response.headers))
+                return web.Response(status=304, headers=validator_headers(response.headers))
+
+            # Stylesheets are rewritten so their references stay inside the proxy
+            if (config.REWRITE_STYLESHEETS and response.status == 200 and main.is_stylesheet(response.headers)
+                    and (main.declared_length(response.headers) or 0) <= config.RESOURCE_STREAM_BUFFER_BYTES):
+                with accesslog.phase('transfer'):
+                    raw_body = await response.read()
+                accesslog.add_bytes_in(len(raw_body))
+                if use_cache:
+                    main.resource_cache.store(url, headers, response.status, response.headers, raw_body)
+                stylesheet = await state.run_cpu(main.stylesheet_response, url, raw_body, response.headers,
+                                                 request.headers)
+                if stylesheet is not None:
+                    return web.Response(body=stylesheet[0], headers=stylesheet[1])
+                return web.Response(body=raw_body, headers=main.relay_headers(response.headers, passthrough=True))
+
+            # Relay the body as it arrives, still compressed if the browser accepts
+            # the origin's coding; see main.proxy_resource for the caching rules
+            content_type = response.headers.get('Content-Type', 'application/octet-stream')
+            is_video = any(video_type in content_type for video_type in main.VIDEO_CONTENT_TYPES)
+            coding = content_coding(response.headers)
+            passthrough = coding != 'identity' and accepts(request.headers.get('Accept-Encoding'), coding)
+            cacheable = use_cache and not is_video and (passthrough or coding == 'identity')
+            buffer_limit = main.cache_buffer_limit(response.headers) if cacheable else 0
+            writer = None
+            if is_video and config.VIDEO_CACHE_ENABLED:
+                registered = main.segment_cache.register(url, response.status, response.headers)
+                if registered is not None:
+                    writer = main.segment_cache.writer(*registered)
+            return await relay_resource(request, response, url, headers, buffer_limit, passthrough, writer)
+
+    except UpstreamUnavailable as e:
+        accesslog.note_error(e)
+        return web.json_response({"error": str(e)}, status=503, headers={'Retry-After': str(e.retry_after)})
+    except Exception as e:
+        accesslog.note_error(e)
+        logger.error(f"Error proxying resource {url}: {str(e)}")
+        return web.json_response({"error": str(e)}, status=500)
+
+
+@web.middleware
+async def access_record(request, handler):
+    """Write one access record per request, as ``main`` does for Flask"""
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else 'unmatched'
+    record = accesslog.begin(request.method, route)
+    if route != request.path:
+        accesslog.note('path', request.path)
+    try:
+        response = await handler(request)
+    except web.HTTPException as e:
+        accesslog.finish(record, e.status)
+        raise
+    except BaseException as e:
+        accesslog.note_error(e)
+        accesslog.finish(record, 500)
+        raise
+    if response.prepared:
+        nbytes = response.body_length
+    else:
+        nbytes = len(response.body) if isinstance(getattr(response, 'body', None), bytes) else response.content_length
+    accesslog.finish(record, response.status, nbytes)
+    return response
+
+
+@web.middleware
+async def profile_request(request, handler):
+    """Profile requests that ask for it, as ``main`` does for Flask"""
+    profile = profiling.profiler.begin(request.method, request.path, request.headers, request.query)
+    if profile is None:
+        return await handler(request)
+    accesslog.note('profile', profile.name)
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        if not response.prepared:
+            response.headers['X-Berry-Profile'] = profile.name
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        profiling.profiler.finish(profile, f"{request.method} {request.path_qs} -> {status}")
+
+
+@web.middleware
+async def compress_response(request, handler):
+    """Async counterpart of ``main.compress_response`` for buffered responses"""
+    response = await handler(request)
+    if (not config.COMPRESSION_ENABLED or type(response) is not web.Response
+            or not isinstance(response.body, bytes) or response.status in (204, 206, 304)
+            or 'Content-Encoding' in response.headers or not is_compressible(response.content_type)
+            or len(response.body) < config.COMPRESSION_MIN_BYTES):
+        return response
+    response.headers['Vary'] = 'Accept-Encoding'
+    if accepts(request.headers.get('Accept-Encoding'), 'gzip'):
+        response.body = gzip_bytes(response.body, config.COMPRESSION_LEVEL)
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+async def add_cors_headers(request, response):
+    # Match flask-cors on the Flask app: every route is open to any origin
+    response.headers['Access-Control-Allow-Origin'] = '*'
+
+
+async def add_profile_header(request, response):
+    profile = profiling.current()
+    if profile is not None:
+        response.headers['X-Berry-Profile'] = profile.name
+
+
+async def warm_origin(state, origin):
+    try:
+        async with state.session() as session:
+            async with session.head(origin, headers=main.BROWSER_HEADERS, allow_redirects=False,
+                                    timeout=aiohttp.ClientTimeout(total=config.WARM_TIMEOUT)):
+                pass
+    except Exception as e:
+        logger.warning(f"Warm-up connection to {origin} failed: {str(e)}")
+
+
+async def warm_up(app):
+    """Async counterpart of ``main.warm_up``, run before the app starts serving"""
+    state = app['upstream']
+    started = time.perf_counter()
+    await asyncio.gather(state.run_cpu(main.warm_rewriters),
+                         *(warm_origin(state, origin) for origin in config.WARM_ORIGINS))
+    logger.info(f"Warm-up finished in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+
+async def upstream_context(app):
+    app['upstream'] = UpstreamState()
+    yield
+    await app['upstream'].close()
+
+
+def create_app():
+    app = web.Application(middlewares=[access_record, profile_request, compress_response])
+    app.router.add_get('/', index)
+    app.router.add_get('/status', status)
+    app.router.add_get('/metrics', metrics_endpoint)
+    app.router.add_get('/youtube', serve_route)
+    app.router.add_route('GET', '/search', serve_route)
+    app.router.add_route('POST', '/search', serve_route)
+    app.router.add_route('GET', '/proxy', serve_route)
+    app.router.add_route('POST', '/proxy', serve_route)
+    app.router.add_get('/results', serve_route)
+    app.router.add_get('/watch', serve_route)
+    app.router.add_get('/proxy-resource', proxy_resource)
+    app.router.add_get('/{youtube_path:.+}', youtube_catchall)
+    app.on_response_prepare.append(add_cors_headers)
+    app.on_response_prepare.append(add_profile_header)
+    app.cleanup_ctx.append(upstream_context)
+    if config.WARM_UP:
+        app.on_startup.append(warm_up)
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(create_app(), host=config.HOST, port=config.PORT)
@@ -0,0 +1,90 @@
+"""
+Size policy for proxied pages.
+
+A BeautifulSoup tree takes roughly ten times the memory of the page it was
+built from, so pages are handled according to their size:
+
+* up to ``config.DOCUMENT_SOFT_LIMIT_BYTES`` they are parsed into a tree;
+* past it they go through the incremental rewriter, which keeps only the
+  markup it has not flushed yet;
+* past ``config.DOCUMENT_HARD_LIMIT_BYTES`` the rest of the page is relayed
+  unmodified.
+
+Tree parses also share a process-wide ``ParseBudget`` of page bytes. A page
+that cannot get its share within ``config.PARSE_BUDGET_WAIT`` seconds is
+rewritten incrementally instead, so a burst of large pages cannot multiply
+the memory held by parse trees.
+"""
+import threading
+
+import config
+
+TREE = 'tree'
+STREAM = 'stream'
+RELAY = 'relay'
+
+
+def document_plan(size):
+    """How to handle a page of ``size`` bytes (None when not known yet)"""
+    if size is None or size <= config.DOCUMENT_SOFT_LIMIT_BYTES:
+        return TREE
+    if size <= config.DOCUMENT_HARD_LIMIT_BYTES:
+        return STREAM
+    return RELAY
+
+
+class ParseBudget:
+    """Bytes of page source being parsed into trees at once, across threads"""
+
+    def __init__(self, max_bytes, wait):
+        self.max_bytes = max_bytes
+        self.wait = wait
+        self.in_use = 0
+        self._changed = threading.Condition()
+        self._counts = {
+            'parses': 0,
+            'waited': 0,
+            'refused': 0,
+            'peak_bytes': 0,
+        }
+
+    def _share(self, size):
+        # A page larger than the whole budget waits for all of it
+        return min(size, self.max_bytes)
+
+    def acquire(self, size):
+        """
+        Reserve ``size`` bytes, waiting up to ``self.wait`` seconds.
+        False if the page should be rewritten without a tree instead.
+        """
+        share = self._share(size)
+        with self._changed:
+            if self.in_use + share > self.max_bytes:
+                self._counts['waited'] += 1
+                if not self._changed.wait_for(lambda: self.in_use + share <= self.max_bytes, self.wait):
+                    self._counts['refused'] += 1
+                    return False
+            self.in_use += share
+            self._counts['parses'] += 1
+            self._counts['peak_bytes'] = max(self._counts['peak_bytes'], self.in_use)
+            return True
+
+    def release(self, size):
+        with self._changed:
+            self.in_use -= self._share(size)
+            self._changed.notify_all()
+
+    def stats(self):
+        with self._changed:
+            stats = dict(self._counts)
+            stats['in_use_bytes'] = self.in_use
+        stats['max_bytes'] = self.max_bytes
+        stats['soft_limit_bytes'] = config.DOCUMENT_SOFT_LIMIT_BYTES
+        stats['hard_limit_bytes'] = config.DOCUMENT_HARD_LIMIT_BYTES
+        return stats
+
+
+parse_budget = ParseBudget(
+    max_bytes=config.PARSE_BUDGET_BYTES,
+    wait=config.PARSE_BUDGET_WAIT,
+)
@@ -0,0 +1,543 @@
+"""
+Bounded in-process caches for proxied content.
+
+``LRUStore`` is a thread-safe LRU map bounded by both entry count and total
+bytes. ``ResourceCache`` layers HTTP caching semantics on top of it
+(``Cache-Control``, ``Expires``, ``Vary``, ``no-store``) for responses
+served by ``/proxy-resource``, and ``DocumentCache`` holds rewritten pages
+for ``/proxy``.
+"""
+import base64
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+
+from requests.structures import CaseInsensitiveDict
+
+# Status codes we are willing to store
+CACHEABLE_STATUSES = (200, 203)
+
+# Upstream headers kept with a cached response
+STORED_HEADERS = ('content-type', 'content-encoding', 'etag', 'last-modified', 'cache-control', 'expires', 'vary')
+
+# Headers that are relayed to the browser so it can cache and revalidate
+VALIDATOR_HEADERS = ('ETag', 'Last-Modified', 'Cache-Control', 'Expires')
+
+
+class LRUStore:
+    """
+    Thread-safe LRU map bounded by entry count and total byte size.
+
+    ``size_of`` is called once per stored value to account its bytes.
+    """
+
+    def __init__(self, max_bytes, max_entries, size_of=len):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._size_of = size_of
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def get(self, key, count=True):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                if count:
+                    self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            if count:
+                self.hits += 1
+            return value
+
+    def peek(self, key):
+        """Look up without touching recency or hit counters"""
+        with self._lock:
+            return self._data.get(key)
+
+    def put(self, key, value):
+        size = self._size_of(value)
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            if key in self._data:
+                self.bytes -= self._sizes.pop(key)
+                del self._data[key]
+            self._data[key] = value
+            self._sizes[key] = size
+            self.bytes += size
+            self.stores += 1
+            while len(self._data) > self.max_entries or self.bytes > self.max_bytes:
+                old_key, _ = self._data.popitem(last=False)
+                self.bytes -= self._sizes.pop(old_key)
+                self.evictions += 1
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                del self._data[key]
+                self.bytes -= self._sizes.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.bytes = 0
+
+    def record_hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def record_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._data),
+                'bytes': self.bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions,
+            }
+
+
+def parse_cache_control(value):
+    """
+    Parse a Cache-Control header into ``{directive: value-or-True}``
+    """
+    directives = {}
+    for part in (value or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        name, sep, arg = part.partition('=')
+        directives[name.strip().lower()] = arg.strip().strip('"') if sep else True
+    return directives
+
+
+def _http_date(value):
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Weak comparison of an ``If-None-Match`` header against an ETag
+    """
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+
+def is_not_modified(request_headers, etag=None, last_modified=None):
+    """
+    Decide whether a client's conditional request can be answered with 304.
+    ``If-None-Match`` takes precedence over ``If-Modified-Since``.
+    """
+    if_none_match = request_headers.get('If-None-Match')
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    since = _http_date(request_headers.get('If-Modified-Since'))
+    modified = _http_date(last_modified)
+    return since is not None and modified is not None and modified <= since
+
+
+def validator_headers(headers):
+    """Pick the caching and validator headers worth relaying to the browser"""
+    return {name: headers[name] for name in VALIDATOR_HEADERS if headers.get(name)}
+
+
+def weaken_etag(headers):
+    """
+    Mark the ETag in ``headers`` weak, for bytes that are another
+    representation (compressed, decoded or rewritten) of what it names
+    """
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        headers['ETag'] = f"W/{etag}"
+
+
+def document_etag(signature, upstream_etag=None, body=None):
+    """
+    Build the ETag for a rewritten document. When the origin supplied an
+    ETag it is embedded, so a later conditional request can be forwarded
+    upstream; otherwise the ETag is a digest of the rewritten body.
+    """
+    if upstream_etag:
+        token = base64.urlsafe_b64encode(upstream_etag.encode('utf-8')).decode('ascii').rstrip('=')
+        return f'W/"u.{signature}.{token}"'
+    return f'W/"h.{signature}.{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+
+
+def upstream_etag_for(if_none_match, signature):
+    """
+    Recover the origin ETag embedded by ``document_etag`` from a browser's
+    ``If-None-Match``, or None
+    """
+    prefix = f'u.{signature}.'
+    for candidate in (if_none_match or '').split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        candidate = candidate.strip('"')
+        if candidate.startswith(prefix):
+            token = candidate[len(prefix):]
+            try:
+                return base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8')
+            except (ValueError, UnicodeDecodeError):
+                return None
+    return None
+
+
+def freshness_lifetime(headers, now=None, heuristic_max=0):
+    """
+    Return how many seconds a response stays fresh in a shared cache, or
+    None when it must not be stored at all
+    """
+    now = time.time() if now is None else now
+    cc = parse_cache_control(headers.get('Cache-Control'))
+    if 'no-store' in cc or 'private' in cc:
+        return None
+    if 'no-cache' in cc:
+        return 0
+
+    for directive in ('s-maxage', 'max-age'):
+        if directive in cc:
+            try:
+                return max(int(cc[directive]), 0)
+            except (TypeError, ValueError):
+                return 0
+
+    date = _http_date(headers.get('Date')) or now
+    expires = headers.get('Expires')
+    if expires is not None:
+        expires_at = _http_date(expires)
+        # Invalid Expires values (such as "0") mean already expired
+        return max(expires_at - date, 0) if expires_at else 0
+
+    # Heuristic freshness: 10% of the time since the last modification
+    last_modified = _http_date(headers.get('Last-Modified'))
+    if last_modified and heuristic_max > 0:
+        return min(max((date - last_modified) * 0.1, 0), heuristic_max)
+    return 0
+
+
+class CachedResponse:
+    """
+    A stored upstream response and the request headers it varies on, with
+    the gzip form of an unencoded body when one is kept
+    """
+
+    __slots__ = ('url', 'status', 'headers', 'body', 'vary', 'stored_at', 'expires_at', 'compressed')
+
+    def __init__(self, url, status, headers, body, vary, stored_at, expires_at, compressed=None):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.vary = vary
+        self.stored_at = stored_at
+        self.expires_at = expires_at
+        self.compressed = compressed
+
+    def is_fresh(self, now=None):
+        return (time.time() if now is None else now) < self.expires_at
+
+    def conditional_headers(self):
+        """Request headers that revalidate this entry with the origin"""
+        conditional = {}
+        if self.headers.get('ETag'):
+            conditional['If-None-Match'] = self.headers['ETag']
+        if self.headers.get('Last-Modified'):
+            conditional['If-Modified-Since'] = self.headers['Last-Modified']
+        return conditional
+
+    @property
+    def size(self):
+        return (len(self.body) + len(self.compressed or b'') + sum(len(k) + len(v) for k, v in self.headers.items())
+                + len(self.url))
+
+
+def _vary_names(headers):
+    return tuple(sorted(name.strip().lower() for name in headers.get('Vary', '').split(',') if name.strip()))
+
+
+def _vary_values(names, request_headers):
+    lowered = {k.lower(): v for k, v in request_headers.items()}
+    return tuple((name, lowered.get(name, '')) for name in names)
+
+
+class ResourceCache:
+    """
+    Shared HTTP cache for subresources.
+
+    Entries are keyed by URL plus the values of the request headers named in
+    the upstream ``Vary``; the known ``Vary`` header names for each URL are
+    remembered so a lookup can build the right key before fetching.
+    ``compress(headers, body)``, when given, returns a compressed form to
+    keep with an entry (or None), so hits are not compressed again.
+    """
+
+    def __init__(self, max_bytes, max_entries, max_entry_bytes, heuristic_max=0, compress=None):
+        self.max_entry_bytes = max_entry_bytes
+        self.heuristic_max = heuristic_max
+        self.compress = compress
+        self._store = LRUStore(max_bytes, max_entries, size_of=lambda entry: entry.size)
+        self._vary_by_url = LRUStore(max_entries, max_entries, size_of=lambda names: 1)
+        self._lock = threading.Lock()
+        self.stale_hits = 0
+        self.revalidated = 0
+
+    def _key(self, url, request_headers, names):
+        return (url, _vary_values(names, request_headers))
+
+    def lookup(self, url, request_headers, allow_stale=False):
+        """
+        Return the cached entry for this request, or None. Stale entries are
+        only returned with ``allow_stale`` (so they can be revalidated).
+        """
+        names = self._vary_by_url.peek(url)
+        entry = None
+        if names is not None:
+            entry = self._store.get(self._key(url, request_headers, names), count=False)
+        if entry is not None and entry.is_fresh():
+            self._store.record_hit()
+            return entry
+        if entry is not None and allow_stale and entry.conditional_headers():
+            with self._lock:
+                self.stale_hits += 1
+            return entry
+        self._store.record_miss()
+        return None
+
+    def contains_fresh(self, url, request_headers):
+        """Whether a fresh entry exists for this request, without touching the stats"""
+        names = self._vary_by_url.peek(url)
+        if names is None:
+            return False
+        entry = self._store.peek(self._key(url, request_headers, names))
+        return entry is not None and entry.is_fresh()
+
+    def store(self, url, request_headers, status, headers, body):
+        """
+        Store an upstream response if its status and caching headers allow it
+        """
+        if status not in CACHEABLE_STATUSES or len(body) > self.max_entry_bytes:
+            return None
+        names = _vary_names(headers)
+        if '*' in names:
+            return None
+        now = time.time()
+        lifetime = freshness_lifetime(headers, now, self.heuristic_max)
+        if lifetime is None:
+            return None
+        try:
+            lifetime -= int(headers.get('Age', 0))
+        except (TypeError, ValueError):
+            pass
+        # An entry that is already stale is only worth keeping if it can be revalidated
+        if lifetime <= 0 and not (headers.get('ETag') or headers.get('Last-Modified')):
+            return None
+
+        kept = CaseInsensitiveDict()
+        for key, value in headers.items():
+            if key.lower() in STORED_HEADERS:
+                kept[key] = value
+        compressed = self.compress(kept, body) if self.compress is not None else None
+        entry = CachedResponse(url, status, kept, body, names, now, now + lifetime, compressed)
+        self._vary_by_url.put(url, names)
+        if not self._store.put(self._key(url, request_headers, names), entry):
+            return None
+        return entry
+
+    def refresh(self, entry, request_headers, not_modified_headers):
+        """
+        Update a stale entry after the origin answered 304 Not Modified,
+        returning the refreshed entry
+        """
+        headers = CaseInsensitiveDict(entry.headers)
+        for key, value in not_modified_headers.items():
+            if key.lower() in STORED_HEADERS and key.lower() != 'content-type':
+                headers[key] = value
+        now = time.time()
+        lifetime = freshness_lifetime(headers, now, self.heuristic_max)
+        if lifetime is None:
+            self.invalidate(entry.url, request_headers)
+            return entry
+        refreshed = CachedResponse(entry.url, entry.status, headers, entry.body, entry.vary, now, now + lifetime,
+                                   entry.compressed)
+        self._store.put(self._key(entry.url, request_headers, entry.vary), refreshed)
+        with self._lock:
+            self.revalidated += 1
+        return refreshed
+
+    def invalidate(self, url, request_headers):
+        names = self._vary_by_url.peek(url)
+        if names is not None:
+            self._store.delete(self._key(url, request_headers, names))
+
+    def stats(self):
+        stats = self._store.stats()
+        with self._lock:
+            stats['stale_hits'] = self.stale_hits
+            stats['revalidated'] = self.revalidated
+        stats['max_entry_bytes'] = self.max_entry_bytes
+        return stats
+
+
+class CachedDocument:
+    """
+    A rewritten page in its own encoding, optionally with its
+    gzip-compressed form, the subresources it references and the
+    fingerprint of the upstream body it came from
+    """
+
+    __slots__ = ('url', 'fingerprint', 'upstream_etag', 'etag', 'body', 'compressed', 'subresources',
+                 'encoding', 'stored_at', 'fresh_until', 'stale_until')
+
+    def __init__(self, url, fingerprint, upstream_etag, etag, body, compressed, subresources, encoding,
+                 stored_at, fresh_until, stale_until):
+        self.url = url
+        self.fingerprint = fingerprint
+        self.upstream_etag = upstream_etag
+        self.etag = etag
+        self.body = body
+        self.compressed = compressed
+        self.subresources = subresources
+        self.encoding = encoding
+        self.stored_at = stored_at
+        self.fresh_until = fresh_until
+        self.stale_until = stale_until
+
+    @property
+    def size(self):
+        return (len(self.body) + len(self.compressed or b'') + len(self.url) + 128
+                + sum(len(url) + 16 for _, url in self.subresources))
+
+
+def body_fingerprint(body):
+    """Digest identifying an upstream body"""
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+class DocumentCache:
+    """
+    Cache of rewritten HTML keyed by normalized URL.
+
+    Entries are fresh for ``ttl`` seconds and may then be served stale for
+    another ``stale_ttl`` seconds while a single background refresh runs.
+    Expired entries are still returned to the caller so their upstream
+    fingerprint and ETag can avoid a redundant rewrite.
+    """
+
+    FRESH = 'fresh'
+    STALE = 'stale'
+    EXPIRED = 'expired'
+
+    def __init__(self, max_bytes, max_entries, ttl, stale_ttl):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._store = LRUStore(max_bytes, max_entries, size_of=lambda entry: entry.size)
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self.stale_hits = 0
+        self.rewrites_saved = 0
+        self.refreshes = 0
+
+    def lookup(self, key):
+        """Return ``(entry, state)``; both are None on a miss"""
+        entry = self._store.get(key, count=False)
+        if entry is None:
+            self._store.record_miss()
+            return None, None
+        now = time.time()
+        if now < entry.fresh_until:
+            self._store.record_hit()
+            return entry, self.FRESH
+        if now < entry.stale_until:
+            with self._lock:
+                self.stale_hits += 1
+            return entry, self.STALE
+        self._store.record_miss()
+        return entry, self.EXPIRED
+
+    def store(self, key, url, fingerprint, upstream_etag, etag, body, headers, compressed=None, subresources=(),
+              encoding='utf-8'):
+        """Store a rewritten page unless the origin forbids storing it"""
+        if 'no-store' in parse_cache_control(headers.get('Cache-Control')):
+            self._store.delete(key)
+            return None
+        now = time.time()
+        entry = CachedDocument(url, fingerprint, upstream_etag, etag, body, compressed, tuple(subresources), encoding,
+                               now, now + self.ttl, now + self.ttl + self.stale_ttl)
+        if not self._store.put(key, entry):
+            return None
+        return entry
+
+    def touch(self, key, entry):
+        """Restart the freshness window of an entry the origin confirmed unchanged"""
+        now = time.time()
+        refreshed = CachedDocument(entry.url, entry.fingerprint, entry.upstream_etag, entry.etag, entry.body,
+                                   entry.compressed, entry.subresources, entry.encoding,
+                                   now, now + self.ttl, now + self.ttl + self.stale_ttl)
+        self._store.put(key, refreshed)
+        return refreshed
+
+    def record_rewrite_saved(self):
+        with self._lock:
+            self.rewrites_saved += 1
+
+    def begin_refresh(self, key):
+        """Claim the background refresh for ``key``; False if one is already running"""
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            self.refreshes += 1
+            return True
+
+    def end_refresh(self, key):
+        with self._lock:
+            self._refreshing.discard(key)
+
+    def stats(self):
+        stats = self._store.stats()
+        with self._lock:
+            stats.update({
+                'stale_hits': self.stale_hits,
+                'rewrites_saved': self.rewrites_saved,
+                'refreshes': self.refreshes,
+                'refreshing': len(self._refreshing),
+                'ttl': self.ttl,
+                'stale_ttl': self.stale_ttl,
+            })
+        return stats
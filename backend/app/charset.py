@@ -0,0 +1,83 @@
+"""
+Character encoding of proxied pages.
+
+``requests`` decodes ``response.text`` with the Content-Type charset, falling
+back to ISO-8859-1 for any ``text/*`` type without one and to statistical
+detection over the whole body otherwise. Pages are resolved here the way
+browsers do instead, cheapest evidence first:
+
+* a byte order mark;
+* the Content-Type charset;
+* a ``<meta charset>`` (or ``http-equiv`` Content-Type) in the first
+  ``config.CHARSET_SCAN_BYTES`` bytes;
+* UTF-8, when that many bytes decode as UTF-8;
+* statistical detection over the first ``config.CHARSET_DETECT_BYTES`` bytes;
+* windows-1252, the web's legacy default, when detection has no answer.
+
+The label found is kept as declared, so a rewritten page can be sent back in
+the encoding, and under the name, it arrived with.
+"""
+import codecs
+import re
+
+from requests.compat import chardet
+
+import config
+
+_CONTENT_TYPE_CHARSET_RE = re.compile(r'charset\s*=\s*["\']?([A-Za-z0-9_.:-]+)', re.IGNORECASE)
+_META_CHARSET_RE = re.compile(rb'<meta\s[^>]*?charset\s*=\s*["\']?\s*([A-Za-z0-9_.:-]+)', re.IGNORECASE)
+
+_BOMS = (
+    (codecs.BOM_UTF8, 'utf-8'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+
+def _known(label):
+    """``label`` if Python can decode with it, else None"""
+    if not label:
+        return None
+    try:
+        codecs.lookup(label)
+    except LookupError:
+        return None
+    return label.lower()
+
+
+def _is_utf16(label):
+    return codecs.lookup(label).name.startswith(('utf-16', 'utf-32'))
+
+
+def document_encoding(body, content_type=None):
+    """The encoding a page's bytes should be decoded (and re-encoded) with"""
+    for bom, encoding in _BOMS:
+        if body.startswith(bom):
+            return encoding
+    match = _CONTENT_TYPE_CHARSET_RE.search(content_type or '')
+    encoding = _known(match.group(1)) if match else None
+    if encoding:
+        return encoding
+    head = body[:config.CHARSET_SCAN_BYTES]
+    match = _META_CHARSET_RE.search(head)
+    encoding = _known(match.group(1).decode('ascii')) if match else None
+    if encoding:
+        # A page whose <meta> could be read is not UTF-16, whatever it says
+        return 'utf-8' if _is_utf16(encoding) else encoding
+    try:
+        head.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError as e:
+        # A multi-byte sequence cut off by the scan window still counts
+        if e.start >= len(head) - 3 and e.reason == 'unexpected end of data':
+            return 'utf-8'
+    return _known(chardet.detect(body[:config.CHARSET_DETECT_BYTES]).get('encoding')) or 'windows-1252'
+
+
+def decode_document(body, encoding):
+    return str(body, encoding, errors='replace')
+
+
+def encode_document(text, encoding):
+    """``text`` in ``encoding``, with characters it lacks as character references"""
+    return text.encode(encoding, errors='xmlcharrefreplace')
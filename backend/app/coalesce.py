@@ -0,0 +1,371 @@
+"""
+Single-flight coalescing of identical concurrent upstream fetches.
+
+When the same page or subresource is requested several times at once (one
+page open in several tabs, or for several users), only the first request,
+the leader, goes to the origin. Requests that arrive while it is in
+flight follow it: they receive its status and headers and read its body
+from a shared ``Flight`` buffer as the leader downloads it.
+
+Fetches are identical when their method, canonical URL and upstream request
+headers match. The proxy builds those headers itself, so they cover every
+header an origin's ``Vary`` can name, and followers never receive a
+variant they did not ask for. Only GETs are coalesced.
+
+Followers are bounded three ways:
+
+* A follower waits at most ``config.COALESCE_WAIT_TIMEOUT`` seconds for the
+  leader's response headers, then fetches on its own (as it does when the
+  leader gives up before its headers arrive; an origin error is shared).
+* Each body read waits at most the follower's own read timeout.
+* A flight buffers ``config.COALESCE_BUFFER_BYTES``. Past that it takes no
+  new followers and drops the bytes every follower has read. A follower
+  that falls that far behind is cut off, as if its connection had broken.
+
+If the leader stops reading early (its browser went away) while followers
+are attached, the rest of the body is still downloaded for them.
+"""
+import asyncio
+import bisect
+import threading
+
+import config
+from urls import normalize_url
+
+
+class FlightAborted(Exception):
+    """The shared body ended early, or this follower fell too far behind"""
+
+
+class FlightTimeout(Exception):
+    """No shared bytes arrived within a follower's read timeout"""
+
+
+def flight_key(method, url, headers, *extra):
+    """Identity of an upstream fetch: method, canonical URL, request headers and ``extra``"""
+    items = tuple(sorted((name.lower(), value) for name, value in (headers or {}).items()))
+    return (method, normalize_url(url), items) + extra
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class Follower:
+    """One follower's read position in a ``Flight``"""
+
+    __slots__ = ('flight', 'position', 'dropped', 'closed')
+
+    def __init__(self, flight):
+        self.flight = flight
+        self.position = 0
+        self.dropped = False
+        self.closed = False
+
+    def read(self, n, timeout):
+        """Up to ``n`` shared bytes (short only at the end), b'' at the end of the body"""
+        parts = []
+        size = 0
+        while size < n:
+            data = self.flight._read(self, n - size, timeout)
+            if not data:
+                break
+            parts.append(data)
+            size += len(data)
+        return parts[0] if len(parts) == 1 else b''.join(parts)
+
+    def read_all(self, timeout):
+        parts = []
+        while True:
+            data = self.flight._read(self, None, timeout)
+            if not data:
+                return b''.join(parts)
+            parts.append(data)
+
+    async def read_async(self, n, timeout):
+        """The next shared bytes, at most ``n`` (None for any amount), b'' at the end"""
+        return await self.flight._read_async(self, n, timeout)
+
+    def at_end(self):
+        return self.flight._at_end(self)
+
+    def close(self):
+        self.flight._detach(self)
+
+
+class Flight:
+    """
+    The response of one in-flight upstream fetch: published once by the
+    leader, then its body bytes as they arrive, shared with any followers
+    """
+
+    def __init__(self, group, key):
+        self.group = group
+        self.key = key
+        self.max_bytes = group.max_bytes
+        self.published = False
+        self.status = None
+        self.reason = None
+        self.url = None
+        self.headers = None
+        self.error = None
+        self.done = False
+        # Whether new followers may still join
+        self.open = True
+        self.size = 0
+        self._chunks = []
+        self._offsets = []
+        self._followers = set()
+        self._async_waiters = []
+        # Every flight shares its group's lock, so joining, counting and
+        # discarding never take two locks
+        self._lock = group._lock
+        self._changed = threading.Condition(self._lock)
+
+    def _notify(self):
+        self._changed.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for waiter in waiters:
+            waiter.get_loop().call_soon_threadsafe(_wake, waiter)
+
+    def _close(self):
+        """Stop taking followers (lock held)"""
+        if self.open:
+            self.open = False
+            self.group._discard(self)
+        self._trim()
+
+    def _trim(self):
+        """Drop the chunks every follower has read; only once no one can join (lock held)"""
+        if self.open:
+            return
+        keep_from = min((follower.position for follower in self._followers), default=self.size)
+        index = bisect.bisect_right(self._offsets, keep_from) - 1
+        if keep_from >= self.size:
+            index = len(self._chunks)
+        if index > 0:
+            del self._chunks[:index]
+            del self._offsets[:index]
+
+    def _follow(self):
+        """A new ``Follower``, or None if the flight no longer takes them (lock held)"""
+        if not self.open:
+            return None
+        follower = Follower(self)
+        self._followers.add(follower)
+        return follower
+
+    @property
+    def followers(self):
+        return len(self._followers)
+
+    # Leader side
+
+    def publish(self, status, reason, url, headers):
+        with self._lock:
+            self.status = status
+            self.reason = reason
+            self.url = url
+            self.headers = headers
+            self.published = True
+            self._notify()
+
+    def append(self, data):
+        if not data:
+            return
+        with self._lock:
+            if self.open or self._followers:
+                self._offsets.append(self.size)
+                self._chunks.append(data)
+            self.size += len(data)
+            if self.open and self.size > self.max_bytes:
+                self.group._record('overflowed')
+                self._close()
+            if not self.open:
+                behind = self.size - self.max_bytes
+                for follower in [follower for follower in self._followers if follower.position < behind]:
+                    follower.dropped = True
+                    self._followers.discard(follower)
+                    self.group._record('dropped')
+                self._trim()
+            self._notify()
+
+    def finish(self):
+        with self._lock:
+            if self.done:
+                return
+            self.done = True
+            self._close()
+            self._notify()
+
+    def fail(self, error=None):
+        """
+        End the flight early. Followers waiting for headers raise ``error``,
+        or fetch on their own without one; followers reading the body find
+        it cut short.
+        """
+        with self._lock:
+            if self.done:
+                return
+            if error is None and self.published:
+                # Followers reading the body must see that it was cut short
+                error = FlightAborted("The leader stopped reading")
+            self.error = error
+            self.done = True
+            self._close()
+            self._notify()
+
+    # Follower side
+
+    def wait_published(self, timeout):
+        """
+        Wait for the leader's response. False when the follower should fetch
+        on its own (timeout, or the leader gave up); raises the leader's error.
+        """
+        with self._lock:
+            self._changed.wait_for(lambda: self.published or self.done, timeout)
+        return self._check_published()
+
+    async def wait_published_async(self, timeout):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self.published or self.done:
+                    break
+                waiter = loop.create_future()
+                self._async_waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, timeout)
+            except asyncio.TimeoutError:
+                break
+        return self._check_published()
+
+    def _check_published(self):
+        with self._lock:
+            if self.published:
+                self.group._record('coalesced')
+                return True
+            if self.error is None:
+                self.group._record('fallbacks')
+                return False
+            self.group._record('shared_errors')
+        raise self.error
+
+    def _take(self, follower, n):
+        """Bytes at ``follower``'s position (lock held); None if it must wait"""
+        if follower.dropped:
+            raise FlightAborted("Fell too far behind the shared upstream response")
+        if follower.position < self.size:
+            index = bisect.bisect_right(self._offsets, follower.position) - 1
+            chunk = self._chunks[index]
+            start = follower.position - self._offsets[index]
+            if start or (n is not None and n < len(chunk) - start):
+                chunk = chunk[start:start + n if n is not None else None]
+            follower.position += len(chunk)
+            self.group._record('shared_bytes', len(chunk))
+            self._trim()
+            return chunk
+        if self.error is not None:
+            raise FlightAborted(f"Shared upstream response broke off: {str(self.error)}")
+        if self.done:
+            return b''
+        return None
+
+    def _read(self, follower, n, timeout):
+        with self._lock:
+            data = self._take(follower, n)
+            while data is None:
+                if not self._changed.wait(timeout):
+                    raise FlightTimeout(f"No shared upstream data within {timeout:g}s")
+                data = self._take(follower, n)
+            return data
+
+    async def _read_async(self, follower, n, timeout):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                data = self._take(follower, n)
+                if data is not None:
+                    return data
+                waiter = loop.create_future()
+                self._async_waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, timeout)
+            except asyncio.TimeoutError:
+                raise FlightTimeout(f"No shared upstream data within {timeout:g}s") from None
+
+    def _at_end(self, follower):
+        with self._lock:
+            return follower.dropped or (self.done and follower.position >= self.size)
+
+    def _detach(self, follower):
+        with self._lock:
+            if follower.closed:
+                return
+            follower.closed = True
+            self._followers.discard(follower)
+            self._trim()
+
+
+class SingleFlight:
+    """Registry of in-flight fetches by ``flight_key``, with coalescing counters"""
+
+    def __init__(self, max_bytes, wait_timeout):
+        self.max_bytes = max_bytes
+        self.wait_timeout = wait_timeout
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._counts = {
+            'leaders': 0,
+            'coalesced': 0,
+            'fallbacks': 0,
+            'shared_errors': 0,
+            'overflowed': 0,
+            'dropped': 0,
+            'drained': 0,
+            'shared_bytes': 0,
+        }
+
+    def join(self, key):
+        """
+        ``(flight, None)`` if the caller leads a new fetch for ``key``, or
+        ``(flight, follower)`` if it follows the one in flight
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                follower = flight._follow()
+                if follower is not None:
+                    return flight, follower
+            flight = self._flights[key] = Flight(self, key)
+            self._counts['leaders'] += 1
+            return flight, None
+
+    def _discard(self, flight):
+        # Lock held
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def _record(self, name, amount=1):
+        # Lock held
+        self._counts[name] += amount
+
+    def record_drained(self):
+        with self._lock:
+            self._record('drained')
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats['in_flight'] = len(self._flights)
+            stats['followers'] = sum(flight.followers for flight in self._flights.values())
+        stats['buffer_bytes'] = self.max_bytes
+        stats['wait_timeout'] = self.wait_timeout
+        return stats
+
+
+flights = SingleFlight(
+    max_bytes=config.COALESCE_BUFFER_BYTES,
+    wait_timeout=config.COALESCE_WAIT_TIMEOUT,
+)
@@ -0,0 +1,104 @@
+"""
+Content-coding negotiation and gzip helpers.
+
+Upstream bodies are requested as gzip or deflate only, so the proxy can
+always decode what it receives. Bodies the browser accepts in their
+upstream coding are relayed untouched; everything the proxy produces itself
+(rewritten HTML, JSON, error pages) is gzip-compressed when the browser
+accepts it.
+"""
+import gzip
+import zlib
+
+# Content codings requested from origins; both can be decoded with zlib
+UPSTREAM_ACCEPT_ENCODING = 'gzip, deflate'
+
+# Media types worth compressing; everything else is usually compressed already
+COMPRESSIBLE_TYPES = (
+    'text/',
+    'application/json',
+    'application/javascript',
+    'application/x-javascript',
+    'application/xml',
+    'application/xhtml+xml',
+    'application/rss+xml',
+    'application/manifest+json',
+    'image/svg+xml',
+)
+
+
+def accepted_encodings(accept_encoding):
+    """Map each content coding in an ``Accept-Encoding`` header to its q-value"""
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        coding, _, params = item.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def accepts(accept_encoding, coding):
+    """Whether a browser sending ``accept_encoding`` takes bodies in ``coding``"""
+    coding = coding.lower()
+    if coding == 'identity':
+        return True
+    accepted = accepted_encodings(accept_encoding)
+    if coding in accepted:
+        return accepted[coding] > 0
+    if coding == 'gzip' and 'x-gzip' in accepted:
+        return accepted['x-gzip'] > 0
+    return accepted.get('*', 0) > 0
+
+
+def content_coding(headers):
+    """The content coding of a response, lower-cased (``identity`` when absent)"""
+    return (headers.get('Content-Encoding') or 'identity').strip().lower()
+
+
+def is_compressible(content_type):
+    content_type = (content_type or '').lower()
+    return any(content_type.startswith(prefix) for prefix in COMPRESSIBLE_TYPES)
+
+
+def gzip_bytes(data, level):
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def decompress(data, coding):
+    """Decode a gzip or deflate body; returns None for codings we cannot decode"""
+    decoder = decompressor(coding)
+    if decoder is None:
+        return None
+    return decoder.decompress(data) + decoder.flush()
+
+
+def decompressor(coding):
+    """A zlib decompression object for ``coding``, or None"""
+    coding = coding.lower()
+    if coding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if coding == 'deflate':
+        # Servers send zlib-wrapped streams (a few send gzip); detect the header
+        return zlib.decompressobj(32 + zlib.MAX_WBITS)
+    return None
+
+
+def gzip_stream(chunks, level):
+    """
+    Gzip an iterable of byte chunks, flushing after every chunk so each
+    piece reaches the browser as soon as it is produced
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if chunk:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
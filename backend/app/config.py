@@ -0,0 +1,185 @@
+"""
+Runtime settings for the BerryOS browser backend.
+
+Every value can be overridden with an environment variable of the same name
+prefixed with ``BERRY_`` (for example ``BERRY_UPSTREAM_POOL_MAXSIZE=32``).
+"""
+import os
+
+
+def _env(name, default):
+    return os.environ.get(f"BERRY_{name}", default)
+
+
+def _env_int(name, default):
+    try:
+        return int(_env(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_float(name, default):
+    try:
+        return float(_env(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_bool(name, default):
+    value = _env(name, None)
+    if value is None:
+        return default
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+# Listening address
+HOST = _env('HOST', '0.0.0.0')
+PORT = _env_int('PORT', 5000)
+DEBUG = _env_bool('DEBUG', False)  # Werkzeug debugger and reloader for `python main.py`; never use in production
+
+# Production server (serve.py, gunicorn.conf.py)
+SERVER_APP = _env('SERVER_APP', 'flask')  # 'flask' (main:app) or 'async' (async_app, on aiohttp's gunicorn worker)
+SERVER_WORKERS = _env_int('SERVER_WORKERS', os.cpu_count() or 1)
+SERVER_THREADS = _env_int('SERVER_THREADS', 16)  # Requests served at once by each gthread worker
+SERVER_WORKER_CLASS = _env('SERVER_WORKER_CLASS', 'gthread')  # Worker class for the Flask app
+SERVER_PRELOAD = _env_bool('SERVER_PRELOAD', False)  # Import the app once in the master before forking workers
+SERVER_KEEPALIVE = _env_int('SERVER_KEEPALIVE', 5)  # Seconds an idle browser connection is kept open
+SERVER_TIMEOUT = _env_int('SERVER_TIMEOUT', 120)  # Seconds a silent worker is given before it is restarted
+SERVER_GRACEFUL_TIMEOUT = _env_int('SERVER_GRACEFUL_TIMEOUT', 30)  # Seconds in-flight requests get to finish on restart or shutdown
+SERVER_MAX_REQUESTS = _env_int('SERVER_MAX_REQUESTS', 0)  # Recycle a worker after this many requests (0 = never)
+SERVER_MAX_REQUESTS_JITTER = _env_int('SERVER_MAX_REQUESTS_JITTER', 0)
+SERVER_BACKLOG = _env_int('SERVER_BACKLOG', 2048)
+
+# Warm-up at boot
+WARM_UP = _env_bool('WARM_UP', True)  # Pre-connect to WARM_ORIGINS and exercise the rewriter before serving
+WARM_ORIGINS = [origin.strip() for origin in _env('WARM_ORIGINS', 'https://www.google.com,https://www.youtube.com').split(',') if origin.strip()]
+WARM_TIMEOUT = _env_float('WARM_TIMEOUT', 5.0)  # Seconds allowed for each warm-up connection
+
+# Upstream origins
+SEARCH_URL = _env('SEARCH_URL', 'https://www.google.com/search')  # Search engine queries are sent to
+PLAIN_HTTP_HOSTS = [host.strip() for host in _env('PLAIN_HTTP_HOSTS', '').split(',') if host.strip()]  # Hosts not upgraded to HTTPS (local test origins)
+
+# Internal routing
+ROUTE_MAX_HOPS = _env_int('ROUTE_MAX_HOPS', 8)  # Internal redirects followed in-process before one is sent to the browser
+URL_MEMO_SIZE = _env_int('URL_MEMO_SIZE', 4096)  # Entries kept by each memoized URL helper
+
+# Logging
+LOG_LEVEL = _env('LOG_LEVEL', 'INFO')
+LOG_QUEUE_SIZE = _env_int('LOG_QUEUE_SIZE', 10000)  # Log records waiting for the writer thread before new ones are dropped
+ACCESS_LOG_ENABLED = _env_bool('ACCESS_LOG_ENABLED', True)  # One JSON access record per request
+LOG_DIAGNOSTIC_SAMPLE_RATE = _env_float('LOG_DIAGNOSTIC_SAMPLE_RATE', 0.0)  # Fraction of requests whose per-step diagnostics are logged at INFO
+
+# Metrics
+METRICS_MAX_HOSTS = _env_int('METRICS_MAX_HOSTS', 200)  # Upstream hosts with their own /metrics series; the rest share 'other'
+
+# Request profiling
+PROFILE_ENABLED = _env_bool('PROFILE_ENABLED', False)  # Allow requests to ask for a profile with X-Berry-Profile or ?berry_profile
+PROFILE_TOKEN = _env('PROFILE_TOKEN', '')  # Value the header or flag must carry; any value when empty
+PROFILE_MODE = _env('PROFILE_MODE', 'sample')  # 'sample' (stack sampling) or 'trace' (sys.setprofile, exact but slow)
+PROFILE_INTERVAL = _env_float('PROFILE_INTERVAL', 0.001)  # Seconds between stack samples
+PROFILE_DIR = _env('PROFILE_DIR', 'profiles')  # Where .collapsed and .txt files are written
+PROFILE_TOP_N = _env_int('PROFILE_TOP_N', 30)  # Functions listed in each summary
+PROFILE_MAX_CONCURRENT = _env_int('PROFILE_MAX_CONCURRENT', 2)  # Profiles running at once; further requests run unprofiled
+
+# Upstream connection pools
+UPSTREAM_POOL_HOSTS = _env_int('UPSTREAM_POOL_HOSTS', 64)  # Number of per-host pools kept alive
+UPSTREAM_POOL_MAXSIZE = _env_int('UPSTREAM_POOL_MAXSIZE', 16)  # Idle keep-alive connections per host
+UPSTREAM_POOL_BLOCK = _env_bool('UPSTREAM_POOL_BLOCK', False)  # Wait for a free connection instead of opening extras
+UPSTREAM_MAX_RETRIES = _env_int('UPSTREAM_MAX_RETRIES', 0)
+
+# Upstream deadlines, per-host limits and circuit breaking
+UPSTREAM_CONNECT_TIMEOUT = _env_float('UPSTREAM_CONNECT_TIMEOUT', 5.0)  # Most of any budget spent connecting, seconds
+UPSTREAM_PAGE_DEADLINE = _env_float('UPSTREAM_PAGE_DEADLINE', 30.0)  # Whole page fetch (connect, headers, body), seconds
+UPSTREAM_RESOURCE_TIMEOUT = _env_float('UPSTREAM_RESOURCE_TIMEOUT', 15.0)  # Subresource headers and each body read, seconds
+UPSTREAM_STREAM_TIMEOUT = _env_float('UPSTREAM_STREAM_TIMEOUT', 30.0)  # Video headers and each body read, seconds
+UPSTREAM_HOST_MAX_CONCURRENT = _env_int('UPSTREAM_HOST_MAX_CONCURRENT', 32)  # Requests in flight to one origin host
+UPSTREAM_HOST_QUEUE_TIMEOUT = _env_float('UPSTREAM_HOST_QUEUE_TIMEOUT', 5.0)  # Wait for a host slot before giving up, seconds
+BREAKER_FAILURE_THRESHOLD = _env_int('BREAKER_FAILURE_THRESHOLD', 5)  # Consecutive failures that open a host's circuit
+BREAKER_OPEN_SECONDS = _env_float('BREAKER_OPEN_SECONDS', 30.0)  # Fail fast this long before probing the host again
+
+# Coalescing of identical concurrent upstream fetches
+COALESCE_ENABLED = _env_bool('COALESCE_ENABLED', True)
+COALESCE_WAIT_TIMEOUT = _env_float('COALESCE_WAIT_TIMEOUT', 10.0)  # Wait for the leader's response headers before fetching alone, seconds
+COALESCE_BUFFER_BYTES = _env_int('COALESCE_BUFFER_BYTES', 4 * 1024 * 1024)  # Body bytes a shared fetch keeps for its followers
+
+# HTML rewriting
+HTML_REWRITE_MODE = _env('HTML_REWRITE_MODE', 'tree')  # 'tree' (BeautifulSoup) or 'stream' (incremental tokenizer)
+HTML_STREAM_CHUNK_SIZE = _env_int('HTML_STREAM_CHUNK_SIZE', 16384)
+REWRITE_RESOURCES = _env_bool('REWRITE_RESOURCES', False)  # Route img/script/stylesheet/video/iframe through the proxy
+CHARSET_SCAN_BYTES = _env_int('CHARSET_SCAN_BYTES', 4096)  # Start of a page searched for <meta charset>
+CHARSET_DETECT_BYTES = _env_int('CHARSET_DETECT_BYTES', 65536)  # Start of a page given to statistical detection when nothing declares an encoding
+
+# Lite rendering (lite=1 on /proxy, or the hosts below)
+LITE_MODE = _env_bool('LITE_MODE', False)  # Serve every page in lite mode unless the request says lite=0
+LITE_HOSTS = [host.strip() for host in _env('LITE_HOSTS', '').split(',') if host.strip()]  # Hosts (and subdomains) always served in lite mode
+LITE_BLOCKLIST = [host.strip() for host in _env('LITE_BLOCKLIST', (
+    'google-analytics.com,googletagmanager.com,googletagservices.com,doubleclick.net,googlesyndication.com,'
+    'googleadservices.com,connect.facebook.net,hotjar.com,clarity.ms,bat.bing.com,scorecardresearch.com,'
+    'quantserve.com,chartbeat.com,cdn.segment.com,api.segment.io,mixpanel.com,amplitude.com,'
+    'js-agent.newrelic.com,bam.nr-data.net,criteo.com,criteo.net,taboola.com,outbrain.com,adsrvr.org'
+)).split(',') if host.strip()]  # Tracking and analytics hosts whose scripts, pixels and frames lite pages drop
+LITE_DROP_PRELOAD_AS = [kind.strip() for kind in _env('LITE_DROP_PRELOAD_AS', 'font,audio,video,track,fetch,document').split(',') if kind.strip()]  # Preloads lite pages drop, by their "as" type
+
+# Oversized pages
+DOCUMENT_SOFT_LIMIT_BYTES = _env_int('DOCUMENT_SOFT_LIMIT_BYTES', 2 * 1024 * 1024)  # Larger pages use the incremental rewriter instead of a tree
+DOCUMENT_HARD_LIMIT_BYTES = _env_int('DOCUMENT_HARD_LIMIT_BYTES', 16 * 1024 * 1024)  # Past this many bytes the rest of a page is relayed unmodified
+PARSE_BUDGET_BYTES = _env_int('PARSE_BUDGET_BYTES', 8 * 1024 * 1024)  # Page bytes being parsed into trees at once, process-wide
+PARSE_BUDGET_WAIT = _env_float('PARSE_BUDGET_WAIT', 0.5)  # Wait for parse budget before rewriting without a tree, seconds
+
+# Response compression
+COMPRESSION_ENABLED = _env_bool('COMPRESSION_ENABLED', True)
+COMPRESSION_LEVEL = _env_int('COMPRESSION_LEVEL', 6)  # gzip level, 1 (fastest) to 9 (smallest)
+COMPRESSION_MIN_BYTES = _env_int('COMPRESSION_MIN_BYTES', 1024)  # Smaller bodies are sent uncompressed
+
+# /proxy-resource cache
+RESOURCE_CACHE_ENABLED = _env_bool('RESOURCE_CACHE_ENABLED', True)
+RESOURCE_CACHE_MAX_BYTES = _env_int('RESOURCE_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+RESOURCE_CACHE_MAX_ENTRIES = _env_int('RESOURCE_CACHE_MAX_ENTRIES', 4096)
+RESOURCE_CACHE_MAX_ENTRY_BYTES = _env_int('RESOURCE_CACHE_MAX_ENTRY_BYTES', 4 * 1024 * 1024)
+RESOURCE_CACHE_HEURISTIC_MAX = _env_int('RESOURCE_CACHE_HEURISTIC_MAX', 3600)  # Cap on Last-Modified based freshness, seconds
+
+# /proxy-resource relaying
+RESOURCE_STREAM_CHUNK_SIZE = _env_int('RESOURCE_STREAM_CHUNK_SIZE', 64 * 1024)
+RESOURCE_STREAM_BUFFER_BYTES = _env_int('RESOURCE_STREAM_BUFFER_BYTES', 4 * 1024 * 1024)  # Most bytes of a relayed body held in memory for caching
+
+# Stylesheets served by /proxy-resource
+REWRITE_STYLESHEETS = _env_bool('REWRITE_STYLESHEETS', True)  # Route url() and @import references through the proxy
+STYLESHEET_CACHE_MAX_BYTES = _env_int('STYLESHEET_CACHE_MAX_BYTES', 16 * 1024 * 1024)
+STYLESHEET_CACHE_MAX_ENTRIES = _env_int('STYLESHEET_CACHE_MAX_ENTRIES', 1024)
+
+# Subresource prefetch (needs REWRITE_RESOURCES, tree mode and the resource cache)
+PREFETCH_ENABLED = _env_bool('PREFETCH_ENABLED', False)
+PREFETCH_WORKERS = _env_int('PREFETCH_WORKERS', 8)  # Prefetches running at once across all pages
+PREFETCH_MAX_PER_PAGE = _env_int('PREFETCH_MAX_PER_PAGE', 32)
+PREFETCH_PAGE_CONCURRENCY = _env_int('PREFETCH_PAGE_CONCURRENCY', 4)  # Prefetches running at once for one page
+PREFETCH_MAX_QUEUED = _env_int('PREFETCH_MAX_QUEUED', 256)
+PREFETCH_TIMEOUT = _env_int('PREFETCH_TIMEOUT', 15)  # Seconds after which a page's remaining prefetches are dropped
+
+# Inlining of tiny images and stylesheets into rewritten pages (needs REWRITE_RESOURCES and tree mode)
+INLINE_ENABLED = _env_bool('INLINE_ENABLED', False)
+INLINE_MAX_BYTES = _env_int('INLINE_MAX_BYTES', 2048)  # Largest image or stylesheet embedded in a page
+INLINE_PAGE_BUDGET_BYTES = _env_int('INLINE_PAGE_BUDGET_BYTES', 32 * 1024)  # Most bytes inlining adds to one page
+INLINE_DEADLINE = _env_float('INLINE_DEADLINE', 0.2)  # Longest a page waits for the resources it inlines, seconds
+INLINE_MAX_PER_PAGE = _env_int('INLINE_MAX_PER_PAGE', 32)  # Resources fetched for inlining per page
+INLINE_WORKERS = _env_int('INLINE_WORKERS', 8)  # Inlining fetches running at once across all pages
+
+# On-disk block cache for ranged video
+VIDEO_CACHE_ENABLED = _env_bool('VIDEO_CACHE_ENABLED', True)
+VIDEO_CACHE_DIR = _env('VIDEO_CACHE_DIR', '')  # Parent of the per-process block directories; empty uses the system temp dir
+VIDEO_CACHE_BLOCK_SIZE = _env_int('VIDEO_CACHE_BLOCK_SIZE', 1024 * 1024)
+VIDEO_CACHE_MAX_BYTES = _env_int('VIDEO_CACHE_MAX_BYTES', 512 * 1024 * 1024)
+VIDEO_CACHE_MAX_VIDEOS = _env_int('VIDEO_CACHE_MAX_VIDEOS', 256)
+VIDEO_CACHE_TTL = _env_int('VIDEO_CACHE_TTL', 3600)  # Seconds cached blocks are trusted before the origin is asked again
+
+# Rewritten HTML cache
+DOCUMENT_CACHE_ENABLED = _env_bool('DOCUMENT_CACHE_ENABLED', True)
+DOCUMENT_CACHE_MAX_BYTES = _env_int('DOCUMENT_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+DOCUMENT_CACHE_MAX_ENTRIES = _env_int('DOCUMENT_CACHE_MAX_ENTRIES', 512)
+DOCUMENT_CACHE_TTL = _env_int('DOCUMENT_CACHE_TTL', 30)  # Seconds a rewritten page is served without asking the origin
+DOCUMENT_CACHE_STALE_TTL = _env_int('DOCUMENT_CACHE_STALE_TTL', 300)  # Further seconds it may be served while refreshing
+
+# asyncio serving mode (app/async_app.py)
+ASYNC_MAX_CONNECTIONS = _env_int('ASYNC_MAX_CONNECTIONS', 1000)  # Upstream sockets open at once across all hosts
+ASYNC_REWRITE_WORKERS = _env_int('ASYNC_REWRITE_WORKERS', 4)  # Threads running BeautifulSoup rewrites
+ASYNC_CONNECT_TIMEOUT = _env_float('ASYNC_CONNECT_TIMEOUT', 15)
+ASYNC_READ_TIMEOUT = _env_float('ASYNC_READ_TIMEOUT', 30)  # Per socket read, so long streams are not cut off
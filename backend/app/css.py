@@ -0,0 +1,92 @@
+"""
+Single-pass CSS reference rewriter.
+
+One scan over the stylesheet finds every ``url(...)`` and ``@import``
+reference, stepping over comments and string literals so that text which
+merely looks like a URL is left alone. Output is assembled from slices of
+the input, so rewriting costs O(n) however many references there are.
+"""
+import codecs
+import re
+
+_TOKEN_RE = re.compile(r'''
+    /\*.*?(?:\*/|\Z)                                    # comment
+  | \burl\(\s*(?:
+        "((?:[^"\\\n]|\\.)*)"                           # url("...")
+      | '((?:[^'\\\n]|\\.)*)'                           # url('...')
+      | ((?:[^)\s"'\\]|\\.)*)                           # url(...)
+    )\s*\)
+  | @import\s+(?:
+        "((?:[^"\\\n]|\\.)*)"                           # @import "..."
+      | '((?:[^'\\\n]|\\.)*)'                           # @import '...'
+    )
+  | "(?:[^"\\\n]|\\.)*"?                                # other strings
+  | '(?:[^'\\\n]|\\.)*'?
+''', re.DOTALL | re.IGNORECASE | re.VERBOSE)
+
+# Capture groups holding a reference
+_REFERENCE_GROUPS = (1, 2, 3, 4, 5)
+
+_CHARSET_RE = re.compile(rb'@charset\s+"([A-Za-z0-9_.:-]+)"\s*;')
+_CONTENT_TYPE_CHARSET_RE = re.compile(r'charset\s*=\s*["\']?([A-Za-z0-9_.:-]+)', re.IGNORECASE)
+
+
+def rewrite_css(text, rewrite_url):
+    """
+    Return ``text`` with each ``url()`` and ``@import`` reference replaced by
+    ``rewrite_url(reference)``. The callback returns the new URL, or the
+    reference itself (or None) to leave it unchanged. Quoting is preserved.
+    """
+    pieces = []
+    last = 0
+    for match in _TOKEN_RE.finditer(text):
+        for group in _REFERENCE_GROUPS:
+            reference = match.group(group)
+            if reference is None:
+                continue
+            stripped = reference.strip()
+            if not stripped:
+                break
+            replacement = rewrite_url(stripped)
+            if replacement is not None and replacement != stripped:
+                start, end = match.span(group)
+                pieces.append(text[last:start])
+                pieces.append(replacement)
+                last = end
+            break
+    if not pieces:
+        return text
+    pieces.append(text[last:])
+    return ''.join(pieces)
+
+
+def upgrade_insecure(reference):
+    """Reference rewrite that only upgrades ``http://`` URLs to HTTPS"""
+    if reference[:7].lower() == 'http://':
+        return f"https://{reference[7:]}"
+    return reference
+
+
+def stylesheet_encoding(body, content_type=None):
+    """
+    Pick the encoding of a stylesheet the way browsers do: BOM, then the
+    Content-Type charset, then an ``@charset`` rule, then UTF-8
+    """
+    if body.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if body.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    match = _CONTENT_TYPE_CHARSET_RE.search(content_type or '')
+    charset = match.group(1) if match else None
+    for candidate in (charset, _charset_rule(body)):
+        if candidate:
+            try:
+                return codecs.lookup(candidate).name
+            except LookupError:
+                pass
+    return 'utf-8'
+
+
+def _charset_rule(body):
+    match = _CHARSET_RE.match(body)
+    return match.group(1).decode('ascii') if match else None
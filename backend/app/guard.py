@@ -0,0 +1,306 @@
+"""
+Guard rails for upstream fetches: deadlines, per-host concurrency caps and
+circuit breakers.
+
+Every upstream request takes a ``Lease`` on its origin host before it
+connects. A host serves at most ``config.UPSTREAM_HOST_MAX_CONCURRENT``
+requests at once; further requests queue for up to
+``config.UPSTREAM_HOST_QUEUE_TIMEOUT`` seconds and are then refused, so one
+hung origin cannot take every worker with it.
+
+Connection errors, timeouts and 5xx answers count as failures. After
+``config.BREAKER_FAILURE_THRESHOLD`` of them in a row the host's breaker
+opens, and for ``config.BREAKER_OPEN_SECONDS`` its requests fail at once
+with ``UpstreamUnavailable``. Then a single probe request is let through
+(half-open): success closes the breaker, failure opens it again.
+
+``Deadline`` splits a fetch's time budget between connecting and reading.
+"""
+import asyncio
+import collections
+import logging
+import math
+import threading
+import time
+from urllib.parse import urlsplit
+
+import config
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class UpstreamUnavailable(Exception):
+    """The origin was not contacted: its breaker is open or its queue is full"""
+
+    def __init__(self, host, reason, retry_after):
+        super().__init__(f"{host} is unavailable ({reason})")
+        self.host = host
+        self.reason = reason
+        self.retry_after = retry_after
+        # Read by metrics.error_class
+        self.error_class = f"upstream_{reason}"
+
+
+class UpstreamTimeout(TimeoutError):
+    """A fetch ran past its deadline"""
+
+
+class Deadline:
+    """Time budget of one fetch, from the moment it is created"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+    def check(self):
+        if self.remaining() <= 0:
+            raise UpstreamTimeout(f"Upstream deadline of {self.seconds:g}s exceeded")
+
+    def timeout(self):
+        """``(connect, read)`` timeouts for a request made now"""
+        self.check()
+        return request_timeout(self.remaining())
+
+
+def request_timeout(budget):
+    """``(connect, read)`` timeouts for a budget: connecting gets at most its own share"""
+    return min(config.UPSTREAM_CONNECT_TIMEOUT, budget), budget
+
+
+def host_of(url):
+    return urlsplit(url).netloc.lower() if '://' in url else url.lower()
+
+
+class _Host:
+    __slots__ = ('name', 'active', 'waiting', 'async_waiters', 'state', 'failures', 'opened_at', 'probing',
+                 'trips', 'rejected')
+
+    def __init__(self, name):
+        self.name = name
+        self.active = 0
+        self.waiting = 0
+        self.async_waiters = collections.deque()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.trips = 0
+        self.rejected = 0
+
+    def idle(self):
+        return not self.active and not self.waiting and self.state == CLOSED and not self.failures
+
+
+class Lease:
+    """One request's slot on a host; ``release`` it when the response is done"""
+
+    __slots__ = ('guard', 'host', 'probe', 'recorded', 'released')
+
+    def __init__(self, guard, host, probe):
+        self.guard = guard
+        self.host = host
+        self.probe = probe
+        self.recorded = False
+        self.released = False
+
+    def success(self):
+        self.guard._record(self, True)
+
+    def failure(self):
+        self.guard._record(self, False)
+
+    def record_status(self, status):
+        self.guard._record(self, status < 500)
+
+    def release(self):
+        self.guard._release(self)
+
+
+class UpstreamGuard:
+    def __init__(self, max_concurrent, queue_timeout, failure_threshold, open_seconds, max_hosts=1024):
+        self.max_concurrent = max_concurrent
+        self.queue_timeout = queue_timeout
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_hosts = max_hosts
+        self._hosts = {}
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+        self.rejected_open = 0
+        self.rejected_busy = 0
+        self.trips = 0
+
+    def _host(self, name):
+        host = self._hosts.get(name)
+        if host is None:
+            if len(self._hosts) >= self.max_hosts:
+                for idle in [key for key, value in self._hosts.items() if value.idle()]:
+                    del self._hosts[idle]
+            host = self._hosts[name] = _Host(name)
+        return host
+
+    def _admit(self, host):
+        """Check the breaker (lock held); returns True if this request is the half-open probe"""
+        if host.state == OPEN:
+            waited = time.monotonic() - host.opened_at
+            if waited < self.open_seconds:
+                self._reject_open(host, self.open_seconds - waited)
+            host.state = HALF_OPEN
+            host.probing = False
+        if host.state == HALF_OPEN:
+            if host.probing:
+                self._reject_open(host, 1)
+            host.probing = True
+            return True
+        return False
+
+    def _reject_open(self, host, retry_after):
+        host.rejected += 1
+        self.rejected_open += 1
+        raise UpstreamUnavailable(host.name, 'circuit_open', math.ceil(retry_after))
+
+    def _reject_busy(self, host, probe):
+        if probe:
+            host.probing = False
+        host.rejected += 1
+        self.rejected_busy += 1
+        raise UpstreamUnavailable(host.name, 'busy', math.ceil(self.queue_timeout) or 1)
+
+    def acquire(self, url):
+        """Take a slot on ``url``'s host, waiting for one if the host is at its cap"""
+        with self._lock:
+            host = self._host(host_of(url))
+            probe = self._admit(host)
+            if host.active >= self.max_concurrent:
+                deadline = time.monotonic() + self.queue_timeout
+                host.waiting += 1
+                try:
+                    while host.active >= self.max_concurrent:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._reject_busy(host, probe)
+                        self._slot_freed.wait(remaining)
+                finally:
+                    host.waiting -= 1
+            host.active += 1
+            return Lease(self, host, probe)
+
+    async def acquire_async(self, url):
+        """``acquire`` for the asyncio app: waits without blocking the event loop"""
+        with self._lock:
+            host = self._host(host_of(url))
+            probe = self._admit(host)
+            if host.active < self.max_concurrent:
+                host.active += 1
+                return Lease(self, host, probe)
+            waiter = asyncio.get_running_loop().create_future()
+            host.async_waiters.append(waiter)
+            host.waiting += 1
+        try:
+            # A freed slot is handed straight to the waiter (see _release)
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                if waiter in host.async_waiters:
+                    host.async_waiters.remove(waiter)
+                    host.waiting -= 1
+                self._reject_busy(host, probe)
+        return Lease(self, host, probe)
+
+    def _record(self, lease, ok):
+        if lease.recorded:
+            return
+        lease.recorded = True
+        host = lease.host
+        tripped = False
+        with self._lock:
+            if ok:
+                host.failures = 0
+                if lease.probe:
+                    host.state = CLOSED
+                    host.probing = False
+            else:
+                host.failures += 1
+                if lease.probe or (host.state == CLOSED and host.failures >= self.failure_threshold):
+                    host.state = OPEN
+                    host.opened_at = time.monotonic()
+                    host.probing = False
+                    host.trips += 1
+                    self.trips += 1
+                    tripped = True
+        if tripped:
+            logger.warning(f"Circuit opened for {host.name} after {host.failures} failures; "
+                           f"failing fast for {self.open_seconds:g}s")
+
+    def _release(self, lease):
+        with self._lock:
+            if lease.released:
+                return
+            lease.released = True
+            host = lease.host
+            if lease.probe and not lease.recorded and host.state == HALF_OPEN:
+                # The probe ended without an answer either way; let another through
+                host.probing = False
+            while host.async_waiters:
+                waiter = host.async_waiters.popleft()
+                host.waiting -= 1
+                if not waiter.done():
+                    waiter.get_loop().call_soon_threadsafe(self._hand_over, waiter, host)
+                    return
+            host.active -= 1
+            if host.waiting:
+                self._slot_freed.notify_all()
+
+    def _hand_over(self, waiter, host):
+        """Give a released slot to an async waiter, or free it if the waiter gave up"""
+        if waiter.done():
+            self._release(Lease(self, host, False))
+        else:
+            waiter.set_result(None)
+
+    def state(self, url):
+        with self._lock:
+            host = self._hosts.get(host_of(url))
+            return host.state if host is not None else CLOSED
+
+    def stats(self):
+        with self._lock:
+            hosts = {
+                name: {
+                    'state': host.state,
+                    'active': host.active,
+                    'queued': host.waiting,
+                    'failures': host.failures,
+                    'trips': host.trips,
+                    'rejected': host.rejected,
+                }
+                for name, host in self._hosts.items() if not host.idle()
+            }
+            return {
+                'max_per_host': self.max_concurrent,
+                'queue_timeout': self.queue_timeout,
+                'failure_threshold': self.failure_threshold,
+                'open_seconds': self.open_seconds,
+                'tracked_hosts': len(self._hosts),
+                'open_circuits': sum(1 for host in self._hosts.values() if host.state != CLOSED),
+                'queued': sum(host.waiting for host in self._hosts.values()),
+                'trips': self.trips,
+                'rejected_open': self.rejected_open,
+                'rejected_busy': self.rejected_busy,
+                'hosts': hosts,
+            }
+
+
+guard = UpstreamGuard(
+    max_concurrent=config.UPSTREAM_HOST_MAX_CONCURRENT,
+    queue_timeout=config.UPSTREAM_HOST_QUEUE_TIMEOUT,
+    failure_threshold=config.BREAKER_FAILURE_THRESHOLD,
+    open_seconds=config.BREAKER_OPEN_SECONDS,
+)
@@ -0,0 +1,42 @@
+"""
+gunicorn settings for production serving, read from ``config`` (the
+``BERRY_SERVER_*`` variables). Used by ``serve.py``, or directly::
+
+    gunicorn -c gunicorn.conf.py main:app
+
+Flask runs on ``gthread`` workers: a long video stream holds one thread,
+not the whole worker, and the worker keeps heartbeating while it streams.
+The async app runs on aiohttp's own worker class. Send ``HUP`` to reload
+workers gracefully, ``TERM`` to stop after in-flight requests finish
+(``graceful_timeout``).
+"""
+# "config" is itself a gunicorn setting
+import config as berry_config
+
+bind = f"{berry_config.HOST}:{berry_config.PORT}"
+backlog = berry_config.SERVER_BACKLOG
+workers = berry_config.SERVER_WORKERS
+threads = berry_config.SERVER_THREADS
+worker_class = 'aiohttp.GunicornWebWorker' if berry_config.SERVER_APP == 'async' else berry_config.SERVER_WORKER_CLASS
+preload_app = berry_config.SERVER_PRELOAD
+keepalive = berry_config.SERVER_KEEPALIVE
+timeout = berry_config.SERVER_TIMEOUT
+graceful_timeout = berry_config.SERVER_GRACEFUL_TIMEOUT
+max_requests = berry_config.SERVER_MAX_REQUESTS
+max_requests_jitter = berry_config.SERVER_MAX_REQUESTS_JITTER
+
+# Proxied URLs, nested and re-encoded, can outgrow gunicorn's 8190 byte
+# request line limit; 0 lifts it as the development server does
+limit_request_line = 0
+
+# Access records are written by the app itself (see accesslog)
+accesslog = None
+errorlog = '-'
+loglevel = str(berry_config.LOG_LEVEL).lower()
+
+
+def post_worker_init(worker):
+    # The async app warms itself up on startup (async_app.warm_up)
+    if berry_config.WARM_UP and berry_config.SERVER_APP != 'async':
+        import main
+        main.warm_up()
@@ -0,0 +1,269 @@
+"""
+Incremental HTML rewriter.
+
+Rewrites a page while it is still downloading: upstream chunks are fed to a
+tokenizer and every complete piece of markup is rewritten and flushed to the
+client straight away, so the browser can start fetching stylesheets before
+the body has finished arriving.
+"""
+import codecs
+import logging
+from html import escape
+from html.parser import HTMLParser
+
+from css import rewrite_css, upgrade_insecure
+from urls import ensure_https, form_target, link_target, proxy_url
+
+logger = logging.getLogger(__name__)
+
+CSP_META_TAG = '<meta content="upgrade-insecure-requests" http-equiv="Content-Security-Policy"/>'
+
+GOOGLE_SEARCH_SCRIPT = """
+                document.addEventListener('DOMContentLoaded', function() {
+                    const form = document.querySelector('form[action="/search"]');
+                    if (form) {
+                        form.addEventListener('submit', function(e) {
+                            const query = form.querySelector('input[name="q"]').value;
+                            if (!query || query.trim() === '') {
+                                e.preventDefault();
+                                console.log('Empty search prevented');
+                                return false;
+                            }
+                            console.log('Search form submitted with query: ' + query);
+                        });
+                    }
+                });
+                """
+
+# Tags that may legitimately come before the CSP meta tag is injected
+_PRE_HEAD_TAGS = ('html', 'head')
+
+
+def _render_tag(tag, attrs, self_closing=False):
+    parts = [tag]
+    for name, value in attrs:
+        if value is None:
+            parts.append(name)
+        else:
+            parts.append(f'{name}="{escape(value, quote=True)}"')
+    return f"<{' '.join(parts)}{' /' if self_closing else ''}>"
+
+
+class StreamingRewriter(HTMLParser):
+    """
+    Tokenizer-driven rewriter applying the same rules as the tree-based
+    handler to ``a[href]``, ``form[action]``, ``iframe[src]``, ``<style>``
+    and inline ``style`` attributes, and injecting the CSP meta tag.
+    """
+
+    def __init__(self, base_url):
+        super().__init__(convert_charrefs=False)
+        self.base_url = base_url
+        self._out = []
+        self._csp_injected = False
+        self._style_buffer = None
+        self._google_form = False
+        self._google_form_has_query = False
+        self._google_script_added = False
+
+    def feed_text(self, text):
+        """Feed a decoded chunk and return whatever output is ready"""
+        self.feed(text)
+        return self._drain()
+
+    def finish(self):
+        """Flush the tokenizer and return the remaining output"""
+        self.close()
+        if self._style_buffer is not None:
+            self._out.append(''.join(self._style_buffer))
+            self._style_buffer = None
+        if not self._csp_injected:
+            self._inject_csp()
+        return self._drain()
+
+    def detach(self):
+        """
+        Stop rewriting: return the output so far followed by the input not
+        tokenized yet, after which the rest of the document can be passed
+        through unchanged
+        """
+        pending = self.rawdata
+        self.rawdata = ''
+        if self._style_buffer is not None:
+            self._out.append(''.join(self._style_buffer))
+            self._style_buffer = None
+        if not self._csp_injected:
+            self._inject_csp()
+        return self._drain() + pending
+
+    def _drain(self):
+        if not self._out:
+            return ''
+        text = ''.join(self._out)
+        self._out = []
+        return text
+
+    def _inject_csp(self):
+        self._out.append(CSP_META_TAG)
+        self._csp_injected = True
+
+    # Tokenizer callbacks
+
+    def handle_starttag(self, tag, attrs):
+        self._emit_starttag(tag, attrs, self_closing=False)
+
+    def handle_startendtag(self, tag, attrs):
+        self._emit_starttag(tag, attrs, self_closing=True)
+
+    def _emit_starttag(self, tag, attrs, self_closing):
+        if not self._csp_injected and tag not in _PRE_HEAD_TAGS:
+            self._inject_csp()
+
+        new_attrs, extra = self._rewrite_attrs(tag, attrs)
+        if new_attrs is None:
+            self._out.append(self.get_starttag_text())
+        else:
+            self._out.append(_render_tag(tag, new_attrs, self_closing))
+        if extra:
+            self._out.append(extra)
+
+        if tag == 'head' and not self._csp_injected:
+            self._inject_csp()
+        if tag == 'style' and not self_closing:
+            self._style_buffer = []
+
+    def handle_endtag(self, tag):
+        if tag == 'style' and self._style_buffer is not None:
+            css = ''.join(self._style_buffer)
+            self._out.append(rewrite_css(css, upgrade_insecure))
+            self._style_buffer = None
+        if tag == 'form' and self._google_form:
+            if not self._google_form_has_query:
+                self._out.append('<input name="q" type="text"/>')
+            self._out.append('</form>')
+            self._google_form = False
+            if not self._google_script_added:
+                self._out.append(f'<script>{GOOGLE_SEARCH_SCRIPT}</script>')
+                self._google_script_added = True
+            return
+        self._out.append(f'</{tag}>')
+
+    def handle_data(self, data):
+        if self._style_buffer is not None:
+            self._style_buffer.append(data)
+        else:
+            self._out.append(data)
+
+    def handle_entityref(self, name):
+        self._out.append(f'&{name};')
+
+    def handle_charref(self, name):
+        self._out.append(f'&#{name};')
+
+    def handle_comment(self, data):
+        self._out.append(f'<!--{data}-->')
+
+    def handle_decl(self, decl):
+        self._out.append(f'<!{decl}>')
+
+    def handle_pi(self, data):
+        self._out.append(f'<?{data}>')
+
+    def unknown_decl(self, data):
+        self._out.append(f'<![{data}]>')
+
+    # Rewrite rules
+
+    def _rewrite_attrs(self, tag, attrs):
+        """
+        Return ``(attrs, extra_markup)``; ``attrs`` is None when the tag can
+        be passed through untouched.
+        """
+        values = dict(attrs)
+        changed = {}
+        extra = ''
+
+        if tag == 'a' and values.get('href'):
+            target = link_target(values['href'])
+            if target is not None:
+                changed['href'] = proxy_url(target)
+                changed['target'] = '_self'
+
+        elif tag == 'form' and values.get('action'):
+            action = form_target(self.base_url, values['action'])
+            if 'google.com/search' in action or '/webhp' in action:
+                changed['action'] = '/search'
+                changed['method'] = 'POST'
+                self._google_form = True
+                self._google_form_has_query = False
+                extra = f'<input name="url" type="hidden" value="{escape(ensure_https(self.base_url), quote=True)}"/>'
+            else:
+                changed['action'] = proxy_url(action)
+
+        elif tag == 'input' and self._google_form and values.get('name') == 'q':
+            self._google_form_has_query = True
+
+        elif tag == 'iframe' and (values.get('src') or '').startswith('http://'):
+            changed['src'] = ensure_https(values['src'])
+
+        style = values.get('style')
+        if style and 'url(' in style:
+            rewritten = rewrite_css(style, upgrade_insecure)
+            if rewritten is not style:
+                changed['style'] = rewritten
+
+        if not changed:
+            return None, extra
+
+        new_attrs = [(name, changed.pop(name, value)) for name, value in attrs]
+        new_attrs.extend(changed.items())
+        return new_attrs, extra
+
+
+def rewrite_text(text, base_url):
+    """Rewrite a whole page with the incremental rewriter, without building a tree"""
+    rewriter = StreamingRewriter(base_url)
+    return rewriter.feed_text(text) + rewriter.finish()
+
+
+def stream_rewrite(response, base_url, chunk_size=16384, chunks=None, limit=None, encoding=None):
+    """
+    Generator yielding rewritten HTML for an upstream ``requests`` response
+    opened with ``stream=True``, or for ``chunks`` of its body when reading
+    has already begun. The output is encoded like the input, in ``encoding``
+    (by default the response's). After ``limit`` bytes the rest of the page
+    is passed through unmodified.
+    """
+    try:
+        decoder = codecs.getincrementaldecoder(encoding or response.encoding or 'utf-8')(errors='replace')
+        encoder = codecs.getincrementalencoder(encoding or response.encoding or 'utf-8')(errors='xmlcharrefreplace')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        encoder = codecs.getincrementalencoder('utf-8')(errors='xmlcharrefreplace')
+    rewriter = StreamingRewriter(base_url)
+    seen = 0
+    try:
+        if chunks is None:
+            chunks = response.iter_content(chunk_size=chunk_size)
+        for chunk in chunks:
+            seen += len(chunk)
+            if rewriter is None:
+                output = decoder.decode(chunk)
+            else:
+                output = rewriter.feed_text(decoder.decode(chunk))
+                if limit is not None and seen > limit:
+                    logger.info(f"Page {base_url} passed {limit} bytes; relaying the rest unmodified")
+                    output += rewriter.detach()
+                    rewriter = None
+            if output:
+                yield encoder.encode(output)
+        output = decoder.decode(b'', final=True)
+        if rewriter is not None:
+            output = rewriter.feed_text(output) + rewriter.finish()
+        output = encoder.encode(output, final=True)
+        if output:
+            yield output
+    except Exception as e:
+        logger.error(f"Error while streaming rewritten HTML for {base_url}: {str(e)}")
+    finally:
+        response.close()
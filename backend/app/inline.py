@@ -0,0 +1,176 @@
+"""
+Inlining of tiny subresources into rewritten pages.
+
+Search pages and app shells reference dozens of small icons and stylesheets,
+and each one costs the browser a round trip through ``/proxy-resource``.
+With ``config.INLINE_ENABLED`` (and ``config.REWRITE_RESOURCES``) the tree
+rewrite offers a page's images and stylesheets to ``Inliner``, which fetches
+them on a small pool of worker threads, from the resource cache or the
+origin:
+
+* an image of at most ``config.INLINE_MAX_BYTES`` becomes a ``data:`` URI;
+* a stylesheet that small becomes a ``<style>`` element, with its references
+  rewritten the way ``/proxy-resource`` serves them.
+
+A page waits at most ``config.INLINE_DEADLINE`` seconds for its fetches and
+grows by at most ``config.INLINE_PAGE_BUDGET_BYTES``. Whatever is late or
+does not fit keeps its ``/proxy-resource`` URL. Fetches share the page's
+deadline too, so a slow origin cannot hold on to the pool, and what they do
+fetch in time is kept in the resource cache.
+"""
+import base64
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from guard import Deadline
+
+logger = logging.getLogger(__name__)
+
+# What an offered element is inlined as
+IMAGE = 'image'
+STYLESHEET = 'stylesheet'
+
+
+def data_uri(content_type, body):
+    return f"data:{content_type};base64,{base64.b64encode(body).decode('ascii')}"
+
+
+def _kind(node):
+    return STYLESHEET if node.name == 'link' else IMAGE
+
+
+class Inliner:
+    """
+    Bounded inlining stage. ``fetch(url, kind, deadline)`` is called on a
+    worker thread and returns ``(content_type, body)`` for a resource small
+    enough to inline (stylesheets already rewritten), or None.
+    """
+
+    def __init__(self, fetch, workers, max_per_page, page_budget, deadline):
+        self.fetch = fetch
+        self.workers = workers
+        self.max_per_page = max_per_page
+        self.page_budget = page_budget
+        self.deadline = deadline
+        self._pool = None
+        self._lock = threading.Lock()
+        self._counts = {
+            'pages': 0,
+            'fetches': 0,
+            'inlined': 0,
+            'inlined_bytes': 0,
+            'late': 0,
+            'over_budget': 0,
+            'skipped': 0,
+            'failed': 0,
+        }
+
+    def _executor(self):
+        # Started on first use, so a forked worker gets threads of its own
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='inline')
+            return self._pool
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counts[name] += amount
+
+    def _fetch(self, url, kind, deadline):
+        try:
+            return self.fetch(url, kind, deadline)
+        except Exception as e:
+            logger.info(f"Inlining {url} failed: {str(e)}")
+            self._count('failed')
+            return None
+
+    def inline(self, soup, candidates):
+        """
+        Embed the ``candidates`` (``(priority, node, url)``, ``node`` an
+        ``img`` or a stylesheet ``link`` and ``url`` absolute) that arrive in
+        time and fit the page budget, lower priorities first. Returns
+        ``(urls, summary)``: the URLs the page no longer loads, and counts
+        for the access record.
+        """
+        ordered = sorted(candidates, key=lambda candidate: candidate[0])
+        deadline = Deadline(self.deadline)
+        pool = self._executor()
+        futures = {}
+        for _, node, url in ordered:
+            if url not in futures and len(futures) < self.max_per_page:
+                futures[url] = pool.submit(self._fetch, url, _kind(node), deadline)
+        _, pending = wait(futures.values(), timeout=max(deadline.remaining(), 0))
+        for future in pending:
+            future.cancel()
+
+        budget = self.page_budget
+        inlined = set()
+        kept = set()
+        summary = {'inlined': 0, 'bytes': 0, 'late': 0, 'over_budget': 0, 'skipped': 0}
+        for _, node, url in ordered:
+            future = futures.get(url)
+            if node.parent is None:
+                # Taken out of the page by another rule
+                continue
+            if future is None or future in pending:
+                if future is not None:
+                    summary['late'] += 1
+                kept.add(url)
+                continue
+            markup = self._markup(future.result())
+            if markup is None:
+                # Missing, too large or not an image or stylesheet
+                summary['skipped'] += 1
+                kept.add(url)
+                continue
+            if len(markup) > budget:
+                summary['over_budget'] += 1
+                kept.add(url)
+                continue
+            budget -= len(markup)
+            self._embed(soup, node, markup)
+            inlined.add(url)
+            summary['inlined'] += 1
+            summary['bytes'] += len(markup)
+
+        with self._lock:
+            self._counts['pages'] += 1
+            self._counts['fetches'] += len(futures)
+            self._counts['inlined'] += summary['inlined']
+            self._counts['inlined_bytes'] += summary['bytes']
+            self._counts['late'] += summary['late']
+            self._counts['over_budget'] += summary['over_budget']
+            self._counts['skipped'] += summary['skipped']
+        return inlined - kept, summary
+
+    def _markup(self, resource):
+        """What an element's URL is replaced by: a data URI or the stylesheet's text"""
+        if resource is None:
+            return None
+        content_type, body = resource
+        if content_type == 'text/css':
+            text = body.decode('utf-8', errors='replace')
+            if '</style' in text.lower():
+                # Would end the <style> element early
+                return None
+            return text
+        return data_uri(content_type, body)
+
+    def _embed(self, soup, node, markup):
+        if node.name != 'link':
+            node['src'] = markup
+            return
+        style = soup.new_tag('style')
+        if node.get('media'):
+            style['media'] = node['media']
+        style.string = markup
+        node.replace_with(style)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+        stats['workers'] = self.workers
+        stats['page_budget_bytes'] = self.page_budget
+        stats['deadline'] = self.deadline
+        return stats
@@ -0,0 +1,69 @@
+"""
+Lite rendering for the small BerryOS browser window.
+
+A page is served in lite mode when the request asks for it (``lite=1`` on
+``/proxy``), when its host is listed in ``config.LITE_HOSTS``, or for every
+page with ``config.LITE_MODE`` (``lite=0`` opts a request out). Lite pages
+go through the ``lite`` rules of ``rewrite``, which:
+
+* remove scripts, images and frames served from the hosts in
+  ``config.LITE_BLOCKLIST``, the short inline loaders that pull them in,
+  and 1x1 tracking pixels;
+* mark images and iframes ``loading="lazy"`` (images also
+  ``decoding="async"``);
+* remove ``prefetch`` and ``prerender`` hints, preloads of the resource
+  types in ``config.LITE_DROP_PRELOAD_AS``, and any hint for a blocked host.
+
+Lite mode applies to tree rewrites; pages rewritten incrementally (stream
+mode, oversized pages) are served in full.
+"""
+import functools
+import re
+from urllib.parse import urlsplit
+
+import config
+
+# Tracker loader snippets are short; a longer inline script that merely
+# mentions a blocked host is more likely application code
+SNIPPET_MAX_CHARS = 4096
+
+_BLOCKED_MENTION_RE = re.compile(
+    '|'.join(re.escape(host) for host in config.LITE_BLOCKLIST) or r'(?!)', re.IGNORECASE
+)
+
+_LITE_HOSTS = tuple(host.lower() for host in config.LITE_HOSTS)
+_BLOCKLIST = tuple(host.lower() for host in config.LITE_BLOCKLIST)
+
+# Hints for future navigations, never used by the page being shown
+NAVIGATION_HINTS = frozenset(('prefetch', 'prerender'))
+PRELOAD_HINTS = frozenset(('preload', 'modulepreload'))
+CONNECTION_HINTS = frozenset(('preconnect', 'dns-prefetch'))
+DROP_PRELOAD_AS = frozenset(kind.lower() for kind in config.LITE_DROP_PRELOAD_AS)
+
+
+@functools.lru_cache(maxsize=4096)
+def _listed(host, hosts):
+    """Whether ``host`` is one of ``hosts`` or a subdomain of one"""
+    host = host.lower()
+    return any(host == listed or host.endswith('.' + listed) for listed in hosts)
+
+
+def wants_lite(url, flag=None):
+    """Whether a page is served in lite mode; ``flag`` is the request's ``lite`` parameter"""
+    if flag is not None and flag != '':
+        return flag.strip().lower() in ('1', 'true', 'yes', 'on')
+    if config.LITE_MODE:
+        return True
+    return bool(config.LITE_HOSTS) and _listed(urlsplit(url).hostname or '', _LITE_HOSTS)
+
+
+def is_blocked(url):
+    """Whether ``url`` (absolute or protocol-relative) is served from a blocklisted host"""
+    if not config.LITE_BLOCKLIST:
+        return False
+    return _listed(urlsplit(url).hostname or '', _BLOCKLIST)
+
+
+def loads_blocked(script):
+    """Whether a short inline script mentions a blocklisted host"""
+    return len(script) <= SNIPPET_MAX_CHARS and _BLOCKED_MENTION_RE.search(script) is not None
@@ -1,17 +1,45 @@
-from flask import Flask, request, jsonify, Response, stream_with_context, redirect, url_for
-import requests
+from flask import Flask, request, jsonify, Response, stream_with_context, redirect
 from bs4 import BeautifulSoup
 from flask_cors import CORS
 import re
 import logging
 import urllib.parse
 import json
-from urllib.parse import urlparse, parse_qs, quote_plus, urlencode, urljoin
+from urllib.parse import urlparse, parse_qs, quote_plus, urlencode
 import traceback
+from html import escape
+import hashlib
+import itertools
+import os
+import threading
+import time
+
+from upstream import upstream
+from guard import Deadline, UpstreamUnavailable, guard, request_timeout
+from coalesce import flights
+from budget import RELAY, STREAM, TREE, document_plan, parse_budget
+from lite import wants_lite
+from urls import absolute_url, ensure_https, host_info, is_proxy_url, memo_stats, normalize_url, proxy_resource_url, proxy_url, unwrap_proxy_url, youtube_video_id
+from html_stream import rewrite_text, stream_rewrite
+from charset import decode_document, document_encoding, encode_document
+from rewrite import rewrite_document
+from css import rewrite_css, stylesheet_encoding, upgrade_insecure
+from cache import DocumentCache, LRUStore, ResourceCache, body_fingerprint, document_etag, is_not_modified, upstream_etag_for, validator_headers, weaken_etag
+from compression import UPSTREAM_ACCEPT_ENCODING, accepts, content_coding, decompress, gzip_bytes, gzip_stream, is_compressible
+from prefetch import CLIENT_COOKIE, PrefetchClient, Prefetcher
+from inline import STYLESHEET, Inliner
+from routing import Router
+from segments import SegmentCache, parse_content_range, parse_range
+import accesslog
+import metrics
+import profiling
+from profiling import profiler
+from accesslog import diag
+import config
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
-logging.basicConfig(level=logging.INFO)
+accesslog.configure()
 logger = logging.getLogger(__name__)
 
 # Headers to mimic a real browser
@@ -19,12 +47,72 @@ BROWSER_HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
     'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
     'Accept-Language': 'en-US,en;q=0.5',
+    'Accept-Encoding': UPSTREAM_ACCEPT_ENCODING,
     'DNT': '1',
     'Connection': 'keep-alive',
     'Upgrade-Insecure-Requests': '1',
 }
 
-# Video content types that should be streamed
+# Headers sent when fetching pages (with special handling for Google)
+PAGE_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Accept-Encoding': UPSTREAM_ACCEPT_ENCODING,
+    'Referer': 'https://www.google.com/',
+}
+
+# Shared cache for /proxy-resource responses; unencoded text keeps its gzip form
+resource_cache = ResourceCache(
+    max_bytes=config.RESOURCE_CACHE_MAX_BYTES,
+    max_entries=config.RESOURCE_CACHE_MAX_ENTRIES,
+    max_entry_bytes=config.RESOURCE_CACHE_MAX_ENTRY_BYTES,
+    heuristic_max=config.RESOURCE_CACHE_HEURISTIC_MAX,
+    compress=lambda headers, body: resource_compressed_form(headers, body),
+)
+
+# Cache of rewritten pages served by /proxy
+document_cache = DocumentCache(
+    max_bytes=config.DOCUMENT_CACHE_MAX_BYTES,
+    max_entries=config.DOCUMENT_CACHE_MAX_ENTRIES,
+    ttl=config.DOCUMENT_CACHE_TTL,
+    stale_ttl=config.DOCUMENT_CACHE_STALE_TTL,
+)
+
+# On-disk block cache for ranged video
+segment_cache = SegmentCache(
+    directory=config.VIDEO_CACHE_DIR,
+    block_size=config.VIDEO_CACHE_BLOCK_SIZE,
+    max_bytes=config.VIDEO_CACHE_MAX_BYTES,
+    max_videos=config.VIDEO_CACHE_MAX_VIDEOS,
+    ttl=config.VIDEO_CACHE_TTL,
+)
+
+# A forked worker keeps its own block files, in a directory made on first use
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=segment_cache.relocate)
+
+# Rewritten stylesheets served by /proxy-resource, keyed by URL with the
+# fingerprint of the upstream body they were produced from, and kept with
+# their gzip form so hits are never compressed again
+stylesheet_cache = LRUStore(
+    max_bytes=config.STYLESHEET_CACHE_MAX_BYTES,
+    max_entries=config.STYLESHEET_CACHE_MAX_ENTRIES,
+    size_of=lambda item: len(item[1]) + len(item[2] or b''),
+)
+
+# Identifies how rewritten documents are produced, so their ETags change with the rewrite settings
+REWRITE_SETTINGS = f"2:{config.HTML_REWRITE_MODE}:{config.REWRITE_RESOURCES}:{config.INLINE_ENABLED}"
+DOCUMENT_SIGNATURE = hashlib.blake2b(REWRITE_SETTINGS.encode('utf-8'), digest_size=4).hexdigest()
+LITE_DOCUMENT_SIGNATURE = hashlib.blake2b(f"{REWRITE_SETTINGS}:lite".encode('utf-8'), digest_size=4).hexdigest()
+
+# Browser validators forwarded on conditional requests
+CONDITIONAL_HEADERS = ['If-None-Match', 'If-Modified-Since']
+
+# Upstream headers describing the byte range of a relayed resource
+RANGE_HEADERS = ['Accept-Ranges', 'Content-Range']
+
+# Video content types that are streamed without being cached
 VIDEO_CONTENT_TYPES = [
     'video/mp4', 
     'video/webm', 
@@ -35,39 +123,84 @@ VIDEO_CONTENT_TYPES = [
     'application/dash+xml'
 ]
 
-# YouTube domains for special handling
-YOUTUBE_DOMAINS = [
-    'youtube.com',
-    'www.youtube.com',
-    'youtu.be',
-    'm.youtube.com',
-    'youtube-nocookie.com',
-    'www.youtube-nocookie.com'
-]
+@app.before_request
+def begin_access_record():
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    accesslog.begin(request.method, route)
+    if route != request.path:
+        accesslog.note('path', request.path)
 
-def ensure_https(url):
+@app.before_request
+def begin_profile():
+    profile = profiler.begin(request.method, request.path, request.headers, request.args)
+    if profile is not None:
+        accesslog.note('profile', profile.name)
+
+@app.after_request
+def finish_profile(response):
     """
-    Ensure a URL uses HTTPS instead of HTTP
+    Stop the request's profile once its response has been sent, so
+    streamed bodies are profiled too
     """
-    if url and url.startswith('http://'):
-        return 'https://' + url[7:]
-    return url
+    profile = profiling.current()
+    if profile is not None:
+        response.headers['X-Berry-Profile'] = profile.name
+        description = f"{request.method} {request.full_path.rstrip('?')} -> {response.status_code}"
+        response.call_on_close(lambda: profiler.finish(profile, description))
+    return response
+
+@app.after_request
+def finish_access_record(response):
+    """
+    Write the request's access record once the response has been sent.
+    Flask runs after_request hooks in reverse order of registration, and
+    this one is registered before compress_response, so it runs after it
+    and sees the final (compressed) body
+    """
+    record = accesslog.current()
+    if record is None:
+        return response
+    if response.is_streamed:
+        response.response = record.count(response.response)
+        response.call_on_close(lambda: accesslog.finish(record, response.status_code))
+    else:
+        response.call_on_close(lambda: accesslog.finish(record, response.status_code, response.content_length))
+    return response
+
+@app.after_request
+def compress_response(response):
+    """
+    Gzip buffered responses (JSON, HTML, error pages, text resources) for
+    browsers that accept it. Streamed and already encoded bodies are left alone.
+    """
+    if (not config.COMPRESSION_ENABLED or response.direct_passthrough or response.is_streamed
+            or response.status_code in (204, 206, 304) or 'Content-Encoding' in response.headers
+            or not is_compressible(response.mimetype)):
+        return response
+    body = response.get_data()
+    if len(body) < config.COMPRESSION_MIN_BYTES:
+        return response
+    response.vary.add('Accept-Encoding')
+    if not accepts(request.headers.get('Accept-Encoding'), 'gzip'):
+        return response
+    response.set_data(gzip_bytes(body, config.COMPRESSION_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    # The compressed bytes are a different representation of the same content
+    weaken_etag(response.headers)
+    return response
 
 @app.route('/')
 def index():
     return jsonify({"status": "Server is running", "usage": "Use /proxy?url=https://example.com to proxy websites"})
 
-@app.route('/youtube')
-def youtube_handler():
-    """Special handler for YouTube videos"""
-    video_id = request.args.get('v')
-    if not video_id:
-        return jsonify({"error": "No YouTube video ID provided"}), 400
-    
+def build_youtube_page(video_id, args):
+    """
+    Build the embed page for a YouTube video from the /youtube query parameters
+    """
     # Get additional YouTube embed parameters
-    autoplay = request.args.get('autoplay', '1')  # Default to autoplay
-    start = request.args.get('t') or request.args.get('start')  # Support both t and start
-    list_id = request.args.get('list')  # Playlist support
+    autoplay = args.get('autoplay', '1')  # Default to autoplay
+    start = args.get('t') or args.get('start')  # Support both t and start
+    list_id = args.get('list')  # Playlist support
     
     # Build the embed URL with parameters
     embed_params = [f"autoplay={autoplay}"]
@@ -108,7 +241,7 @@ def youtube_handler():
     
     # Construct the embed URL - ensure HTTPS
     embed_url = f"https://www.youtube.com/embed/{video_id}?{('&').join(embed_params)}"
-    logger.info(f"Proxying YouTube video: {video_id} via embed URL: {embed_url}")
+    diag(logger, "Proxying YouTube video: %s via embed URL: %s", video_id, embed_url)
     
     # Create a responsive HTML page with the YouTube iframe embed
     html = f"""<!DOCTYPE html>
@@ -173,68 +306,95 @@ def youtube_handler():
     </body>
     </html>"""
     
-    return html, 200, {'Content-Type': 'text/html'}
+    return html
 
-@app.route('/search', methods=['GET', 'POST'])
-def search():
+# Resolves the proxy's own redirects in-process
+router = Router(max_hops=config.ROUTE_MAX_HOPS)
+
+@router.route('/youtube')
+def route_youtube(method, args, form):
+    video_id = args.get('v')
+    if not video_id:
+        return ('error', "No YouTube video ID provided", 400)
+    return ('youtube', video_id, args)
+
+def serve_route(path):
     """
-    Handle search requests, primarily for Google searches.
-    Supports both GET and POST methods and constructs an appropriate search URL.
+    Serve a request through the internal router, running the handler of the
+    final target directly
     """
-    try:
-        logger.info(f"Search request received. Method: {request.method}")
-        
-        if request.method == 'POST':
-            logger.info(f"POST form data: {request.form}")
-        
-        # Get search query from various possible sources
-        q = ""
-        if request.method == 'POST' and 'q' in request.form:
-            q = request.form.get('q', '')
-        elif request.method == 'GET' and 'q' in request.args:
-            q = request.args.get('q', '')
-        
-        logger.info(f"Search query: '{q}'")
-        
-        # Check for YouTube search
-        if q.lower().startswith('youtube ') or 'youtube.com' in request.form.get('url', ''):
-            # Clean the query for YouTube search
-            yt_query = q.lower().replace('youtube ', '', 1).strip()
-            logger.info(f"YouTube search detected. Query: '{yt_query}'")
-            
-            # Construct YouTube search URL - ensure HTTPS
-            yt_search_url = f"https://www.youtube.com/results?search_query={quote_plus(yt_query)}"
-            logger.info(f"Redirecting to YouTube search: {yt_search_url}")
-            
-            # Redirect to our proxy with the YouTube search URL
-            return redirect(f"/proxy?url={quote_plus(yt_search_url)}")
-        
-        # Construct Google search URL with parameters - ensure HTTPS
-        search_params = {
-            'q': q,
-            'hl': 'en',  # Language
-            'safe': 'active',  # Safe search
-            'pws': '0',  # Turn off personalized search
-            'nfpr': '1',  # Turn off auto-correction of spelling
-            'darkmode': '1',  # Enable dark mode
-        }
-        
-        # Add any additional parameters from form or URL
-        if request.method == 'POST':
-            for key, value in request.form.items():
-                if key not in ['q', 'url'] and value:
-                    search_params[key] = value
-        else:  # GET
-            for key, value in request.args.items():
-                if key != 'q' and value:
-                    search_params[key] = value
+    action = router.dispatch(request.method, path, request.query_string.decode('utf-8', 'replace'), request.form)
+    if action[0] == 'redirect':
+        return redirect(action[1])
+    if action[0] == 'error':
+        return jsonify({"error": action[1]}), action[2]
+    if action[0] == 'youtube':
+        return build_youtube_page(action[1], action[2]), 200, {'Content-Type': 'text/html'}
+    return proxy_website_handler(action[1], action[2])
+
+@app.route('/youtube')
+def youtube_handler():
+    """Special handler for YouTube videos"""
+    return serve_route('/youtube')
+
+def search_target(method, args, form):
+    """
+    Build the /proxy location a search request should be sent to.
+    Supports both GET and POST submissions.
+    """
+    # Get search query from various possible sources
+    q = ""
+    if method == 'POST' and 'q' in form:
+        q = form.get('q', '')
+    elif method == 'GET' and 'q' in args:
+        q = args.get('q', '')
+    
+    diag(logger, "Search query: '%s'", q)
+    
+    # Check for YouTube search
+    if q.lower().startswith('youtube ') or 'youtube.com' in form.get('url', ''):
+        # Clean the query for YouTube search
+        yt_query = q.lower().replace('youtube ', '', 1).strip()
+        diag(logger, "YouTube search detected. Query: '%s'", yt_query)
         
-        # Construct the final search URL - ensure HTTPS
-        search_url = f"https://www.google.com/search?{urlencode(search_params)}"
-        logger.info(f"Constructed search URL: {search_url}")
+        # Construct YouTube search URL - ensure HTTPS
+        yt_search_url = f"https://www.youtube.com/results?search_query={quote_plus(yt_query)}"
+        diag(logger, "Redirecting to YouTube search: %s", yt_search_url)
         
-        # Redirect to our proxy with the Google search URL
-        return redirect(f"/proxy?url={quote_plus(search_url)}")
+        # Redirect to our proxy with the YouTube search URL
+        return proxy_url(yt_search_url)
+    
+    # Construct Google search URL with parameters - ensure HTTPS
+    search_params = {
+        'q': q,
+        'hl': 'en',  # Language
+        'safe': 'active',  # Safe search
+        'pws': '0',  # Turn off personalized search
+        'nfpr': '1',  # Turn off auto-correction of spelling
+        'darkmode': '1',  # Enable dark mode
+    }
+    
+    # Add any additional parameters from form or URL
+    if method == 'POST':
+        for key, value in form.items():
+            if key not in ['q', 'url'] and value:
+                search_params[key] = value
+    else:  # GET
+        for key, value in args.items():
+            if key not in ('q', profiling.QUERY_FLAG) and value:
+                search_params[key] = value
+    
+    # Construct the final search URL - ensure HTTPS
+    search_url = f"{config.SEARCH_URL}?{urlencode(search_params)}"
+    diag(logger, "Constructed search URL: %s", search_url)
+    
+    # Redirect to our proxy with the Google search URL
+    return proxy_url(search_url)
+
+@router.route('/search')
+def route_search(method, args, form):
+    try:
+        return ('redirect', search_target(method, args, form))
         
     except Exception as e:
         logger.error(f"Error in search function: {str(e)}")
@@ -242,57 +402,60 @@ def search():
         logger.error(f"Traceback: {traceback_str}")
         
         # Default to Google homepage on error - ensure HTTPS
-        return redirect("/proxy?url=https://www.google.com")
+        return ('redirect', "/proxy?url=https://www.google.com")
 
-@app.route('/proxy', methods=['GET', 'POST'])
-def proxy_website():
+@app.route('/search', methods=['GET', 'POST'])
+def search():
     """
-    Main proxy endpoint that fetches and transforms HTML content
+    Handle search requests, primarily for Google searches.
+    Supports both GET and POST methods and constructs an appropriate search URL.
+    """
+    diag(logger, "Search request received. Method: %s", request.method)
+    return serve_route('/search')
+
+@router.route('/proxy')
+def resolve_proxy_request(method, args, form):
+    """
+    Decide how a /proxy request is served. Returns one of
+    ``('redirect', location)``, ``('error', message, status)`` or
+    ``('fetch', url, args)``, with ``args`` the arguments of the hop that
+    resolved to ``url`` (which may not be the browser's own).
     """
     # Check for Google search in query parameters
-    if request.method == 'GET' and 'q' in request.args:
+    if method == 'GET' and 'q' in args:
         # This might be a Google search form submission
-        if not request.args.get('url'):
+        if not args.get('url'):
             # Redirect to dedicated search handler
-            return redirect(url_for('search', **request.args))
+            return ('redirect', f"/search?{urlencode(list(args.items()))}")
     
     # Check for nested proxy URLs and fix them
-    if request.method == 'GET':
-        url = request.args.get('url', '')
+    if method == 'GET':
+        url = args.get('url', '')
         # Detect if this is a nested proxy URL
-        if url.startswith('http://localhost:5000/proxy') or url.startswith('/proxy'):
-            # Extract the original URL from the nested proxy
-            nested_url_match = re.search(r'[/=](https?[^&]+)', url)
-            if nested_url_match:
-                # Get the actual URL and properly decode it
-                actual_url = nested_url_match.group(1)
-                # It might be URL encoded multiple times
-                try:
-                    while '%' in actual_url:
-                        decoded = urllib.parse.unquote(actual_url)
-                        if decoded == actual_url:
-                            break
-                        actual_url = decoded
-                except Exception as e:
-                    logger.error(f"Error decoding URL: {e}")
-                
-                # Ensure HTTPS
-                actual_url = ensure_https(actual_url)
-                logger.info(f"Fixed nested proxy URL. Redirecting to: {actual_url}")
-                return redirect(f"/proxy?url={urllib.parse.quote(actual_url)}")
+        if is_proxy_url(url):
+            # Extract the original URL from the nested proxy (it might be URL encoded multiple times)
+            actual_url = unwrap_proxy_url(url)
+            if actual_url:
+                diag(logger, "Fixed nested proxy URL. Routing to: %s", actual_url)
+                location = proxy_url(actual_url)
+                # The inner hop's lite flag belongs to the unwrapped target; the outer one is the fallback
+                lite = parse_qs(urlparse(url).query).get('lite', args.getlist('lite'))
+                if lite:
+                    location += f"&lite={quote_plus(lite[-1])}"
+                return ('redirect', location)
             else:
-                return jsonify({"error": "Invalid nested proxy URL"}), 400
+                return ('error', "Invalid nested proxy URL", 400)
                 
         # Ensure HTTPS for all URLs
         url = ensure_https(url)
         
         # Check for direct Google search URLs
         if url and 'google.com/search' in url:
-            logger.info(f"Detected Google search URL: {url}")
+            diag(logger, "Detected Google search URL: %s", url)
     
     # Handle form submission from search engines
-    if request.method == 'POST':
-        url = request.form.get('url')
+    if method == 'POST':
+        url = form.get('url')
         
         # Ensure HTTPS
         if url:
@@ -301,304 +464,817 @@ def proxy_website():
         # Handle Google search form submission
         if url and ('google.com/search' in url or '/search' in url):
             # Get the search query
-            q = request.form.get('q')
+            q = form.get('q')
             if q:
                 # Construct Google search URL with the query - ensure HTTPS
-                search_url = f"https://www.google.com/search?q={urllib.parse.quote(q)}"
-                for key, value in request.form.items():
+                search_url = f"{config.SEARCH_URL}?q={urllib.parse.quote(q)}"
+                for key, value in form.items():
                     if key not in ['url', 'q'] and value:
                         search_url += f"&{key}={urllib.parse.quote(value)}"
                 
-                logger.info(f"Redirecting Google search to: {search_url}")
-                return redirect(f"/proxy?url={urllib.parse.quote(search_url)}")
+                diag(logger, "Redirecting Google search to: %s", search_url)
+                return ('redirect', proxy_url(search_url))
         
         # Handle YouTube search form submission
         if url and ('youtube.com/results' in url or '/results' in url):
-            search_query = request.form.get('search_query')
+            search_query = form.get('search_query')
             if search_query:
                 # Construct proper YouTube search URL - ensure HTTPS
                 search_url = f"https://www.youtube.com/results?search_query={urllib.parse.quote(search_query)}"
-                logger.info(f"Redirecting YouTube search to: {search_url}")
-                return redirect(f"/proxy?url={urllib.parse.quote(search_url)}")
+                diag(logger, "Redirecting YouTube search to: %s", search_url)
+                return ('redirect', proxy_url(search_url))
         
         # For other form submissions, append the form data to the URL
         if url:
-            form_data = request.form.copy()
-            # Remove the URL parameter as we don't want to add it to the query string
-            if 'url' in form_data:
-                del form_data['url']
-                
-            # Build query string from remaining form data
-            query_params = urllib.parse.urlencode(form_data)
+            # Build query string from the form data, without the URL parameter itself
+            query_params = urllib.parse.urlencode([(key, value) for key, value in form.items() if key != 'url'])
             if '?' in url:
                 url = f"{url}&{query_params}"
             else:
                 url = f"{url}?{query_params}"
                 
-            return redirect(f"/proxy?url={urllib.parse.quote(url)}")
+            return ('redirect', proxy_url(url))
             
     # Normal GET request handling
-    url = request.args.get('url')
+    url = args.get('url')
     if not url:
-        return jsonify({"error": "No URL provided"}), 400
+        return ('error', "No URL provided", 400)
     
     # Ensure HTTPS
     url = ensure_https(url)
     
     # Special handling for YouTube watch URLs
-    youtube_video_match = re.match(r'https?://(www\.)?(youtube\.com|youtu\.be)(/watch\?v=|/)([a-zA-Z0-9_-]{11})', url)
-    if youtube_video_match:
-        video_id = youtube_video_match.group(4)
-        return redirect(f"/youtube?v={video_id}")
+    video_id = youtube_video_id(url)
+    if video_id:
+        return ('redirect', f"/youtube?v={video_id}")
     
-    return proxy_website_handler(url)
+    return ('fetch', url, args)
+
+@app.route('/proxy', methods=['GET', 'POST'])
+def proxy_website():
+    """
+    Main proxy endpoint that fetches and transforms HTML content
+    """
+    return serve_route('/proxy')
+
+def render_document(url, raw_body, content_type=None, lite=False, inline=True):
+    """
+    Decode, parse and rewrite a page, trimmed with the lite rules when
+    ``lite`` and with tiny subresources embedded when ``inline`` (and
+    inlining is enabled). Returns ``(body, subresources, encoding)``: the
+    result in the page's own encoding, the subresources it still routes
+    through /proxy-resource and that encoding. A page that does not fit the
+    parse budget is rewritten incrementally, without a tree (or lite rules,
+    or inlining).
+    """
+    with accesslog.phase('decode'):
+        encoding = document_encoding(raw_body, content_type)
+        html_text = decode_document(raw_body, encoding)
+    size = len(raw_body)
+    if not parse_budget.acquire(size):
+        diag(logger, "Parse budget exhausted, rewriting without a tree")
+        accesslog.note('document', STREAM)
+        with accesslog.phase('rewrite'):
+            return encode_document(rewrite_text(html_text, url), encoding), (), encoding
+    try:
+        diag(logger, "Parsing HTML content")
+        with accesslog.phase('parse'):
+            soup = BeautifulSoup(html_text, 'html.parser')
+        
+        # Rewrite links, forms and (optionally) subresources in a single walk
+        diag(logger, "Rewriting document")
+        with accesslog.phase('rewrite'):
+            ctx = rewrite_document(soup, url, rewrite_resources=config.REWRITE_RESOURCES, lite=lite,
+                                   inline=inline and config.INLINE_ENABLED)
+        if lite:
+            accesslog.note('lite', {'removed': ctx.removed, 'saved_bytes': ctx.removed_bytes})
+        subresources = ctx.subresources
+        if ctx.inline_candidates:
+            diag(logger, "Inlining %d subresources", len(ctx.inline_candidates))
+            with accesslog.phase('inline'):
+                inlined, summary = inliner.inline(soup, ctx.inline_candidates)
+            accesslog.note('inline', summary)
+            if inlined:
+                # Nothing left for the browser to fetch, so nothing to prefetch
+                subresources = [(priority, resource) for priority, resource in subresources if resource not in inlined]
+        with accesslog.phase('serialize'):
+            body = encode_document(soup.decode(eventual_encoding=encoding), encoding)
+        return body, subresources, encoding
+    finally:
+        parse_budget.release(size)
+
+def build_document(url, raw_body, content_type, previous=None, lite=False):
+    """
+    Rewrite a fetched page, reusing a previous rewrite when the upstream body
+    is byte-for-byte unchanged. Returns ``(body, fingerprint, subresources, encoding)``.
+    """
+    fingerprint = body_fingerprint(raw_body)
+    if previous is not None and previous.fingerprint == fingerprint:
+        diag(logger, "Upstream body unchanged, reusing cached rewrite")
+        document_cache.record_rewrite_saved()
+        return previous.body, fingerprint, previous.subresources, previous.encoding
+    body, subresources, encoding = render_document(url, raw_body, content_type, lite)
+    return body, fingerprint, subresources, encoding
+
+def compress_document(body, previous=None):
+    """
+    The gzip form of a rewritten page kept alongside it in the document
+    cache, reused from ``previous`` when the page itself was reused
+    """
+    if not config.COMPRESSION_ENABLED or len(body) < config.COMPRESSION_MIN_BYTES:
+        return None
+    if previous is not None and previous.body is body and previous.compressed is not None:
+        return previous.compressed
+    with accesslog.phase('compress'):
+        return gzip_bytes(body, config.COMPRESSION_LEVEL)
+
+def cache_document(cache_key, url, raw_body, upstream_headers, previous=None, lite=False):
+    """
+    Rewrite a fetched page and store it in the document cache.
+    Returns ``(body, etag, compressed, subresources, encoding)``.
+    """
+    upstream_etag = upstream_headers.get('ETag')
+    body, fingerprint, subresources, encoding = build_document(
+        url, raw_body, upstream_headers.get('Content-Type'), previous, lite
+    )
+    etag = document_etag(document_signature(lite), upstream_etag, body)
+    compressed = compress_document(body, previous)
+    document_cache.store(cache_key, url, fingerprint, upstream_etag, etag, body, upstream_headers,
+                         compressed, subresources, encoding)
+    return body, etag, compressed, subresources, encoding
+
+def document_signature(lite=False):
+    """
+    Signature of the rewrite settings behind a document's ETag
+    """
+    return LITE_DOCUMENT_SIGNATURE if lite else DOCUMENT_SIGNATURE
+
+def document_cache_key(url, lite=False):
+    """
+    Document cache key of a page; lite pages are cached apart from full ones
+    """
+    key = normalize_url(url)
+    return f"lite:{key}" if lite else key
+
+def refresh_document(cache_key, url, entry, lite=False):
+    """
+    Background refresh of a stale cached page
+    """
+    try:
+        headers = PAGE_HEADERS.copy()
+        if entry.upstream_etag:
+            headers['If-None-Match'] = entry.upstream_etag
+        response = upstream.get(url, headers=headers, timeout=request_timeout(config.UPSTREAM_PAGE_DEADLINE))
+        if response.status_code == 304:
+            document_cache.touch(cache_key, entry)
+        elif response.status_code == 200 and 'text/html' in response.headers.get('Content-Type', ''):
+            cache_document(cache_key, url, response.content, response.headers, entry, lite)
+    except Exception as e:
+        logger.error(f"Error refreshing cached page {url}: {str(e)}")
+    finally:
+        document_cache.end_refresh(cache_key)
+
+def schedule_document_refresh(cache_key, url, entry, lite=False):
+    """
+    Start a background refresh unless one is already running for this page
+    """
+    if document_cache.begin_refresh(cache_key):
+        threading.Thread(target=refresh_document, args=(cache_key, url, entry, lite), daemon=True).start()
 
-def proxy_website_handler(url):
+def document_response(body, etag, compressed=None, subresources=(), encoding='utf-8', client=None):
+    """
+    Return a rewritten page in ``encoding``, or 304 if the browser already
+    has it. A cached gzip form is sent as is to browsers that accept it, and
+    the page's subresources are prefetched for the ``client`` page view while
+    it is being delivered.
+    """
+    response_headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if client is not None and client.new:
+        response_headers['Set-Cookie'] = client.set_cookie()
+    if request.method == 'GET' and is_not_modified(request.headers, etag):
+        diag(logger, "Browser copy is current, returning 304")
+        return '', 304, response_headers
+    if client is not None:
+        start_prefetch(client.key, subresources)
+    diag(logger, "Returning modified HTML content")
+    response_headers['Content-Type'] = f'text/html; charset={encoding}'
+    if compressed is not None and accepts(request.headers.get('Accept-Encoding'), 'gzip'):
+        response_headers.update({'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'})
+        return compressed, 200, response_headers
+    return body, 200, response_headers
+
+def proxy_website_handler(url, args):
     """
     Proxy handler that fetches content from external websites and processes it to work within our proxy.
     Focuses on modifying Google search forms to ensure they work properly through the proxy.
+    ``args`` are the query arguments the router resolved ``url`` from.
     """
     try:
         # Ensure HTTPS for the URL
         url = ensure_https(url)
-        logger.info(f"Proxying website: {url}")
+        accesslog.note_host(url)
+        diag(logger, "Proxying website: %s", url)
+        
+        # The client is leaving the page it navigated from; stop prefetching for it
+        client = None
+        if config.PREFETCH_ENABLED:
+            client = PrefetchClient(request.cookies.get(CLIENT_COOKIE), url)
+            leaving = client.leaving(request.headers.get('Referer'))
+            if leaving is not None:
+                prefetcher.cancel(leaving)
+        
+        # Lite mode trims the page in the tree rewrite
+        lite = config.HTML_REWRITE_MODE == 'tree' and wants_lite(url, args.get('lite'))
+        signature = document_signature(lite)
         
-        # Use a session to maintain cookies and common headers
-        session = requests.Session()
+        # Plain GETs of rewritten pages can be answered from the document cache
+        cache_key = None
+        cached = None
+        if request.method == 'GET' and config.DOCUMENT_CACHE_ENABLED and config.HTML_REWRITE_MODE == 'tree':
+            cache_key = document_cache_key(url, lite)
+            cached, state = document_cache.lookup(cache_key)
+            accesslog.note('cache', state or 'miss')
+            if state == DocumentCache.FRESH:
+                diag(logger, "Serving rewritten page from cache")
+                return document_response(cached.body, cached.etag, cached.compressed, cached.subresources, cached.encoding, client=client)
+            if state == DocumentCache.STALE:
+                diag(logger, "Serving stale rewritten page from cache while refreshing")
+                schedule_document_refresh(cache_key, url, cached, lite)
+                return document_response(cached.body, cached.etag, cached.compressed, cached.subresources, cached.encoding, client=client)
         
-        # Special handling for Google
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Referer': 'https://www.google.com/',
-        }
+        # The whole fetch (connect, headers and body) shares one time budget
+        deadline = Deadline(config.UPSTREAM_PAGE_DEADLINE)
+        headers = PAGE_HEADERS.copy()
         
         # Handle POST request (form submission)
         if request.method == 'POST':
-            logger.info(f"Handling POST request to {url}")
-            logger.info(f"POST data: {request.form}")
+            diag(logger, "Handling POST request to %s", url)
             
             # Forward the POST request with form data
-            response = session.post(url, data=request.form, headers=headers, allow_redirects=True)
-            logger.info(f"POST response status: {response.status_code}")
-            logger.info(f"POST response URL: {response.url}")
+            with accesslog.phase('upstream'):
+                response = upstream.post(url, data=request.form, headers=headers, allow_redirects=True, stream=True,
+                                         timeout=deadline.timeout())
+            diag(logger, "POST response status: %s from %s", response.status_code, response.url)
         else:
-            # Handle GET request
-            logger.info(f"Handling GET request to {url}")
-            response = session.get(url, headers=headers, allow_redirects=True)
-            logger.info(f"GET response status: {response.status_code}")
-            logger.info(f"GET response URL: {response.url}")
+            # Handle GET request, revalidating with the origin if the browser or our cache holds a copy
+            browser_etag = upstream_etag_for(request.headers.get('If-None-Match'), signature)
+            if browser_etag:
+                headers['If-None-Match'] = browser_etag
+            elif cached is not None and cached.upstream_etag:
+                headers['If-None-Match'] = cached.upstream_etag
+            diag(logger, "Handling GET request to %s", url)
+            # An identical GET already in flight shares its response
+            with accesslog.phase('upstream'):
+                response = upstream.get(url, headers=headers, allow_redirects=True, stream=True,
+                                        timeout=deadline.timeout(), coalesce=True)
+            diag(logger, "GET response status: %s from %s", response.status_code, response.url)
+            
+            if response.status_code == 304 and 'If-None-Match' in headers:
+                response.close()
+                if browser_etag:
+                    return '', 304, {'ETag': document_etag(signature, browser_etag), 'Cache-Control': 'no-cache'}
+                cached = document_cache.touch(cache_key, cached)
+                return document_response(cached.body, cached.etag, cached.compressed, cached.subresources, cached.encoding, client=client)
 
         # Process only HTML content
         content_type = response.headers.get('Content-Type', '')
         if 'text/html' not in content_type:
-            logger.info(f"Non-HTML content detected: {content_type}")
-            return response.content, response.status_code, {'Content-Type': content_type}
-        
-        # Parse HTML
-        logger.info("Parsing HTML content")
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        # Process links to route through our proxy
-        logger.info("Processing links")
-        for a_tag in soup.find_all('a', href=True):
-            href = a_tag['href']
-            if href.startswith('http'):
-                # Ensure HTTPS
-                href = ensure_https(href)
-                a_tag['href'] = f"/proxy?url={quote_plus(href)}"
-                a_tag['target'] = '_self'  # Open in same tab
-                logger.debug(f"Modified link: {href} -> /proxy?url={quote_plus(href)}")
-            elif href.startswith('//'):
-                # Protocol-relative URLs, make them explicit HTTPS
-                href = f"https:{href}"
-                a_tag['href'] = f"/proxy?url={quote_plus(href)}"
-                a_tag['target'] = '_self'
-                logger.debug(f"Modified protocol-relative link: {href}")
-        
-        # Process forms
-        logger.info("Processing forms")
-        for form in soup.find_all('form'):
-            # Get the form action URL
-            action = form.get('action', '')
-            logger.info(f"Found form with action: {action}")
-            
-            # Skip forms without action
-            if not action:
-                logger.info("Form has no action, skipping")
-                continue
-                
-            # Convert relative URLs to absolute
-            if not action.startswith('http'):
-                if action.startswith('/'):
-                    # Ensure we use HTTPS for the base URL
-                    parsed_url = urllib.parse.urlparse(url)
-                    base_url = f"https://{parsed_url.netloc}"  # Force HTTPS
-                    action = f"{base_url}{action}"
-                else:
-                    action = urljoin(url, action)
-                logger.info(f"Converted relative action to absolute: {action}")
-            else:
-                # Force HTTPS for all absolute URLs
-                if action.startswith('http://'):
-                    action = 'https://' + action[7:]
-                    logger.info(f"Converted HTTP action to HTTPS: {action}")
-            
-            # Check if it's a Google search form
-            is_google_search = False
-            if 'google.com/search' in action or '/webhp' in action:
-                logger.info("Detected Google search form")
-                is_google_search = True
-                
-                # Set the form to submit to our search endpoint
-                form['action'] = '/search'
-                form['method'] = 'POST'
-                logger.info("Modified Google form to use our search endpoint")
-                
-                # Add a hidden input for the original URL (ensure it's HTTPS)
-                url_input = soup.new_tag('input')
-                url_input['type'] = 'hidden'
-                url_input['name'] = 'url'
-                if url.startswith('http://'):
-                    url = 'https://' + url[7:]  # Convert to HTTPS
-                url_input['value'] = url
-                form.append(url_input)
-                logger.info(f"Added hidden input with original URL: {url}")
-                
-                # Ensure there's a search input field
-                search_input = form.find('input', {'name': 'q'})
-                if not search_input:
-                    logger.info("No search input found, creating one")
-                    search_input = soup.new_tag('input')
-                    search_input['type'] = 'text'
-                    search_input['name'] = 'q'
-                    form.append(search_input)
-            else:
-                # For non-Google forms, route through our proxy
-                form['action'] = f"/proxy?url={quote_plus(action)}"
-                logger.info(f"Modified form action to use proxy: {action}")
-            
-            # Add javascript to make Google search work better
-            if is_google_search:
-                script = soup.new_tag('script')
-                script.string = """
-                document.addEventListener('DOMContentLoaded', function() {
-                    const form = document.querySelector('form[action="/search"]');
-                    if (form) {
-                        form.addEventListener('submit', function(e) {
-                            const query = form.querySelector('input[name="q"]').value;
-                            if (!query || query.trim() === '') {
-                                e.preventDefault();
-                                console.log('Empty search prevented');
-                                return false;
-                            }
-                            console.log('Search form submitted with query: ' + query);
-                        });
-                    }
-                });
-                """
-                if soup.head:
-                    soup.head.append(script)
-                else:
-                    # Create head if it doesn't exist
-                    head = soup.new_tag('head')
-                    head.append(script)
-                    soup.html.insert(0, head)
-                logger.info("Added JavaScript to enhance Google search form")
-        
-        # Process iframes to ensure HTTPS
-        for iframe in soup.find_all('iframe', src=True):
-            src = iframe['src']
-            if src.startswith('http://'):
-                iframe['src'] = 'https://' + src[7:]
-                logger.info(f"Converted iframe src from HTTP to HTTPS: {iframe['src']}")
-                
-        # Fix mixed content in style tags
-        for style in soup.find_all('style'):
-            if style.string:
-                style.string = style.string.replace('http://', 'https://')
-                
-        # Fix inline styles with url() references
-        for tag in soup.find_all(style=True):
-            if 'url(http://' in tag['style']:
-                tag['style'] = tag['style'].replace('url(http://', 'url(https://')
-                
-        # Add a meta tag to enforce HTTPS
-        meta_tag = soup.new_tag('meta')
-        meta_tag['http-equiv'] = 'Content-Security-Policy'
-        meta_tag['content'] = "upgrade-insecure-requests"
-        if soup.head:
-            soup.head.insert(0, meta_tag)
-        else:
-            head = soup.new_tag('head')
-            head.append(meta_tag)
-            if soup.html:
-                soup.html.insert(0, head)
-            else:
-                html = soup.new_tag('html')
-                html.append(head)
-                soup.append(html)
+            diag(logger, "Non-HTML content detected: %s", content_type)
+            raw_body = read_content(response, deadline)
+            accesslog.add_bytes_in(len(raw_body))
+            return raw_body, response.status_code, {'Content-Type': content_type}
+        
+        # Origin validator for the document, when it is safe to reuse
+        upstream_etag = response.headers.get('ETag') if request.method == 'GET' and response.status_code == 200 else None
+        
+        # Oversized pages skip the parse tree: past the soft limit they are
+        # rewritten incrementally, past the hard limit relayed unmodified
+        plan = document_plan(declared_length(response.headers))
+        if plan == RELAY:
+            diag(logger, "Relaying oversized page unmodified")
+            accesslog.note('document', RELAY)
+            return relay_document(response, content_type)
+        
+        chunks = None
+        if config.HTML_REWRITE_MODE == 'tree' and plan == TREE:
+            with accesslog.phase('transfer'):
+                raw_body, rest = read_document(response, deadline, config.DOCUMENT_SOFT_LIMIT_BYTES)
+            accesslog.add_bytes_in(len(raw_body))
+            if rest is None:
+                if cache_key is not None and response.status_code == 200:
+                    return document_response(*cache_document(
+                        cache_key, url, raw_body, response.headers, cached, lite
+                    ), client=client)
+                body, subresources, encoding = render_document(url, raw_body, content_type, lite)
+                return document_response(body, document_etag(signature, upstream_etag, body),
+                                         subresources=subresources, encoding=encoding, client=client)
+            diag(logger, "Page passed %d bytes, rewriting the rest incrementally", config.DOCUMENT_SOFT_LIMIT_BYTES)
+            plan = STREAM
+            chunks = itertools.chain((raw_body,), rest)
         
-        # Return modified HTML content
-        modified_html = str(soup)
-        logger.info("Returning modified HTML content")
-        return modified_html
+        if plan == STREAM:
+            accesslog.note('document', STREAM)
+        return stream_document(response, url, upstream_etag, chunks, signature)
         
+    except UpstreamUnavailable as e:
+        accesslog.note_error(e)
+        return unavailable_page(e)
     except Exception as e:
+        accesslog.note_error(e)
         logger.error(f"Error in proxy_website_handler: {str(e)}")
         traceback_str = traceback.format_exc()
         logger.error(f"Traceback: {traceback_str}")
         return f"<html><body><h1>Error accessing {url}</h1><p>{str(e)}</p></body></html>", 500
 
-def stream_video(url, headers):
+def stream_document(response, url, upstream_etag, chunks=None, signature=DOCUMENT_SIGNATURE):
     """
-    Stream video content from the source URL
+    Rewrite and flush a page while its body is still arriving; ``chunks``
+    continues a body that has already been partly read. The page is sent in
+    its own encoding, settled from its first chunk, with an ETag under the
+    request's rewrite ``signature``.
     """
+    diag(logger, "Streaming rewritten HTML content")
+    if chunks is None:
+        chunks = response.iter_content(chunk_size=config.HTML_STREAM_CHUNK_SIZE)
     try:
-        # Ensure HTTPS for video URL
-        url = ensure_https(url)
-        logger.info(f"Streaming video from: {url}")
-        
-        # Create custom headers for video
-        video_headers = BROWSER_HEADERS.copy()
-        
-        # Check for YouTube domains to add specific headers
-        parsed_url = urllib.parse.urlparse(url)
-        domain = parsed_url.netloc
-        if any(domain.endswith(yt_domain) for yt_domain in YOUTUBE_DOMAINS):
-            video_headers['Referer'] = 'https://www.youtube.com/'
-            video_headers['Origin'] = 'https://www.youtube.com'
-        
-        # Add range header if present in request
-        range_header = request.headers.get('Range')
-        if range_header:
-            video_headers['Range'] = range_header
-        
-        # Make a streaming request to the source
-        req = requests.get(
-            url, 
-            headers=video_headers, 
-            stream=True, 
-            timeout=30
-        )
-        
-        # Extract necessary headers from the response
-        response_headers = {}
-        for key, value in req.headers.items():
-            if key.lower() in ['content-type', 'content-length', 'accept-ranges', 'content-range',
-                              'cache-control', 'expires', 'etag', 'last-modified']:
-                response_headers[key] = value
-        
-        # Create a streaming response using Flask's stream_with_context
-        return Response(
-            stream_with_context(req.iter_content(chunk_size=1024)),
-            headers=response_headers,
-            status=req.status_code
-        )
-    except Exception as e:
-        logger.error(f"Error streaming video {url}: {str(e)}", exc_info=True)
-        return jsonify({"error": f"Failed to stream video: {str(e)}"}), 500
+        first = next(chunks, b'')
+    except BaseException:
+        response.close()
+        raise
+    encoding = document_encoding(first, response.headers.get('Content-Type'))
+    stream_headers = {'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+    if upstream_etag:
+        stream_headers['ETag'] = document_etag(signature, upstream_etag)
+    body = stream_rewrite(response, url, chunks=itertools.chain((first,), chunks),
+                          limit=config.DOCUMENT_HARD_LIMIT_BYTES, encoding=encoding)
+    if config.COMPRESSION_ENABLED and accepts(request.headers.get('Accept-Encoding'), 'gzip'):
+        body = gzip_stream(body, config.COMPRESSION_LEVEL)
+        stream_headers['Content-Encoding'] = 'gzip'
+    return Response(
+        stream_with_context(body),
+        headers=stream_headers,
+        content_type=f'text/html; charset={encoding}'
+    )
+
+def relay_document(response, content_type):
+    """
+    Pass a page too large to rewrite through unmodified, as it arrives
+    """
+    def body():
+        try:
+            yield from counted_body(response.iter_content(chunk_size=config.RESOURCE_STREAM_CHUNK_SIZE))
+        finally:
+            response.close()
+    return Response(
+        stream_with_context(body()),
+        status=response.status_code,
+        headers={'Content-Type': content_type, 'Cache-Control': 'no-cache'}
+    )
+
+def read_document(response, deadline, limit=None):
+    """
+    Read a streamed response's body, giving up once ``deadline`` passes
+    (each read is bounded by the request's read timeout, the whole body by this).
+    Returns ``(body, rest)``: once more than ``limit`` bytes have arrived,
+    reading stops with the response left open, ``body`` is only its start and
+    ``rest`` iterates over the remaining chunks; otherwise ``rest`` is None.
+    """
+    chunks = []
+    size = 0
+    stream = response.iter_content(chunk_size=config.RESOURCE_STREAM_CHUNK_SIZE)
+    try:
+        for chunk in stream:
+            chunks.append(chunk)
+            size += len(chunk)
+            if limit is not None and size > limit:
+                return b''.join(chunks), stream
+            deadline.check()
+    except BaseException:
+        response.close()
+        raise
+    response.close()
+    # Lets response.text decode the body as usual
+    response._content = b''.join(chunks)
+    return response._content, None
+
+def read_content(response, deadline):
+    """
+    Read a streamed response's whole body, giving up once ``deadline`` passes
+    """
+    return read_document(response, deadline)[0]
+
+def unavailable_page(e):
+    """
+    Cheap error page for an origin whose circuit is open or whose queue is full
+    """
+    return (
+        f"<html><body><h1>{escape(e.host)} is not responding</h1>"
+        f"<p>Try again in {e.retry_after} seconds.</p></body></html>",
+        503,
+        {'Retry-After': str(e.retry_after), 'Cache-Control': 'no-store'},
+    )
+
+def counted_body(chunks):
+    """
+    Pass an upstream body through, counting its bytes for the access record
+    """
+    for chunk in chunks:
+        accesslog.add_bytes_in(len(chunk))
+        yield chunk
+
+def cached_resource_response(entry):
+    """
+    Answer a /proxy-resource request from a cache entry, with 304 when the
+    browser's copy is still valid
+    """
+    headers = validator_headers(entry.headers)
+    if is_not_modified(request.headers, entry.headers.get('ETag'), entry.headers.get('Last-Modified')):
+        return '', 304, headers
+    if config.REWRITE_STYLESHEETS and is_stylesheet(entry.headers):
+        stylesheet = stylesheet_response(entry.url, entry.body, entry.headers, request.headers)
+        if stylesheet is not None:
+            return stylesheet[0], 200, stylesheet[1]
+    headers['Content-Type'] = entry.headers.get('Content-Type', 'application/octet-stream')
+    return encoded_resource_body(entry, request.headers, headers), 200, headers
+
+def is_stylesheet(headers):
+    return (headers.get('Content-Type') or '').split(';', 1)[0].strip().lower() == 'text/css'
+
+def declared_length(headers):
+    """
+    The Content-Length of a response, or None when missing or invalid
+    """
+    try:
+        return int(headers.get('Content-Length'))
+    except (TypeError, ValueError):
+        return None
+
+def compressed_form(body, content_type):
+    """
+    The gzip form of a body that is served many times, or None when it
+    would not be compressed on its way out
+    """
+    if (not config.COMPRESSION_ENABLED or len(body) < config.COMPRESSION_MIN_BYTES
+            or not is_compressible(content_type)):
+        return None
+    return gzip_bytes(body, config.COMPRESSION_LEVEL)
+
+def resource_compressed_form(headers, body):
+    """
+    The gzip form kept with a cached resource the origin sent unencoded
+    """
+    if content_coding(headers) != 'identity':
+        return None
+    return compressed_form(body, headers.get('Content-Type'))
+
+def negotiated_body(body, compressed, request_headers, headers):
+    """
+    ``body``, or its stored gzip form ``compressed`` for browsers that
+    accept it, with ``headers`` updated to match
+    """
+    if compressed is None:
+        return body
+    headers['Vary'] = 'Accept-Encoding'
+    if not accepts(request_headers.get('Accept-Encoding'), 'gzip'):
+        return body
+    headers['Content-Encoding'] = 'gzip'
+    # The compressed bytes are a different representation of the same content
+    weaken_etag(headers)
+    return compressed
+
+def rewritten_stylesheet(url, raw_body, upstream_headers):
+    """
+    Rewrite the url() and @import references of a stylesheet so they load
+    through /proxy-resource. ``raw_body`` is in the origin's content coding.
+    Returns the UTF-8 result, or None if the body cannot be decoded.
+    """
+    forms = stylesheet_forms(url, raw_body, upstream_headers)
+    return forms[0] if forms is not None else None
+
+def stylesheet_response(url, raw_body, upstream_headers, request_headers):
+    """
+    ``(body, headers)`` of a rewritten stylesheet, gzipped for browsers
+    that accept it, or None if the body cannot be decoded
+    """
+    forms = stylesheet_forms(url, raw_body, upstream_headers)
+    if forms is None:
+        return None
+    headers = stylesheet_headers(upstream_headers)
+    return negotiated_body(*forms, request_headers, headers), headers
+
+def stylesheet_forms(url, raw_body, upstream_headers):
+    """
+    ``(rewritten, compressed)`` forms of a stylesheet (see
+    ``rewritten_stylesheet``), cached per stylesheet URL for as long as the
+    upstream body is unchanged; None if the body cannot be decoded
+    """
+    fingerprint = body_fingerprint(raw_body)
+    cached = stylesheet_cache.get(url, count=False)
+    if cached is not None and cached[0] == fingerprint:
+        stylesheet_cache.record_hit()
+        return cached[1], cached[2]
+    stylesheet_cache.record_miss()
+
+    def reference(ref):
+        if ref.startswith('data:'):
+            return ref
+        return proxy_resource_url(absolute_url(url, upgrade_insecure(ref)))
+
+    with accesslog.phase('rewrite'):
+        coding = content_coding(upstream_headers)
+        body = raw_body if coding == 'identity' else decompress(raw_body, coding)
+        if body is None:
+            return None
+        text = body.decode(stylesheet_encoding(body, upstream_headers.get('Content-Type')), errors='replace')
+        rewritten = rewrite_css(text, reference).encode('utf-8')
+    with accesslog.phase('compress'):
+        compressed = compressed_form(rewritten, 'text/css')
+    stylesheet_cache.put(url, (fingerprint, rewritten, compressed))
+    return rewritten, compressed
+
+def stylesheet_headers(upstream_headers):
+    """
+    Headers for a rewritten stylesheet. Its ETag is weakened, since the body
+    now differs from the origin's bytes.
+    """
+    headers = validator_headers(upstream_headers)
+    weaken_etag(headers)
+    headers['Content-Type'] = 'text/css; charset=utf-8'
+    return headers
+
+def encoded_resource_body(entry, request_headers, headers):
+    """
+    The body of a cached resource in a coding the browser accepts. Entries
+    are stored as the origin encoded them and decoded here only if needed;
+    unencoded ones are sent in the gzip form kept with them when accepted.
+    """
+    coding = content_coding(entry.headers)
+    if coding == 'identity':
+        return negotiated_body(entry.body, entry.compressed, request_headers, headers)
+    headers['Vary'] = 'Accept-Encoding'
+    if not accepts(request_headers.get('Accept-Encoding'), coding):
+        decoded = decompress(entry.body, coding)
+        if decoded is not None:
+            # The origin's ETag names its encoded bytes
+            weaken_etag(headers)
+            return decoded
+    headers['Content-Encoding'] = coding
+    return entry.body
+
+def relay_headers(upstream_headers, passthrough=False, compress=False):
+    """
+    Headers for a relayed resource. Content-Length is only passed on when the
+    body goes through byte for byte (unencoded, or encoded and passed
+    through); decoded or ``compress``-ed bodies are sent chunked.
+    """
+    headers = validator_headers(upstream_headers)
+    headers['Content-Type'] = upstream_headers.get('Content-Type', 'application/octet-stream')
+    for name in RANGE_HEADERS:
+        if upstream_headers.get(name):
+            headers[name] = upstream_headers[name]
+    coding = content_coding(upstream_headers)
+    if coding != 'identity':
+        headers['Vary'] = 'Accept-Encoding'
+        if passthrough:
+            headers['Content-Encoding'] = coding
+        else:
+            # Decoded on the way through; the origin's ETag names its encoded bytes
+            weaken_etag(headers)
+    if compress:
+        headers['Vary'] = 'Accept-Encoding'
+        headers['Content-Encoding'] = 'gzip'
+        weaken_etag(headers)
+    elif upstream_headers.get('Content-Length') and (passthrough or coding == 'identity'):
+        headers['Content-Length'] = upstream_headers['Content-Length']
+    return headers
+
+def should_compress_relay(status, upstream_headers, accept_encoding):
+    """
+    Whether to gzip an unencoded text resource on its way through. Partial
+    content is never compressed, as its range refers to the original bytes.
+    """
+    if not (config.COMPRESSION_ENABLED and status == 200 and content_coding(upstream_headers) == 'identity'
+            and is_compressible(upstream_headers.get('Content-Type'))
+            and accepts(accept_encoding, 'gzip')):
+        return False
+    try:
+        return int(upstream_headers.get('Content-Length')) >= config.COMPRESSION_MIN_BYTES
+    except (TypeError, ValueError):
+        return True
+
+def cache_buffer_limit(upstream_headers):
+    """
+    Bytes of a relayed body that may be held in memory for the resource
+    cache, or 0 when the declared length already rules caching out
+    """
+    limit = min(config.RESOURCE_STREAM_BUFFER_BYTES, resource_cache.max_entry_bytes)
+    if (declared_length(upstream_headers) or 0) > limit:
+        return 0
+    return limit
+
+def relay_resource(response, url, request_headers, buffer_limit, writer=None, passthrough=False):
+    """
+    Yield an upstream body chunk by chunk, still encoded when ``passthrough``
+    is set. Up to ``buffer_limit`` bytes are kept so a complete body that
+    fits can be cached after the last chunk, and video blocks are handed to
+    ``writer`` for the segment cache.
+    """
+    buffered = [] if buffer_limit else None
+    size = 0
+    if passthrough:
+        chunks = response.raw.stream(config.RESOURCE_STREAM_CHUNK_SIZE, decode_content=False)
+    else:
+        chunks = response.iter_content(chunk_size=config.RESOURCE_STREAM_CHUNK_SIZE)
+    try:
+        for chunk in chunks:
+            accesslog.add_bytes_in(len(chunk))
+            if writer is not None:
+                writer.feed(chunk)
+            if buffered is not None:
+                size += len(chunk)
+                if size > buffer_limit:
+                    buffered = None
+                else:
+                    buffered.append(chunk)
+            yield chunk
+        if buffered is not None:
+            resource_cache.store(url, request_headers, response.status_code, response.headers, b''.join(buffered))
+    finally:
+        response.close()
+
+def segment_plan(meta, range_header):
+    """
+    How the segment cache answers ``range_header`` for a known video:
+    ``(status, start, end, headers)``, with no bytes to send for a 416, or
+    None for ranges it cannot serve
+    """
+    response_headers = {'Content-Type': meta.content_type, 'Accept-Ranges': 'bytes'}
+    if meta.etag:
+        response_headers['ETag'] = meta.etag
+    if meta.last_modified:
+        response_headers['Last-Modified'] = meta.last_modified
+
+    if range_header:
+        byte_range = parse_range(range_header, meta.length)
+        if byte_range is None:
+            return None
+        if byte_range is False:
+            response_headers['Content-Range'] = f"bytes */{meta.length}"
+            return 416, None, None, response_headers
+        start, end = byte_range
+        status = 206
+        response_headers['Content-Range'] = f"bytes {start}-{end}/{meta.length}"
+    else:
+        start, end, status = 0, meta.length - 1, 200
+    response_headers['Content-Length'] = str(end - start + 1)
+    return status, start, end, response_headers
+
+def segment_fetch_headers(headers, meta, first, last):
+    """Upstream headers fetching bytes ``first``..``last`` of a video for the segment cache"""
+    range_headers = {key: value for key, value in headers.items() if key != 'Range'}
+    range_headers['Range'] = f"bytes={first}-{last}"
+    range_headers['If-Range'] = meta.validator
+    return range_headers
+
+def check_segment_fetch(url, status, upstream_headers, first, last):
+    """Raise unless an upstream response holds exactly the bytes a segment fetch asked for"""
+    content_range = parse_content_range(upstream_headers.get('Content-Range'))
+    if status != 206 or content_range is None or content_range[0] != first:
+        # The origin changed the video (or ignored the range); start over next time
+        segment_cache.forget(url)
+        raise IOError(f"Origin did not return bytes {first}-{last} of {url} (status {status})")
+
+def segmented_video_response(url, headers, meta, range_header):
+    """
+    Answer a request for a video known to the segment cache, fetching only
+    the blocks not on disk yet. Returns None for ranges it cannot serve.
+    """
+    plan = segment_plan(meta, range_header)
+    if plan is None:
+        return None
+    status, start, end, response_headers = plan
+    if status == 416:
+        return '', 416, response_headers
+
+    def fetch(first, last):
+        response = upstream.get(url, headers=segment_fetch_headers(headers, meta, first, last), stream=True,
+                                timeout=request_timeout(config.UPSTREAM_STREAM_TIMEOUT))
+        try:
+            check_segment_fetch(url, response.status_code, response.headers, first, last)
+            yield from counted_body(response.iter_content(chunk_size=config.RESOURCE_STREAM_CHUNK_SIZE))
+        finally:
+            response.close()
+
+    return Response(
+        stream_with_context(segment_cache.read_range(meta, start, end, fetch)),
+        headers=response_headers,
+        status=status
+    )
+
+def resource_request_headers(url):
+    """
+    Upstream request headers for a subresource, with the Referer and Origin
+    YouTube expects on its own resources
+    """
+    headers = BROWSER_HEADERS.copy()
+    host = host_info(url)
+    if host.is_youtube or host.is_video:
+        headers['Referer'] = 'https://www.youtube.com/'
+        headers['Origin'] = 'https://www.youtube.com'
+    return headers
+
+def prefetch_resource(url):
+    """
+    Warm the resource cache for a subresource of a page being delivered.
+    Returns False when a fresh copy was already cached.
+    """
+    url = ensure_https(url)
+    headers = resource_request_headers(url)
+    if resource_cache.contains_fresh(url, headers):
+        return False
+    response = upstream.get(url, headers=headers, stream=True, timeout=request_timeout(config.UPSTREAM_RESOURCE_TIMEOUT),
+                            coalesce=True)
+    try:
+        limit = cache_buffer_limit(response.headers)
+        if response.status_code != 200 or not limit:
+            return True
+        raw_body = response.raw.read(limit + 1, decode_content=False)
+        if len(raw_body) > limit:
+            return True
+        resource_cache.store(url, headers, response.status_code, response.headers, raw_body)
+        if config.REWRITE_STYLESHEETS and is_stylesheet(response.headers):
+            rewritten_stylesheet(url, raw_body, response.headers)
+    finally:
+        response.close()
+    return True
+
+prefetcher = Prefetcher(
+    fetch=prefetch_resource,
+    workers=config.PREFETCH_WORKERS,
+    max_per_page=config.PREFETCH_MAX_PER_PAGE,
+    page_concurrency=config.PREFETCH_PAGE_CONCURRENCY,
+    max_queued=config.PREFETCH_MAX_QUEUED,
+    timeout=config.PREFETCH_TIMEOUT,
+)
+
+def inline_resource(url, kind, deadline):
+    """
+    A subresource small enough to embed in a page, as ``(content_type,
+    body)``, from the resource cache or the origin within ``deadline``.
+    Stylesheets come back rewritten. None when it is missing, too large or
+    not an image (or stylesheet, for ``STYLESHEET``).
+    """
+    url = ensure_https(url)
+    headers = resource_request_headers(url)
+    cached = resource_cache.lookup(url, headers) if config.RESOURCE_CACHE_ENABLED else None
+    if cached is not None:
+        status, upstream_headers, raw_body = cached.status, cached.headers, cached.body
+    else:
+        response = upstream.get(url, headers=headers, stream=True, timeout=deadline.timeout(), coalesce=True)
+        try:
+            status, upstream_headers = response.status_code, response.headers
+            if status != 200 or (declared_length(upstream_headers) or 0) > config.INLINE_MAX_BYTES:
+                return None
+            raw_body = response.raw.read(config.INLINE_MAX_BYTES + 1, decode_content=False)
+            if len(raw_body) > config.INLINE_MAX_BYTES:
+                return None
+            if config.RESOURCE_CACHE_ENABLED:
+                resource_cache.store(url, headers, status, upstream_headers, raw_body)
+        finally:
+            response.close()
+    if status != 200:
+        return None
+
+    content_type = (upstream_headers.get('Content-Type') or '').split(';', 1)[0].strip().lower()
+    if kind == STYLESHEET:
+        if content_type != 'text/css':
+            return None
+        body = rewritten_stylesheet(url, raw_body, upstream_headers)
+    elif content_type.startswith('image/'):
+        coding = content_coding(upstream_headers)
+        body = raw_body if coding == 'identity' else decompress(raw_body, coding)
+    else:
+        return None
+    if body is None or len(body) > config.INLINE_MAX_BYTES:
+        return None
+    return content_type, body
+
+# Tiny images and stylesheets embedded in rewritten pages
+inliner = Inliner(
+    fetch=inline_resource,
+    workers=config.INLINE_WORKERS,
+    max_per_page=config.INLINE_MAX_PER_PAGE,
+    page_budget=config.INLINE_PAGE_BUDGET_BYTES,
+    deadline=config.INLINE_DEADLINE,
+)
+
+def start_prefetch(client, subresources):
+    """
+    Prefetch a page's subresources on behalf of ``client``, replacing the
+    batch of the page it was on before
+    """
+    if config.PREFETCH_ENABLED and config.RESOURCE_CACHE_ENABLED:
+        prefetcher.start(client, subresources)
 
 @app.route('/proxy-resource')
 def proxy_resource():
@@ -612,56 +1288,148 @@ def proxy_resource():
     try:
         # Ensure HTTPS
         url = ensure_https(url)
-        logger.info(f"Proxying resource: {url}")
-        
-        # Check if this is a YouTube resource
-        parsed_url = urllib.parse.urlparse(url)
-        domain = parsed_url.netloc
-        is_youtube = any(domain.endswith(yt_domain) for yt_domain in YOUTUBE_DOMAINS)
+        accesslog.note_host(url)
+        diag(logger, "Proxying resource: %s", url)
         
         # Check for Range header to support video seeking
-        headers = BROWSER_HEADERS.copy()
-        if is_youtube:
-            headers['Referer'] = 'https://www.youtube.com/'
-            headers['Origin'] = 'https://www.youtube.com'
-            
+        headers = resource_request_headers(url)
         range_header = request.headers.get('Range')
         if range_header:
             headers['Range'] = range_header
         
-        # Make request
-        response = requests.get(url, headers=headers, stream=True, timeout=15)
+        # Videos already in the segment cache are assembled from their disk blocks
+        if config.VIDEO_CACHE_ENABLED:
+            meta = segment_cache.lookup(url)
+            if meta is not None:
+                segmented = segmented_video_response(url, headers, meta, range_header)
+                if segmented is not None:
+                    accesslog.note('cache', 'segments')
+                    return segmented
         
-        # Extract content type 
-        content_type = response.headers.get('Content-Type', 'application/octet-stream')
+        # Serve fresh copies straight from the cache (ranged requests always go upstream)
+        use_cache = config.RESOURCE_CACHE_ENABLED and not range_header
+        cached = resource_cache.lookup(url, headers, allow_stale=True) if use_cache else None
+        if cached is not None and cached.is_fresh():
+            accesslog.note('cache', 'fresh')
+            return cached_resource_response(cached)
         
-        # Handle video content by streaming
-        if any(video_type in content_type for video_type in VIDEO_CONTENT_TYPES):
-            response_headers = {}
-            for key, value in response.headers.items():
-                if key.lower() in ['content-type', 'content-length', 'accept-ranges', 'content-range',
-                                  'cache-control', 'expires', 'etag', 'last-modified']:
-                    response_headers[key] = value
-            
-            return Response(
-                stream_with_context(response.iter_content(chunk_size=1024)),
-                headers=response_headers,
-                status=response.status_code
-            )
+        upstream_headers = headers.copy()
+        if cached is not None:
+            # Revalidate our stale copy with its stored validators
+            upstream_headers.update(cached.conditional_headers())
+        else:
+            # Nothing cached: pass the browser's own validators through
+            for name in CONDITIONAL_HEADERS:
+                if request.headers.get(name):
+                    upstream_headers[name] = request.headers[name]
+        
+        # Make request, sharing the response of an identical one already in flight
+        with accesslog.phase('upstream'):
+            response = upstream.get(url, headers=upstream_headers, stream=True,
+                                    timeout=request_timeout(config.UPSTREAM_RESOURCE_TIMEOUT), coalesce=True)
+        
+        if response.status_code == 304:
+            response.close()
+            if cached is not None:
+                accesslog.note('cache', 'revalidated')
+                return cached_resource_response(resource_cache.refresh(cached, headers, response.headers))
+            return '', 304, validator_headers(response.headers)
         
-        # Handle normal resources
-        return response.content, 200, {'Content-Type': content_type}
+        # Stylesheets are rewritten so their references stay inside the proxy;
+        # the cache keeps the origin's bytes and the rewrite is cached separately
+        if (config.REWRITE_STYLESHEETS and response.status_code == 200 and is_stylesheet(response.headers)
+                and (declared_length(response.headers) or 0) <= config.RESOURCE_STREAM_BUFFER_BYTES):
+            with accesslog.phase('transfer'):
+                raw_body = response.raw.read(decode_content=False)
+            accesslog.add_bytes_in(len(raw_body))
+            response.close()
+            if use_cache:
+                resource_cache.store(url, headers, response.status_code, response.headers, raw_body)
+            stylesheet = stylesheet_response(url, raw_body, response.headers, request.headers)
+            if stylesheet is not None:
+                return stylesheet[0], 200, stylesheet[1]
+            return raw_body, 200, relay_headers(response.headers, passthrough=True)
+        
+        # Relay the body as it arrives, still compressed if the browser accepts
+        # the origin's coding. Video is never cached, anything else is kept
+        # aside for the cache only while it fits the buffer (and only in the
+        # coding the origin sent, which is how the cache stores it).
+        content_type = response.headers.get('Content-Type', 'application/octet-stream')
+        is_video = any(video_type in content_type for video_type in VIDEO_CONTENT_TYPES)
+        coding = content_coding(response.headers)
+        passthrough = coding != 'identity' and accepts(request.headers.get('Accept-Encoding'), coding)
+        cacheable = use_cache and not is_video and (passthrough or coding == 'identity')
+        buffer_limit = cache_buffer_limit(response.headers) if cacheable else 0
+        writer = None
+        if is_video and config.VIDEO_CACHE_ENABLED:
+            registered = segment_cache.register(url, response.status_code, response.headers)
+            if registered is not None:
+                writer = segment_cache.writer(*registered)
+        body = relay_resource(response, url, headers, buffer_limit, writer, passthrough)
+        compress = should_compress_relay(response.status_code, response.headers, request.headers.get('Accept-Encoding'))
+        if compress:
+            body = gzip_stream(body, config.COMPRESSION_LEVEL)
+        return Response(
+            stream_with_context(body),
+            headers=relay_headers(response.headers, passthrough, compress),
+            status=response.status_code
+        )
         
+    except UpstreamUnavailable as e:
+        accesslog.note_error(e)
+        return jsonify({"error": str(e)}), 503, {'Retry-After': str(e.retry_after)}
     except Exception as e:
+        accesslog.note_error(e)
         logger.error(f"Error proxying resource {url}: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """
+    Request, phase and upstream metrics in the Prometheus text format
+    """
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def status_payload(mode, upstream_stats):
+    """
+    The /status body, shared by the Flask and asyncio apps so both report
+    the same sections; ``upstream_stats`` describes the app's own client
+    """
+    return {
+        "status": "online",
+        "mode": mode,
+        "upstream": upstream_stats,
+        "resource_cache": resource_cache.stats(),
+        "stylesheet_cache": stylesheet_cache.stats(),
+        "prefetch": prefetcher.stats(),
+        "inline": inliner.stats(),
+        "segment_cache": segment_cache.stats(),
+        "document_cache": document_cache.stats(),
+        "routing": router.stats(),
+        "urls": memo_stats(),
+        "logging": accesslog.stats(),
+        "profiling": profiler.stats(),
+        "upstream_guard": guard.stats(),
+        "coalescing": flights.stats(),
+        "parse_budget": parse_budget.stats(),
+    }
+
 @app.route('/status')
 def status():
     """
-    Simple status endpoint to check if the server is running
+    Simple status endpoint to check if the server is running, with upstream pool and cache stats
     """
-    return jsonify({"status": "online"})
+    return jsonify(status_payload('flask', upstream.stats()))
+
+@router.route('/results')
+def route_youtube_results(method, args, form):
+    search_query = args.get('search_query')
+    if search_query:
+        youtube_search_url = f"https://www.youtube.com/results?search_query={urllib.parse.quote(search_query)}"
+        diag(logger, "Routing YouTube result to: %s", youtube_search_url)
+        return ('redirect', proxy_url(youtube_search_url))
+    else:
+        return ('error', "Missing search query parameter", 400)
 
 @app.route('/results')
 def youtube_results():
@@ -669,13 +1437,16 @@ def youtube_results():
     Special handler for YouTube search results - 
     catches requests when YouTube forms submit directly to /results
     """
-    search_query = request.args.get('search_query')
-    if search_query:
-        youtube_search_url = f"https://www.youtube.com/results?search_query={urllib.parse.quote(search_query)}"
-        logger.info(f"Redirecting YouTube result to: {youtube_search_url}")
-        return redirect(f"/proxy?url={urllib.parse.quote(youtube_search_url)}")
+    return serve_route('/results')
+
+@router.route('/watch')
+def route_youtube_watch(method, args, form):
+    video_id = args.get('v')
+    if video_id:
+        diag(logger, "Routing YouTube watch to video ID: %s", video_id)
+        return ('redirect', f"/youtube?v={video_id}")
     else:
-        return jsonify({"error": "Missing search query parameter"}), 400
+        return ('error', "Missing video ID parameter", 400)
 
 @app.route('/watch')
 def youtube_watch():
@@ -683,32 +1454,30 @@ def youtube_watch():
     Special handler for YouTube watch URLs - 
     handles direct access to /watch?v=VIDEO_ID pattern
     """
-    video_id = request.args.get('v')
-    if video_id:
-        logger.info(f"Redirecting YouTube watch to video ID: {video_id}")
-        return redirect(f"/youtube?v={video_id}")
-    else:
-        return jsonify({"error": "Missing video ID parameter"}), 400
+    return serve_route('/watch')
 
-@app.route('/<path:youtube_path>')
-def youtube_catchall(youtube_path):
-    """
-    Catch-all handler for various YouTube paths that might be directly accessed
-    """
-    logger.info(f"Catching YouTube path: {youtube_path}")
-    
+@router.fallback
+def route_youtube_path(youtube_path, method, args, form):
     # Check if it's likely a YouTube path
     if youtube_path in ['channel', 'user', 'c', 'playlist', 'feed', 'gaming', 'watch']:
         # Reconstruct the full YouTube URL with query parameters
-        query_string = request.query_string.decode('utf-8')
+        query_string = urlencode(list(args.items(multi=True)))
         youtube_url = f"https://www.youtube.com/{youtube_path}"
         if query_string:
             youtube_url += f"?{query_string}"
             
-        return redirect(f"/proxy?url={urllib.parse.quote(youtube_url)}")
+        return ('redirect', proxy_url(youtube_url))
     
     # Handle other paths or return 404
-    return jsonify({"error": f"Path not found: {youtube_path}"}), 404
+    return ('error', f"Path not found: {youtube_path}", 404)
+
+@app.route('/<path:youtube_path>')
+def youtube_catchall(youtube_path):
+    """
+    Catch-all handler for various YouTube paths that might be directly accessed
+    """
+    diag(logger, "Catching YouTube path: %s", youtube_path)
+    return serve_route(f"/{youtube_path}")
 
 def add_navigation_script(html, base_url):
     """
@@ -785,172 +1554,53 @@ def get_base_url(url):
         return f"{parts[0]}//{parts[2]}"
     return url
 
-def process_links(soup, base_url):
+# Small page run through the parser and rewriter at boot
+WARM_UP_PAGE = (
+    '<!DOCTYPE html><html><head><meta charset="utf-8"><link rel="stylesheet" href="/s.css">'
+    '<style>body{background:url(/b.png)}</style></head><body><a href="https://www.google.com/">g</a>'
+    '<a href="//www.youtube.com/watch?v=dQw4w9WgXcQ">y</a><form action="/search"><input name="q"></form>'
+    '<img src="/i.png"><script src="/a.js"></script></body></html>'
+)
+
+def warm_origin(origin):
+    """Open a keep-alive connection to ``origin``; True if it answered"""
+    try:
+        response = upstream.request('HEAD', origin, headers=BROWSER_HEADERS, timeout=config.WARM_TIMEOUT,
+                                    allow_redirects=False)
+        response.close()
+        return True
+    except Exception as e:
+        logger.warning(f"Warm-up connection to {origin} failed: {str(e)}")
+        return False
+
+def warm_rewriters():
     """
-    Process all links in the HTML to ensure they work through our proxy
+    Run a page and a stylesheet through the rewriters so lazy imports,
+    compiled patterns and the URL memo are in place before the first request
     """
-    # Process anchor tags
-    for a_tag in soup.find_all('a', href=True):
-        try:
-            href = a_tag['href']
-            if href.startswith('#'):
-                # Skip anchors
-                continue
-                
-            if href.startswith('javascript:'):
-                # Skip JavaScript links
-                continue
-                
-            # Make relative URLs absolute
-            if not href.startswith(('http://', 'https://')):
-                if href.startswith('/'):
-                    # Absolute path relative to domain
-                    parsed_base = urllib.parse.urlparse(base_url)
-                    href = f"{parsed_base.scheme}://{parsed_base.netloc}{href}"
-                else:
-                    # Relative path
-                    href = urllib.parse.urljoin(base_url, href)
-                    
-            # Update href to use our proxy
-            a_tag['href'] = f"/proxy?url={urllib.parse.quote(href)}"
-            
-            # Store original URL as data attribute
-            a_tag['data-original-url'] = href
-        except Exception as e:
-            logger.error(f"Error processing link: {e}")
-            
-    # Process forms
-    for form in soup.find_all('form', action=True):
-        try:
-            action = form['action']
-            
-            # Skip empty actions (submits to same page)
-            if not action:
-                continue
-                
-            # Make relative URLs absolute
-            if not action.startswith(('http://', 'https://')):
-                if action.startswith('/'):
-                    # Absolute path relative to domain
-                    parsed_base = urllib.parse.urlparse(base_url)
-                    action = f"{parsed_base.scheme}://{parsed_base.netloc}{action}"
-                else:
-                    # Relative path
-                    action = urllib.parse.urljoin(base_url, action)
-                    
-            # Update action to use our proxy
-            form['action'] = f"/proxy?url={quote_plus(action)}"
-            
-            # Store original URL as data attribute
-            form['data-original-action'] = action
-        except Exception as e:
-            logger.error(f"Error processing form: {e}")
-            
-    return str(soup)
+    render_document('https://www.google.com/', WARM_UP_PAGE.encode('utf-8'), inline=False)
+    rewrite_css('.a{background:url(/b.png)}@import "c.css";',
+                lambda ref: proxy_resource_url(absolute_url('https://www.google.com/s.css', ref)))
+    gzip_bytes(WARM_UP_PAGE.encode('utf-8'), config.COMPRESSION_LEVEL)
 
-def process_resources(soup, base_url, is_youtube=False):
+def warm_up():
     """
-    Process resources like images, scripts, and stylesheets
+    Prepare a freshly started worker: connect to the usual origins (DNS,
+    TCP and TLS are paid once, the connections stay in the pools) while the
+    rewriters are warmed
     """
-    # Process images
-    for img in soup.find_all('img', src=True):
-        src = img['src']
-        if not src.startswith('data:') and not src.startswith('http'):
-            if src.startswith('/'):
-                src = f"{base_url}{src}"
-            else:
-                src = f"{base_url}/{src}"
-        if not src.startswith('data:'):
-            img['src'] = f"/proxy-resource?url={urllib.parse.quote(src)}"
-    
-    # Process video sources
-    for video in soup.find_all('video'):
-        # Process src attribute if present
-        if video.has_attr('src'):
-            src = video['src']
-            if not src.startswith('data:') and not src.startswith('http'):
-                if src.startswith('/'):
-                    src = f"{base_url}{src}"
-                else:
-                    src = f"{base_url}/{src}"
-            video['src'] = f"/proxy-resource?url={urllib.parse.quote(src)}"
-        
-        # Process source elements within video
-        for source in video.find_all('source', src=True):
-            src = source['src']
-            if not src.startswith('data:') and not src.startswith('http'):
-                if src.startswith('/'):
-                    src = f"{base_url}{src}"
-                else:
-                    src = f"{base_url}/{src}"
-            source['src'] = f"/proxy-resource?url={urllib.parse.quote(src)}"
-    
-    # Process scripts - for YouTube we need to leave certain scripts intact
-    for script in soup.find_all('script', src=True):
-        src = script['src']
-        if not src.startswith('http'):
-            if src.startswith('/'):
-                src = f"{base_url}{src}"
-            else:
-                src = f"{base_url}/{src}"
-        
-        # YouTube special handling
-        if is_youtube and ('www.youtube.com' in src or 'youtube.com' in src or 's.ytimg.com' in src):
-            # Leave YouTube API scripts unchanged to allow player to work
-            continue
-        
-        script['src'] = f"/proxy-resource?url={urllib.parse.quote(src)}"
-    
-    # Process iframe sources
-    for iframe in soup.find_all('iframe', src=True):
-        src = iframe['src']
-        if not src.startswith('http'):
-            if src.startswith('/'):
-                src = f"{base_url}{src}"
-            else:
-                src = f"{base_url}/{src}"
-        
-        # YouTube special handling for embedded videos
-        if is_youtube and ('www.youtube.com/embed/' in src or 'youtube.com/embed/' in src):
-            # Extract video ID from embed URL
-            match = re.search(r'youtube\.com/embed/([a-zA-Z0-9_-]{11})', src)
-            if match:
-                video_id = match.group(1)
-                iframe['src'] = f"/youtube?v={video_id}"
-            continue
-        
-        iframe['src'] = f"/proxy?url={urllib.parse.quote(src)}"
-    
-    # Process stylesheets
-    for link in soup.find_all('link', rel="stylesheet", href=True):
-        href = link['href']
-        if not href.startswith('http'):
-            if href.startswith('/'):
-                href = f"{base_url}{href}"
-            else:
-                href = f"{base_url}/{href}"
-        link['href'] = f"/proxy-resource?url={urllib.parse.quote(href)}"
-    
-    # Process style background images
-    for style in soup.find_all('style'):
-        if style.string:
-            # Use regex to find url() patterns in CSS
-            urls = re.findall(r'url\([\'"]?([^\'")]+)[\'"]?\)', style.string)
-            for url in urls:
-                if not url.startswith('data:'):
-                    if not url.startswith('http'):
-                        if url.startswith('/'):
-                            full_url = f"{base_url}{url}"
-                        else:
-                            full_url = f"{base_url}/{url}"
-                    else:
-                        full_url = url
-                    
-                    # Replace the URL in the style
-                    style.string = style.string.replace(
-                        f'url({url})', 
-                        f'url(/proxy-resource?url={urllib.parse.quote(full_url)})'
-                    )
+    started = time.perf_counter()
+    threads = [threading.Thread(target=warm_origin, args=(origin,), daemon=True) for origin in config.WARM_ORIGINS]
+    for thread in threads:
+        thread.start()
+    warm_rewriters()
+    deadline = time.monotonic() + config.WARM_TIMEOUT
+    for thread in threads:
+        thread.join(max(deadline - time.monotonic(), 0))
+    logger.info(f"Warm-up finished in {(time.perf_counter() - started) * 1000:.0f} ms, "
+                f"{upstream.stats()['open_pools']} upstream pools open")
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000) 
\ No newline at end of file
+    if config.WARM_UP and not config.DEBUG:
+        warm_up()
+    app.run(debug=config.DEBUG, host=config.HOST, port=config.PORT, threaded=True) 
\ No newline at end of file
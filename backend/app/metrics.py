@@ -0,0 +1,213 @@
+"""
+In-process metrics in the Prometheus text exposition format.
+
+Counters, gauges and histograms are kept per label set behind one lock
+each and rendered by ``render`` for the ``/metrics`` endpoint. Request
+metrics are fed from finished access records (see ``accesslog``): total
+latency and each phase per route, time to upstream headers and connect time
+per upstream host, bytes in and out, in-flight requests, error classes and
+requests coalesced onto another request's upstream fetch, and markup removed
+from pages by lite mode.
+
+Upstream hosts are an open-ended label, so only the first
+``config.METRICS_MAX_HOSTS`` distinct hosts get their own series; the rest
+are reported as ``other``.
+"""
+import bisect
+import threading
+
+import config
+
+# Latency buckets, seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+OTHER_HOST = 'other'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = self.header()
+        lines.extend(f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}" for labels, value in values)
+        return lines
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                # Per-bucket counts (plus +Inf), sum
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        lines = self.header()
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, [('le', _number(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {round(total, 6)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+requests_total = registry.register(Counter(
+    'berry_requests_total', 'Requests served, by route and status', ('route', 'status')))
+request_duration = registry.register(Histogram(
+    'berry_request_duration_seconds', 'Time from request start to response close, by route', ('route',)))
+phase_duration = registry.register(Histogram(
+    'berry_phase_duration_seconds', 'Time spent in each request phase, by route', ('route', 'phase')))
+upstream_duration = registry.register(Histogram(
+    'berry_upstream_duration_seconds', 'Time to upstream response headers (connect included), by host', ('host',)))
+connect_duration = registry.register(Histogram(
+    'berry_upstream_connect_duration_seconds', 'DNS, TCP and TLS time of new upstream connections, by host', ('host',)))
+bytes_out = registry.register(Counter(
+    'berry_response_bytes_total', 'Bytes sent to browsers, by route', ('route',)))
+bytes_in = registry.register(Counter(
+    'berry_upstream_bytes_total', 'Body bytes received from origins, by route', ('route',)))
+in_flight = registry.register(Gauge(
+    'berry_in_flight_requests', 'Requests currently being served, by route', ('route',)))
+errors_total = registry.register(Counter(
+    'berry_errors_total', 'Failed requests, by route and error class', ('route', 'error')))
+coalesced_total = registry.register(Counter(
+    'berry_coalesced_requests_total', 'Requests that shared an identical upstream fetch in flight, by route', ('route',)))
+lite_removed_bytes = registry.register(Counter(
+    'berry_lite_removed_bytes_total', 'Markup removed from pages served in lite mode, by route', ('route',)))
+
+_hosts = set()
+_hosts_lock = threading.Lock()
+
+
+def host_label(host):
+    """``host``, or ``other`` once the per-host series budget is used up"""
+    if not host:
+        return OTHER_HOST
+    with _hosts_lock:
+        if host in _hosts:
+            return host
+        if len(_hosts) < config.METRICS_MAX_HOSTS:
+            _hosts.add(host)
+            return host
+    return OTHER_HOST
+
+
+def error_class(exc):
+    """Coarse class of an exception raised while serving a request"""
+    declared = getattr(exc, 'error_class', None)
+    if declared:
+        return declared
+    name = type(exc).__name__.lower()
+    if 'timeout' in name:
+        return 'upstream_timeout'
+    if 'ssl' in name or 'certificate' in name:
+        return 'upstream_tls'
+    if 'connect' in name or 'dns' in name or isinstance(exc, ConnectionError):
+        return 'upstream_connect'
+    return 'internal'
+
+
+def observe_request(record):
+    """Fold a finished ``AccessRecord`` into the request metrics"""
+    route = (record.route,)
+    requests_total.inc((record.route, str(record.status)))
+    if record.elapsed is not None:
+        request_duration.observe(record.elapsed, route)
+    for name, ms in record.phases.items():
+        phase_duration.observe(ms / 1000, (record.route, name))
+    host = (host_label(record.host),)
+    if 'upstream' in record.phases:
+        upstream_duration.observe(record.phases['upstream'] / 1000, host)
+    if 'connect' in record.phases:
+        connect_duration.observe(record.phases['connect'] / 1000, host)
+    if record.bytes:
+        bytes_out.inc(route, record.bytes)
+    if record.bytes_in:
+        bytes_in.inc(route, record.bytes_in)
+    if record.fields.get('coalesced'):
+        coalesced_total.inc(route)
+    lite = record.fields.get('lite')
+    if lite:
+        lite_removed_bytes.inc(route, lite['saved_bytes'])
+    if record.error is not None:
+        errors_total.inc((record.route, record.error))
+    elif record.status is not None and record.status >= 500:
+        errors_total.inc((record.route, 'http_5xx'))
+
+
+def render():
+    return registry.render()
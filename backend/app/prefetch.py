@@ -0,0 +1,220 @@
+"""
+Background prefetch of the subresources a rewritten page references.
+
+When a page is rewritten, its stylesheets, scripts and images are known
+before the browser asks for them. ``Prefetcher`` warms the resource cache
+for those URLs on a small pool of worker threads while the page is on its
+way to the client, so the follow-up ``/proxy-resource`` requests are served
+from memory.
+
+Work is bounded three ways: a global worker count, a per-page limit on
+URLs and on concurrent fetches, and a cap on queued fetches. Lower
+priority numbers (render-blocking CSS, then JS) run first across all pages.
+A page view's batch is cancelled as soon as the browser navigates away from
+it (see ``PrefetchClient``).
+"""
+import heapq
+import itertools
+import logging
+import re
+import secrets
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from urls import ensure_https, normalize_url
+
+logger = logging.getLogger(__name__)
+
+# Fetch order; lower runs first
+PRIORITY_STYLESHEET = 0
+PRIORITY_SCRIPT = 1
+PRIORITY_IMAGE = 2
+
+# Cookie telling browsers apart, however many share one address
+CLIENT_COOKIE = 'berry_client'
+_CLIENT_ID_RE = re.compile(r'[A-Za-z0-9_-]{16,64}')
+
+
+class PrefetchClient:
+    """
+    The page view a batch belongs to: a browser, told apart by the
+    ``CLIENT_COOKIE`` it is given, and the page it shows. Browsers behind one
+    address (NAT, a reverse proxy) and the tabs of one browser keep their
+    own batches; a navigation cancels only the batch of the page it leaves,
+    named by its Referer.
+    """
+
+    __slots__ = ('id', 'new', 'key')
+
+    def __init__(self, cookie, page_url):
+        self.new = not (cookie and _CLIENT_ID_RE.fullmatch(cookie))
+        self.id = secrets.token_urlsafe(16) if self.new else cookie
+        self.key = self._key(page_url)
+
+    def _key(self, page_url):
+        return f"{self.id} {normalize_url(page_url)}"
+
+    def leaving(self, referer):
+        """Key of the batch of the page a navigation leaves, or None when it did not come from /proxy"""
+        if self.new or not referer:
+            return None
+        parts = urlsplit(referer)
+        targets = parse_qs(parts.query).get('url') if parts.path == '/proxy' else None
+        return self._key(ensure_https(targets[0])) if targets else None
+
+    def set_cookie(self):
+        """``Set-Cookie`` value for a browser seen for the first time"""
+        return f"{CLIENT_COOKIE}={self.id}; Path=/; HttpOnly; SameSite=Lax"
+
+
+class PrefetchBatch:
+    """The subresources of one page view, released to the queue a few at a time"""
+
+    def __init__(self, client, jobs, deadline):
+        self.client = client
+        self.pending = jobs
+        self.deadline = deadline
+        self.active = 0
+        self.cancelled = False
+
+    def expired(self, now=None):
+        return self.cancelled or (time.time() if now is None else now) >= self.deadline
+
+
+class Prefetcher:
+    """
+    Bounded background fetcher. ``fetch(url)`` is called on a worker thread
+    and returns True if it went to the origin, False if the URL was already
+    cached.
+    """
+
+    def __init__(self, fetch, workers, max_per_page, page_concurrency, max_queued, timeout):
+        self.fetch = fetch
+        self.workers = workers
+        self.max_per_page = max_per_page
+        self.page_concurrency = page_concurrency
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self._queue = []
+        self._sequence = itertools.count()
+        self._batches = {}
+        self._in_flight = set()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self.submitted = 0
+        self.fetched = 0
+        self.already_cached = 0
+        self.cancelled = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self, client, resources):
+        """
+        Prefetch ``resources`` (``(priority, url)`` pairs) for ``client``,
+        cancelling whatever was still pending for its previous page
+        """
+        seen = set()
+        jobs = []
+        for priority, url in sorted(resources, key=lambda item: item[0]):
+            if url in seen:
+                continue
+            seen.add(url)
+            jobs.append((priority, url))
+            if len(jobs) >= self.max_per_page:
+                break
+
+        with self._lock:
+            self._cancel(client)
+            if not jobs:
+                return None
+            self._ensure_workers()
+            batch = PrefetchBatch(client, jobs, time.time() + self.timeout)
+            self._batches[client] = batch
+            self.submitted += len(jobs)
+            self._release(batch)
+            return batch
+
+    def cancel(self, client):
+        with self._lock:
+            self._cancel(client)
+
+    def _cancel(self, client):
+        batch = self._batches.pop(client, None)
+        if batch is not None and not batch.cancelled:
+            batch.cancelled = True
+            self.cancelled += len(batch.pending)
+            batch.pending = []
+
+    def _ensure_workers(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name=f"prefetch-{len(self._threads)}", daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def _release(self, batch):
+        """Move the batch's next jobs onto the shared queue, within its concurrency cap"""
+        while batch.pending and batch.active < self.page_concurrency and not batch.cancelled:
+            if len(self._queue) >= self.max_queued:
+                self.dropped += len(batch.pending)
+                batch.pending = []
+                break
+            priority, url = batch.pending.pop(0)
+            heapq.heappush(self._queue, (priority, next(self._sequence), url, batch))
+            batch.active += 1
+            self._ready.notify()
+        if not batch.pending and not batch.active and self._batches.get(batch.client) is batch:
+            del self._batches[batch.client]
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while not self._queue:
+                    self._ready.wait()
+                _, _, url, batch = heapq.heappop(self._queue)
+                if batch.expired():
+                    self.cancelled += 1
+                    run = False
+                elif url in self._in_flight:
+                    # Another page is already fetching it
+                    self.already_cached += 1
+                    run = False
+                else:
+                    self._in_flight.add(url)
+                    run = True
+
+            fetched = failed = False
+            if run:
+                try:
+                    fetched = self.fetch(url)
+                except Exception as e:
+                    logger.info(f"Prefetch of {url} failed: {str(e)}")
+                    failed = True
+
+            with self._lock:
+                if run:
+                    self._in_flight.discard(url)
+                    if failed:
+                        self.failed += 1
+                    elif fetched:
+                        self.fetched += 1
+                    else:
+                        self.already_cached += 1
+                batch.active -= 1
+                self._release(batch)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queued': len(self._queue),
+                'in_flight': len(self._in_flight),
+                'pages': len(self._batches),
+                'submitted': self.submitted,
+                'fetched': self.fetched,
+                'already_cached': self.already_cached,
+                'cancelled': self.cancelled,
+                'dropped': self.dropped,
+                'failed': self.failed,
+            }
@@ -0,0 +1,308 @@
+"""
+Opt-in profiling of single requests.
+
+With ``config.PROFILE_ENABLED`` set, a request that carries the
+``X-Berry-Profile`` header (or the ``berry_profile`` query flag) with the
+configured token is profiled from the moment it is routed until its
+response is closed. Two profilers are available:
+
+``sample``
+    A background thread records the stacks of the request's threads every
+    ``config.PROFILE_INTERVAL`` seconds. The overhead is low and the
+    result is wall-clock time, so waits on the origin show up too.
+``trace``
+    ``sys.setprofile`` charges the time between profiler events to the
+    running stack. It is exact, but every Python and C call is slowed down.
+
+Each profile writes ``<name>.collapsed``, one ``frame;frame;... weight``
+line per stack (the input of ``flamegraph.pl`` and speedscope), and
+``<name>.txt``, the top ``config.PROFILE_TOP_N`` functions by self and
+by inclusive time, to ``config.PROFILE_DIR``.
+
+Under asyncio, the event loop thread runs other requests while this one
+waits, and their frames land in the profile as well. Rewrite threads are
+attached only while they work for the profiled request (see ``call``).
+"""
+import contextlib
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from contextvars import ContextVar
+
+import config
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'X-Berry-Profile'
+QUERY_FLAG = 'berry_profile'
+
+_current = ContextVar('berry_profile', default=None)
+_unsafe_name_re = re.compile(r'[^A-Za-z0-9._-]+')
+
+
+def _frame_label(code):
+    # ';' separates frames in the collapsed format
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ':')
+
+
+def _stack(frame):
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame.f_code))
+        frame = frame.f_back
+    labels.reverse()
+    return tuple(labels)
+
+
+class _Tracer:
+    """``sys.setprofile`` hook for one thread, charging time to the running stack"""
+
+    def __init__(self, frame):
+        # Kept per thread and merged into the profile on detach, so the
+        # hook never takes a lock
+        self.stacks = {}
+        self.labels = list(_stack(frame))
+        # Code object of each entry, None for builtins
+        self.codes = []
+        while frame is not None:
+            self.codes.append(frame.f_code)
+            frame = frame.f_back
+        self.codes.reverse()
+        self.last = time.perf_counter()
+
+    def __call__(self, frame, event, arg):
+        stack = tuple(self.labels)
+        self.stacks[stack] = self.stacks.get(stack, 0) + (time.perf_counter() - self.last) * 1e6
+        if event == 'call':
+            self.labels.append(_frame_label(frame.f_code))
+            self.codes.append(frame.f_code)
+        elif event == 'c_call':
+            self.labels.append(f"{getattr(arg, '__qualname__', arg)} (builtin)".replace(';', ':'))
+            self.codes.append(None)
+        elif event == 'return':
+            # Unwind to the returning frame; frames that started before
+            # tracing may be missing
+            if frame.f_code in self.codes:
+                while self.codes and self.codes.pop() is not frame.f_code:
+                    self.labels.pop()
+                self.labels.pop()
+        elif self.codes and self.codes[-1] is None:
+            # c_return, c_exception
+            self.codes.pop()
+            self.labels.pop()
+        self.last = time.perf_counter()
+
+
+class Profile:
+    """Stacks recorded for one request, keyed by frame tuple"""
+
+    def __init__(self, name, description, mode):
+        self.name = name
+        self.description = description
+        self.mode = mode
+        self.stacks = {}
+        self.started = time.perf_counter()
+        self.elapsed = None
+        self._threads = {}
+        self._tracers = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+        if mode == 'sample':
+            self._sampler = threading.Thread(target=self._sample, name=f'profile-{name}', daemon=True)
+            self._sampler.start()
+
+    def add(self, stack, weight):
+        with self._lock:
+            self.stacks[stack] = self.stacks.get(stack, 0) + weight
+
+    def _sample(self):
+        while not self._stop.wait(config.PROFILE_INTERVAL):
+            frames = sys._current_frames()
+            with self._lock:
+                threads = list(self._threads)
+            for ident in threads:
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.add(_stack(frame), 1)
+
+    def attach(self):
+        """Start recording the calling thread; returns a token for ``detach``"""
+        ident = threading.get_ident()
+        with self._lock:
+            depth = self._threads.get(ident, 0)
+            self._threads[ident] = depth + 1
+        if self.mode == 'trace' and depth == 0 and sys.getprofile() is None:
+            # A thread has one hook; a profile already tracing it keeps it
+            self._tracers[ident] = _Tracer(sys._getframe(0))
+            sys.setprofile(self._tracers[ident])
+        return ident
+
+    def detach(self, ident):
+        if self._threads.get(ident) == 1 and ident in self._tracers:
+            tracer = self._tracers.pop(ident)
+            sys.setprofile(None)
+            for stack, weight in tracer.stacks.items():
+                self.add(stack, weight)
+        with self._lock:
+            depth = self._threads.get(ident, 0) - 1
+            if depth > 0:
+                self._threads[ident] = depth
+            else:
+                self._threads.pop(ident, None)
+
+    def stop(self):
+        self.elapsed = time.perf_counter() - self.started
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+    def collapsed(self):
+        weight = round if self.mode == 'trace' else int
+        lines = [f"{';'.join(stack)} {weight(value)}" for stack, value in sorted(self.stacks.items()) if stack]
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, top_n):
+        own = {}
+        inclusive = {}
+        total = 0
+        for stack, value in self.stacks.items():
+            if not stack:
+                continue
+            total += value
+            own[stack[-1]] = own.get(stack[-1], 0) + value
+            # Recursion must not count a frame twice
+            for label in set(stack):
+                inclusive[label] = inclusive.get(label, 0) + value
+        unit = 'us' if self.mode == 'trace' else 'samples'
+        lines = [
+            f"{self.description}",
+            f"mode: {self.mode}, elapsed: {self.elapsed * 1000:.1f} ms, total: {round(total)} {unit}, "
+            f"stacks: {len(self.stacks)}",
+        ]
+        for title, table in (('self', own), ('inclusive', inclusive)):
+            lines.append('')
+            lines.append(f"Top {top_n} by {title} time")
+            lines.append(f"{unit:>12} {'%':>6}  function")
+            for label, value in sorted(table.items(), key=lambda item: item[1], reverse=True)[:top_n]:
+                share = value / total * 100 if total else 0.0
+                lines.append(f"{round(value):>12} {share:>6.1f}  {label}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self, directory, top_n):
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, self.name)
+        with open(f"{base}.collapsed", 'w') as f:
+            f.write(self.collapsed())
+        with open(f"{base}.txt", 'w') as f:
+            f.write(self.summary(top_n))
+        return base
+
+
+class Profiler:
+    """Starts and finishes request profiles, a few at a time"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = 0
+        self._written = 0
+        self._skipped = 0
+        self._failed = 0
+        self._last = None
+
+    def requested(self, headers, args):
+        """Whether a request with these headers and query args asked to be profiled"""
+        if not config.PROFILE_ENABLED:
+            return False
+        value = headers.get(HEADER) or args.get(QUERY_FLAG)
+        if not value:
+            return False
+        return value == config.PROFILE_TOKEN if config.PROFILE_TOKEN else True
+
+    def begin(self, method, path, headers, args):
+        """
+        Profile the rest of the current request from this thread if it asked
+        for it; returns the ``Profile``, or None
+        """
+        profile = self.start(method, path) if self.requested(headers, args) else None
+        # Worker threads are reused, so always replace the previous request's profile
+        _current.set(profile)
+        return profile
+
+    def start(self, method, path):
+        """Start a ``Profile`` on this thread, or return None when too many are running"""
+        with self._lock:
+            if self._active >= config.PROFILE_MAX_CONCURRENT:
+                self._skipped += 1
+                return None
+            self._active += 1
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        name = _unsafe_name_re.sub('_', f"{stamp}-{time.perf_counter_ns() % 1000000:06d}-{method}{path}")[:120]
+        mode = 'trace' if config.PROFILE_MODE == 'trace' else 'sample'
+        profile = Profile(name, f"{method} {path}", mode)
+        profile.attach()
+        return profile
+
+    def finish(self, profile, description=None):
+        """Stop ``profile`` (on the thread that started it) and write its files"""
+        profile.detach(threading.get_ident())
+        profile.stop()
+        _current.set(None)
+        if description:
+            profile.description = description
+        try:
+            base = profile.write(config.PROFILE_DIR, config.PROFILE_TOP_N)
+        except OSError as e:
+            logger.error(f"Error writing profile {profile.name}: {str(e)}")
+            with self._lock:
+                self._active -= 1
+                self._failed += 1
+            return None
+        logger.info(f"Wrote request profile {base}.collapsed ({profile.elapsed * 1000:.1f} ms)")
+        with self._lock:
+            self._active -= 1
+            self._written += 1
+            self._last = profile.name
+        return base
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': config.PROFILE_ENABLED,
+                'mode': config.PROFILE_MODE,
+                'active': self._active,
+                'written': self._written,
+                'skipped': self._skipped,
+                'failed': self._failed,
+                'last': self._last,
+            }
+
+
+profiler = Profiler()
+
+
+def current():
+    return _current.get()
+
+
+@contextlib.contextmanager
+def attached():
+    """Record the calling thread in the current request's profile, if any"""
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    ident = profile.attach()
+    try:
+        yield
+    finally:
+        profile.detach(ident)
+
+
+def call(fn, *args):
+    """Call ``fn`` with the calling thread attached to the current profile"""
+    with attached():
+        return fn(*args)
@@ -0,0 +1,382 @@
+"""
+Single-pass, rule-driven HTML rewrite engine.
+
+Rewrites are registered as rules keyed by tag and attribute. For each page
+the rules that apply to its host are compiled into a lookup table, and the
+document is walked exactly once, so every rewrite costs O(nodes) in total.
+
+Rules for the same tag and attribute run in registration order; a handler
+that returns True stops the remaining handlers for that attribute. Per-host
+special cases are therefore registered before the generic rules they
+override.
+"""
+import functools
+import logging
+import re
+
+from css import rewrite_css, upgrade_insecure
+from html_stream import GOOGLE_SEARCH_SCRIPT
+from lite import CONNECTION_HINTS, DROP_PRELOAD_AS, NAVIGATION_HINTS, PRELOAD_HINTS, is_blocked, loads_blocked
+from prefetch import PRIORITY_IMAGE, PRIORITY_SCRIPT, PRIORITY_STYLESHEET
+from urls import absolute_url, ensure_https, form_target, host_info, link_target, proxy_resource_url, proxy_url
+
+logger = logging.getLogger(__name__)
+
+# Rule groups: 'links' is always applied, 'resources' routes subresources through /proxy-resource,
+# 'lite' trims pages served in lite mode (see ``lite``)
+LINKS = 'links'
+RESOURCES = 'resources'
+LITE = 'lite'
+
+_YOUTUBE_EMBED_RE = re.compile(r'youtube\.com/embed/([a-zA-Z0-9_-]{11})')
+
+
+class Rule:
+    """A rewrite applied to ``attr`` of ``tag`` (``attr=None`` targets the element's text)"""
+
+    __slots__ = ('tag', 'attr', 'handler', 'when', 'group')
+
+    def __init__(self, tag, attr, handler, when=None, group=LINKS):
+        self.tag = tag
+        self.attr = attr
+        self.handler = handler
+        self.when = when
+        self.group = group
+
+
+_RULES = []
+
+
+def rule(tag, attr=None, when=None, group=LINKS):
+    """
+    Register a rewrite rule. ``tag='*'`` matches every element and ``when``
+    restricts the rule to pages whose host class it accepts.
+    """
+    def decorator(handler):
+        _RULES.append(Rule(tag, attr, handler, when, group))
+        return handler
+    return decorator
+
+
+class HostClass:
+    """Host flags that per-host rules are selected on"""
+
+    __slots__ = ('is_google', 'is_youtube')
+
+    def __init__(self, is_google=False, is_youtube=False):
+        self.is_google = is_google
+        self.is_youtube = is_youtube
+
+    @classmethod
+    def for_url(cls, url):
+        info = host_info(url)
+        return cls(is_google=info.is_google, is_youtube=info.is_youtube)
+
+
+@functools.lru_cache(maxsize=16)
+def _compile(is_google, is_youtube, groups):
+    """
+    Build ``{tag: [(attr, handlers), ...]}`` for one host class, with the
+    wildcard rules folded into every tag's entry
+    """
+    host = HostClass(is_google, is_youtube)
+
+    by_tag = {}
+    for r in _RULES:
+        if r.group not in groups or (r.when is not None and not r.when(host)):
+            continue
+        attrs = by_tag.setdefault(r.tag, {})
+        attrs.setdefault(r.attr, []).append(r.handler)
+
+    wildcard = by_tag.pop('*', {})
+    table = {}
+    for tag, attrs in by_tag.items():
+        merged = {attr: list(handlers) for attr, handlers in attrs.items()}
+        for attr, handlers in wildcard.items():
+            merged.setdefault(attr, []).extend(handlers)
+        table[tag] = tuple((attr, tuple(handlers)) for attr, handlers in merged.items())
+    table['*'] = tuple((attr, tuple(handlers)) for attr, handlers in wildcard.items())
+    return table
+
+
+class RewriteContext:
+    """Per-document state shared by rule handlers"""
+
+    def __init__(self, soup, page_url, rewrite_resources=False, lite=False, inline=False):
+        self.soup = soup
+        self.page_url = page_url
+        self.rewrite_resources = rewrite_resources
+        self.host = HostClass.for_url(page_url)
+        self.google_script_added = False
+        # (priority, url) of every subresource routed through /proxy-resource
+        self.subresources = []
+        # (priority, node, url) of the images and stylesheets offered for inlining (see ``inline``)
+        self.inline = inline
+        self.inline_candidates = []
+        # Links out of a lite page stay in lite mode
+        self.link_suffix = '&lite=1' if lite else ''
+        # Elements removed in lite mode and the markup they took up
+        self.removed = 0
+        self.removed_bytes = 0
+
+    def subresource(self, url, priority=None, node=None):
+        """
+        Proxy path for a subresource; ``priority`` marks it for prefetching
+        and ``node`` offers the element referencing it for inlining
+        """
+        url = self.absolute(url)
+        if priority is not None:
+            self.subresources.append((priority, url))
+            if node is not None and self.inline:
+                self.inline_candidates.append((priority, node, url))
+        return proxy_resource_url(url)
+
+    def css_reference(self, reference):
+        """Rewrite a stylesheet reference: HTTPS always, through the proxy when routing resources"""
+        if reference.startswith('data:'):
+            return reference
+        reference = upgrade_insecure(reference)
+        if self.rewrite_resources:
+            return self.subresource(reference, PRIORITY_IMAGE)
+        return reference
+
+    def absolute(self, url):
+        return absolute_url(self.page_url, url)
+
+    def remove(self, node):
+        """Take an element out of the page; rules still running on it see it detached"""
+        self.removed += 1
+        self.removed_bytes += len(str(node))
+        node.extract()
+
+    def ensure_head(self):
+        if self.soup.head:
+            return self.soup.head
+        head = self.soup.new_tag('head')
+        if self.soup.html:
+            self.soup.html.insert(0, head)
+        else:
+            self.soup.insert(0, head)
+        return head
+
+
+def rewrite_document(soup, page_url, rewrite_resources=False, lite=False, inline=False):
+    """
+    Apply every registered rule to ``soup`` in a single walk and inject the
+    CSP meta tag. With ``inline``, the images and stylesheets routed through
+    the proxy are collected in ``ctx.inline_candidates``.
+    """
+    ctx = RewriteContext(soup, page_url, rewrite_resources, lite, inline)
+    groups = frozenset((LINKS,) + ((RESOURCES,) if rewrite_resources else ()) + ((LITE,) if lite else ()))
+    table = _compile(ctx.host.is_google, ctx.host.is_youtube, groups)
+    wildcard = table['*']
+
+    for node in soup.find_all(True):
+        for attr, handlers in table.get(node.name, wildcard):
+            if attr is None:
+                for handler in handlers:
+                    if handler(ctx, node, None):
+                        break
+                continue
+            for handler in handlers:
+                value = node.get(attr)
+                if value is None or handler(ctx, node, value):
+                    break
+
+    # Add a meta tag to enforce HTTPS
+    meta_tag = soup.new_tag('meta')
+    meta_tag['http-equiv'] = 'Content-Security-Policy'
+    meta_tag['content'] = "upgrade-insecure-requests"
+    ctx.ensure_head().insert(0, meta_tag)
+    return ctx
+
+
+# Lite-mode rules. These come first, and remove elements from the attribute
+# the generic rules rewrite, so that removed elements are never rewritten or
+# queued for prefetching (or inlining).
+
+@rule('script', 'src', group=LITE)
+@rule('img', 'src', group=LITE)
+@rule('iframe', 'src', group=LITE)
+def _blocked_source(ctx, node, src):
+    # Tracker scripts, pixels and frames
+    if is_blocked(ctx.absolute(src)):
+        ctx.remove(node)
+        return True
+    return False
+
+
+@rule('script', group=LITE)
+def _tracker_loader(ctx, node, _):
+    # Inline snippets that load a tracker
+    script = node.string
+    if script and node.parent is not None and not node.get('src') and loads_blocked(script):
+        ctx.remove(node)
+
+
+@rule('img', 'src', group=LITE)
+def _tracking_pixel(ctx, node, src):
+    # 1x1 (or hidden 0x0) beacons, whatever host they report to
+    if node.get('width') in ('0', '1') and node.get('height') in ('0', '1'):
+        ctx.remove(node)
+        return True
+    return False
+
+
+@rule('img', group=LITE)
+@rule('iframe', group=LITE)
+def _lazy(ctx, node, _):
+    if node.parent is None:
+        return
+    if 'loading' not in node.attrs:
+        node['loading'] = 'lazy'
+    if node.name == 'img' and 'decoding' not in node.attrs:
+        node['decoding'] = 'async'
+
+
+@rule('link', 'href', group=LITE)
+def _resource_hint(ctx, node, href):
+    rel = {value.lower() for value in node.get('rel', ())}
+    if not rel & (NAVIGATION_HINTS | PRELOAD_HINTS | CONNECTION_HINTS):
+        return False
+    if (rel & NAVIGATION_HINTS
+            or (rel & PRELOAD_HINTS and (node.get('as') or '').lower() in DROP_PRELOAD_AS)
+            or is_blocked(ctx.absolute(href))):
+        ctx.remove(node)
+        return True
+    return False
+
+
+# Host-specific rules. These come first so they can claim an attribute
+# before the generic rules below see it.
+
+@rule('script', 'src', when=lambda host: host.is_youtube, group=RESOURCES)
+def _youtube_script(ctx, node, src):
+    # Leave YouTube API scripts unchanged to allow the player to work
+    src = ctx.absolute(src)
+    return 'youtube.com' in src or 's.ytimg.com' in src
+
+
+@rule('iframe', 'src', when=lambda host: host.is_youtube, group=RESOURCES)
+def _youtube_embed(ctx, node, src):
+    src = ctx.absolute(src)
+    if 'youtube.com/embed/' not in src:
+        return False
+    match = _YOUTUBE_EMBED_RE.search(src)
+    if match:
+        node['src'] = f"/youtube?v={match.group(1)}"
+    return True
+
+
+@rule('form', 'action')
+def _google_search_form(ctx, node, action):
+    if not action:
+        return True
+    action = form_target(ctx.page_url, action)
+    if 'google.com/search' not in action and '/webhp' not in action:
+        return False
+
+    # Submit Google searches to our search endpoint
+    node['action'] = '/search'
+    node['method'] = 'POST'
+
+    url_input = ctx.soup.new_tag('input')
+    url_input['type'] = 'hidden'
+    url_input['name'] = 'url'
+    url_input['value'] = ensure_https(ctx.page_url)
+    node.append(url_input)
+
+    # Ensure there's a search input field
+    if not node.find('input', {'name': 'q'}):
+        search_input = ctx.soup.new_tag('input')
+        search_input['type'] = 'text'
+        search_input['name'] = 'q'
+        node.append(search_input)
+
+    if not ctx.google_script_added:
+        script = ctx.soup.new_tag('script')
+        script.string = GOOGLE_SEARCH_SCRIPT
+        ctx.ensure_head().append(script)
+        ctx.google_script_added = True
+    return True
+
+
+# Generic rules
+
+@rule('a', 'href')
+def _link(ctx, node, href):
+    target = link_target(href)
+    if target is None:
+        return True
+    node['href'] = proxy_url(target) + ctx.link_suffix
+    node['target'] = '_self'  # Open in same tab
+    return True
+
+
+@rule('form', 'action')
+def _form(ctx, node, action):
+    if action:
+        node['action'] = proxy_url(form_target(ctx.page_url, action))
+    return True
+
+
+@rule('img', 'src', group=RESOURCES)
+@rule('video', 'src', group=RESOURCES)
+@rule('source', 'src', group=RESOURCES)
+def _media(ctx, node, src):
+    if not src.startswith('data:'):
+        # Video is streamed on demand, never prefetched (or inlined)
+        if node.name == 'img':
+            node['src'] = ctx.subresource(src, PRIORITY_IMAGE, node)
+        else:
+            node['src'] = ctx.subresource(src)
+    return True
+
+
+@rule('script', 'src', group=RESOURCES)
+def _script(ctx, node, src):
+    node['src'] = ctx.subresource(src, PRIORITY_SCRIPT)
+    return True
+
+
+@rule('iframe', 'src', group=RESOURCES)
+def _proxied_iframe(ctx, node, src):
+    node['src'] = proxy_url(ctx.absolute(src))
+    return True
+
+
+@rule('iframe', 'src')
+def _iframe(ctx, node, src):
+    if src.startswith('http://'):
+        node['src'] = ensure_https(src)
+    return True
+
+
+@rule('link', 'href', group=RESOURCES)
+def _stylesheet(ctx, node, href):
+    rel = node.get('rel', ())
+    if 'stylesheet' in rel:
+        # Alternate stylesheets are not applied, so are never inlined
+        inline = node if 'alternate' not in rel and not node.has_attr('disabled') else None
+        node['href'] = ctx.subresource(href, PRIORITY_STYLESHEET, inline)
+    return True
+
+
+@rule('style')
+def _style(ctx, node, _):
+    # Fix mixed content (and route references through the proxy) in style tags
+    css = node.string
+    if css:
+        rewritten = rewrite_css(css, ctx.css_reference)
+        if rewritten is not css:
+            node.string = rewritten
+
+
+@rule('*', 'style')
+def _inline_style(ctx, node, style):
+    # Fix inline styles with url() references
+    if 'url(' in style:
+        rewritten = rewrite_css(style, ctx.css_reference)
+        if rewritten is not style:
+            node['style'] = rewritten
+    return True
@@ -0,0 +1,101 @@
+"""
+In-process resolution of the proxy's own redirects.
+
+Several entry points only translate a request into another proxy URL:
+``/proxy?q=`` becomes ``/search``, a search becomes ``/proxy?url=``, a
+YouTube watch URL becomes ``/youtube`` and ``/results``, ``/watch`` and the
+YouTube catch-all paths each add a hop of their own. ``Router`` follows
+those internal redirects without going back to the browser and hands the
+final action to the caller, so a typed search costs one round trip instead
+of three or four.
+
+A redirect still reaches the browser when the visible URL has to change:
+after a form POST (so reloading the result does not submit it again) and
+for locations outside the router.
+"""
+import threading
+from urllib.parse import parse_qsl, urlsplit
+
+from werkzeug.datastructures import ImmutableMultiDict
+
+_EMPTY = ImmutableMultiDict()
+
+
+class Router:
+    """
+    Table of route resolvers. A resolver is called as
+    ``resolver(method, args, form)`` (the fallback also gets the path first)
+    and returns an action tuple whose first item names it; ``('redirect',
+    location)`` actions pointing at another route are resolved in turn.
+    """
+
+    def __init__(self, max_hops):
+        self.max_hops = max_hops
+        self._routes = {}
+        self._fallback = None
+        self._lock = threading.Lock()
+        self.dispatched = 0
+        self.hops_collapsed = 0
+        self.redirects = 0
+
+    def route(self, path):
+        """Decorator registering a resolver for ``path``"""
+        def register(resolver):
+            self._routes[path] = resolver
+            return resolver
+        return register
+
+    def fallback(self, resolver):
+        """Decorator registering the resolver for paths with no route of their own"""
+        self._fallback = resolver
+        return resolver
+
+    def handles(self, path):
+        return path in self._routes or (self._fallback is not None and path not in ('', '/'))
+
+    def _resolve(self, method, path, args, form):
+        resolver = self._routes.get(path)
+        if resolver is not None:
+            return resolver(method, args, form)
+        return self._fallback(path.lstrip('/'), method, args, form)
+
+    def dispatch(self, method, path, query_string, form=_EMPTY):
+        """
+        Resolve a request to its final action, following internal redirects
+        for up to ``max_hops`` hops
+        """
+        args = ImmutableMultiDict(parse_qsl(query_string, keep_blank_values=True))
+        submitted = method == 'POST'
+        hops = 0
+        action = self._resolve(method, path, args, form)
+        location = None
+        while action[0] == 'redirect' and hops < self.max_hops:
+            location = action[1]
+            target = urlsplit(location)
+            if target.scheme or target.netloc or not self.handles(target.path):
+                break
+            hops += 1
+            action = self._resolve('GET', target.path, ImmutableMultiDict(parse_qsl(target.query, keep_blank_values=True)), _EMPTY)
+
+        if submitted and hops and action[0] != 'error':
+            # Land the browser on a GET URL, but only once and at the final location
+            if action[0] != 'redirect':
+                hops -= 1
+                action = ('redirect', location)
+
+        with self._lock:
+            self.dispatched += 1
+            self.hops_collapsed += hops
+            if action[0] == 'redirect':
+                self.redirects += 1
+        return action
+
+    def stats(self):
+        with self._lock:
+            return {
+                'routes': len(self._routes),
+                'max_hops': self.max_hops,
+                'dispatched': self.dispatched,
+                'hops_collapsed': self.hops_collapsed,
+                'redirects': self.redirects,
+            }
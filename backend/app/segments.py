@@ -0,0 +1,479 @@
+"""
+On-disk block cache for ranged video relay.
+
+Video bodies are split into fixed-size blocks stored as files under one
+directory and evicted least-recently-used once the cache outgrows its byte
+budget. A ``Range`` request for a known video is assembled from the blocks
+already on disk, and only the runs of missing blocks are fetched from the
+origin, so seeking back and forth does not download the same bytes again.
+Both servers use it: ``read_range`` serves Flask's streamed responses and
+``read_range_async`` the asyncio mode's, with its disk I/O on worker threads.
+
+Blocks are keyed by URL and origin validator, so a changed video never mixes
+with blocks of its previous version.
+
+Each process keeps its blocks in a directory of its own, created on first
+write and named after the process ID. It is removed when the process exits,
+and directories left behind by processes that are gone (killed workers, an
+earlier run) are swept away when a cache starts.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Block directories are named ``<prefix><pid>-<random>``
+DIRECTORY_PREFIX = 'berry-segments-'
+# Directories of earlier versions, named without the process ID
+_LEGACY_PREFIXES = ('berry-segments-', 'segments-')
+
+_CONTENT_RANGE_RE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+)')
+_RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)$')
+# Block files, and the temporary files they are written through
+_BLOCK_FILE_RE = re.compile(r'([0-9a-f]{32}\.\d+|tmp\w+)$')
+
+
+def parse_content_range(value):
+    """Return ``(start, end, total)`` from a Content-Range header, or None"""
+    match = _CONTENT_RANGE_RE.match(value or '')
+    if not match:
+        return None
+    return tuple(int(group) for group in match.groups())
+
+
+def parse_range(value, length):
+    """
+    Resolve a single-range ``Range`` header against ``length``.
+
+    Returns ``(start, end)`` inclusive, ``None`` when the header is absent,
+    malformed or asks for several ranges (the caller then relays it as is),
+    and ``False`` when the range cannot be satisfied.
+    """
+    match = _RANGE_RE.match((value or '').strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the final N bytes
+        start, end = max(length - int(last), 0), length - 1
+    else:
+        start = int(first)
+        end = min(int(last), length - 1) if last else length - 1
+    if start >= length or start > end:
+        return False
+    return start, end
+
+
+class VideoMeta:
+    """What is known about one cached video"""
+
+    __slots__ = ('url', 'key', 'length', 'content_type', 'etag', 'last_modified', 'expires')
+
+    def __init__(self, url, key, length, content_type, etag, last_modified, expires):
+        self.url = url
+        self.key = key
+        self.length = length
+        self.content_type = content_type
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires = expires
+
+    @property
+    def validator(self):
+        """Value for ``If-Range``: a strong ETag if there is one, else the Last-Modified date"""
+        if self.etag and not self.etag.startswith('W/'):
+            return self.etag
+        return self.last_modified
+
+
+class SegmentCache:
+    """
+    Thread-safe LRU cache of video blocks on disk.
+
+    ``register`` records a video from an upstream response, ``writer`` stores
+    the blocks of a body as it is relayed and ``read_range`` yields a byte
+    range, pulling missing blocks through a caller supplied ``fetch``.
+    """
+
+    def __init__(self, directory, block_size, max_bytes, max_videos, ttl):
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self.max_videos = max_videos
+        self.ttl = ttl
+        # Where block directories are made; only a configured one may hold legacy directories
+        self.root = directory or tempfile.gettempdir()
+        self.dedicated_root = bool(directory)
+        self.directory = None
+        self._finalizer = None
+        self._videos = OrderedDict()
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.block_hits = 0
+        self.block_misses = 0
+        self.bytes_served = 0
+        self.bytes_fetched = 0
+        self.evictions = 0
+        self.swept = 0
+        self.sweep()
+
+    # Directories
+
+    def _stale(self, name, path):
+        """Whether a directory under ``root`` belongs to a process that is gone"""
+        if name.startswith(DIRECTORY_PREFIX):
+            pid, sep, _ = name[len(DIRECTORY_PREFIX):].partition('-')
+            if sep and pid.isdigit():
+                pid = int(pid)
+                if pid == os.getpid():
+                    return False
+                try:
+                    os.kill(pid, 0)
+                except ProcessLookupError:
+                    return True
+                except OSError:
+                    # Alive, but owned by someone else
+                    return False
+                return False
+        # Legacy names carry no process ID. A bare ``segments-`` directory in
+        # the system temp dir may not be ours unless it only holds blocks
+        if name.startswith(DIRECTORY_PREFIX) or (self.dedicated_root and name.startswith(_LEGACY_PREFIXES)):
+            return True
+        if name.startswith(_LEGACY_PREFIXES):
+            try:
+                return all(_BLOCK_FILE_RE.match(entry) for entry in os.listdir(path))
+            except OSError:
+                return False
+        return False
+
+    def sweep(self):
+        """Remove block directories left behind by processes that have exited"""
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.root, name)
+            if path != self.directory and os.path.isdir(path) and self._stale(name, path):
+                shutil.rmtree(path, ignore_errors=True)
+                with self._lock:
+                    self.swept += 1
+
+    def _ensure_directory(self):
+        """This process's block directory, created on first use"""
+        with self._lock:
+            if self.directory is None:
+                os.makedirs(self.root, exist_ok=True)
+                self.directory = tempfile.mkdtemp(prefix=f"{DIRECTORY_PREFIX}{os.getpid()}-", dir=self.root)
+                self._finalizer = weakref.finalize(self, shutil.rmtree, self.directory, ignore_errors=True)
+            return self.directory
+
+    def _release_directory(self, remove):
+        """Forget this process's block directory, removing it when ``remove``"""
+        if self._finalizer is not None:
+            if remove:
+                self._finalizer()
+            else:
+                self._finalizer.detach()
+        self._finalizer = None
+        self.directory = None
+
+    # Videos
+
+    def lookup(self, url):
+        """Return the ``VideoMeta`` for ``url`` while it is still trusted"""
+        with self._lock:
+            meta = self._videos.get(url)
+            if meta is None:
+                return None
+            if meta.expires <= time.time():
+                del self._videos[url]
+                return None
+            self._videos.move_to_end(url)
+            return meta
+
+    def register(self, url, status, headers):
+        """
+        Record a video from an upstream 200 or 206 response. Returns
+        ``(meta, offset)`` with the body's starting byte, or None when the
+        response cannot be cached by range.
+        """
+        if headers.get('Content-Encoding', 'identity').lower() != 'identity':
+            return None
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if status == 206:
+            content_range = parse_content_range(headers.get('Content-Range'))
+            if content_range is None:
+                return None
+            offset, _, length = content_range
+        elif status == 200 and headers.get('Accept-Ranges', '').lower() == 'bytes':
+            try:
+                offset, length = 0, int(headers.get('Content-Length'))
+            except (TypeError, ValueError):
+                return None
+        else:
+            return None
+
+        key = hashlib.blake2b(f"{url}\0{etag or last_modified or ''}".encode('utf-8'), digest_size=16).hexdigest()
+        meta = VideoMeta(url, key, length, headers.get('Content-Type', 'application/octet-stream'),
+                         etag, last_modified, time.time() + self.ttl)
+        if not meta.validator:
+            # Without a validator a changed video could not be told apart from the cached one
+            return None
+        with self._lock:
+            self._videos[url] = meta
+            self._videos.move_to_end(url)
+            while len(self._videos) > self.max_videos:
+                self._videos.popitem(last=False)
+        return meta, offset
+
+    def forget(self, url):
+        with self._lock:
+            self._videos.pop(url, None)
+
+    # Blocks
+
+    def _path(self, key, index):
+        return os.path.join(self.directory, f"{key}.{index}")
+
+    def _block_length(self, meta, index):
+        return min(self.block_size, meta.length - index * self.block_size)
+
+    def has_block(self, meta, index):
+        with self._lock:
+            return (meta.key, index) in self._blocks
+
+    def _read_block(self, meta, index):
+        with self._lock:
+            if (meta.key, index) not in self._blocks:
+                self.block_misses += 1
+                return None
+            self._blocks.move_to_end((meta.key, index))
+        try:
+            with open(self._path(meta.key, index), 'rb') as f:
+                data = f.read()
+        except OSError:
+            data = None
+        if data is None or len(data) != self._block_length(meta, index):
+            self._drop_block(meta.key, index)
+            with self._lock:
+                self.block_misses += 1
+            return None
+        with self._lock:
+            self.block_hits += 1
+        return data
+
+    def _write_block(self, meta, index, data):
+        if len(data) > self.max_bytes:
+            return
+        try:
+            directory = self._ensure_directory()
+            path = self._path(meta.key, index)
+            fd, tmp_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error(f"Error writing video block {index} of {meta.url}: {str(e)}")
+            return
+        evicted = []
+        with self._lock:
+            block = (meta.key, index)
+            if block in self._blocks:
+                self.bytes -= self._blocks.pop(block)
+            self._blocks[block] = len(data)
+            self.bytes += len(data)
+            while self.bytes > self.max_bytes:
+                old_block, size = self._blocks.popitem(last=False)
+                self.bytes -= size
+                self.evictions += 1
+                evicted.append(old_block)
+        for key, old_index in evicted:
+            self._unlink(key, old_index)
+
+    def _drop_block(self, key, index):
+        with self._lock:
+            size = self._blocks.pop((key, index), None)
+            if size is not None:
+                self.bytes -= size
+        self._unlink(key, index)
+
+    def _unlink(self, key, index):
+        try:
+            os.remove(self._path(key, index))
+        except OSError:
+            pass
+
+    def writer(self, meta, offset):
+        """A ``BlockWriter`` for a body that starts at byte ``offset``"""
+        return BlockWriter(self, meta, offset)
+
+    def _served(self, data, index, start, end):
+        """The part of cached block ``index`` inside ``start``..``end``"""
+        block_start = index * self.block_size
+        piece = data[max(start - block_start, 0):end + 1 - block_start]
+        with self._lock:
+            self.bytes_served += len(piece)
+        return piece
+
+    def _missing_run(self, meta, index, last):
+        """``(run_end, first_byte, last_byte)`` of the run of missing blocks from ``index``"""
+        run_end = index
+        while run_end < last and not self.has_block(meta, run_end + 1):
+            run_end += 1
+        return run_end, index * self.block_size, min((run_end + 1) * self.block_size, meta.length) - 1
+
+    def _fetched(self, meta, fetch_start, fetch_end, position):
+        with self._lock:
+            self.bytes_fetched += position - fetch_start
+        if position <= fetch_end:
+            raise IOError(f"Upstream ended early at byte {position} of {meta.url}")
+
+    def read_range(self, meta, start, end, fetch):
+        """
+        Yield bytes ``start``..``end`` (inclusive) of a video. Cached blocks
+        are read from disk; each run of missing blocks is requested with one
+        ``fetch(first_byte, last_byte)`` call, which must return an iterable
+        of bytes, and stored on the way through.
+        """
+        index = start // self.block_size
+        last = end // self.block_size
+        while index <= last:
+            data = self._read_block(meta, index)
+            if data is not None:
+                yield self._served(data, index, start, end)
+                index += 1
+                continue
+
+            run_end, fetch_start, fetch_end = self._missing_run(meta, index, last)
+            writer = self.writer(meta, fetch_start)
+            position = fetch_start
+            for chunk in fetch(fetch_start, fetch_end):
+                writer.feed(chunk)
+                piece = _overlap(chunk, position, start, end)
+                if piece:
+                    yield piece
+                position += len(chunk)
+            self._fetched(meta, fetch_start, fetch_end, position)
+            index = run_end + 1
+
+    async def read_range_async(self, meta, start, end, fetch):
+        """
+        ``read_range`` for the asyncio server: ``fetch`` returns an async
+        iterable, and blocks are read and written on worker threads so the
+        event loop never waits on the disk
+        """
+        index = start // self.block_size
+        last = end // self.block_size
+        while index <= last:
+            data = await asyncio.to_thread(self._read_block, meta, index)
+            if data is not None:
+                yield self._served(data, index, start, end)
+                index += 1
+                continue
+
+            run_end, fetch_start, fetch_end = self._missing_run(meta, index, last)
+            writer = self.writer(meta, fetch_start)
+            position = fetch_start
+            async for chunk in fetch(fetch_start, fetch_end):
+                await writer.feed_async(chunk)
+                piece = _overlap(chunk, position, start, end)
+                if piece:
+                    yield piece
+                position += len(chunk)
+            self._fetched(meta, fetch_start, fetch_end, position)
+            index = run_end + 1
+
+    def relocate(self):
+        """
+        Start over, empty, without the parent's directory, which stays the
+        parent's to remove. A forked worker calls this so it never shares
+        block files with its parent; its own directory is made on first use.
+        """
+        with self._lock:
+            self._videos.clear()
+            self._blocks.clear()
+            self.bytes = 0
+            self._release_directory(remove=False)
+
+    def clear(self):
+        with self._lock:
+            self._videos.clear()
+            self._blocks.clear()
+            self.bytes = 0
+            self._release_directory(remove=True)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.block_hits + self.block_misses
+            return {
+                'videos': len(self._videos),
+                'blocks': len(self._blocks),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'block_size': self.block_size,
+                'block_hits': self.block_hits,
+                'block_misses': self.block_misses,
+                'hit_ratio': round(self.block_hits / lookups, 4) if lookups else 0.0,
+                'bytes_served': self.bytes_served,
+                'bytes_fetched': self.bytes_fetched,
+                'evictions': self.evictions,
+                'stale_directories_removed': self.swept,
+            }
+
+
+def _overlap(chunk, position, start, end):
+    """The part of a chunk starting at byte ``position`` inside ``start``..``end``"""
+    low = max(start - position, 0)
+    high = min(end + 1 - position, len(chunk))
+    return chunk[low:high] if low < high else b''
+
+
+class BlockWriter:
+    """
+    Splits a relayed body into blocks and stores every block it sees in
+    full; partial blocks at either end of the body are dropped.
+    """
+
+    def __init__(self, cache, meta, offset):
+        self.cache = cache
+        self.meta = meta
+        block_size = cache.block_size
+        # Skip ahead to the first block boundary inside the body
+        self.index = -(-offset // block_size)
+        self.skip = self.index * block_size - offset
+        self.buffer = bytearray()
+
+    def feed(self, chunk):
+        if self.skip:
+            dropped = min(self.skip, len(chunk))
+            chunk = chunk[dropped:]
+            self.skip -= dropped
+        self.buffer += chunk
+        while self.index * self.cache.block_size < self.meta.length:
+            size = self.cache._block_length(self.meta, self.index)
+            if len(self.buffer) < size:
+                break
+            self.cache._write_block(self.meta, self.index, bytes(self.buffer[:size]))
+            del self.buffer[:size]
+            self.index += 1
+
+    async def feed_async(self, chunk):
+        """``feed`` for the asyncio server, writing completed blocks on a worker thread"""
+        if len(self.buffer) + len(chunk) - self.skip < self.cache._block_length(self.meta, self.index):
+            # Completes no block
+            self.feed(chunk)
+        else:
+            await asyncio.to_thread(self.feed, chunk)
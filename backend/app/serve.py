@@ -0,0 +1,28 @@
+"""
+Production entry point: serves the proxy under gunicorn with the settings
+in ``gunicorn.conf.py``.
+
+    python serve.py                          # Flask app on gthread workers
+    BERRY_SERVER_APP=async python serve.py   # asyncio app on aiohttp workers
+
+Extra arguments are passed on to gunicorn (for example ``--workers 4``).
+"""
+import os
+import sys
+
+from gunicorn.app.wsgiapp import run
+
+import config
+
+APPS = {
+    'flask': 'main:app',
+    'async': 'async_app:create_app()',
+}
+
+if __name__ == '__main__':
+    here = os.path.dirname(os.path.abspath(__file__))
+    if config.SERVER_APP not in APPS:
+        sys.exit(f"Unknown BERRY_SERVER_APP {config.SERVER_APP!r}, expected one of: {', '.join(APPS)}")
+    sys.argv = [sys.argv[0], '--config', os.path.join(here, 'gunicorn.conf.py'), '--chdir', here,
+                *sys.argv[1:], APPS[config.SERVER_APP]]
+    run()
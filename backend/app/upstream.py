@@ -0,0 +1,394 @@
+"""
+Shared upstream HTTP client used by every proxy endpoint.
+
+All outbound requests go through one process-wide set of urllib3 connection
+pools, so repeat visits to the same origin reuse an open keep-alive
+connection instead of paying a fresh TCP + TLS handshake. Each request
+holds a ``guard`` lease on its origin host until its body is consumed or
+closed. Streamed GETs made with ``coalesce=True`` share the response of an
+identical request already in flight (see ``coalesce``).
+"""
+import contextlib
+import socket
+import ssl
+import threading
+import weakref
+
+import certifi
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ProtocolError
+from urllib3.response import HTTPResponse
+from urllib3.util.response import is_fp_closed
+from urllib3.util.ssl_ import create_urllib3_context
+
+import accesslog
+import config
+from coalesce import FlightAborted, FlightTimeout, flight_key, flights
+from guard import guard
+
+
+class _PoolStats:
+    """Thread-safe counters for connection reuse"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def record_connect(self):
+        with self._lock:
+            self.new_connections += 1
+
+    def snapshot(self):
+        with self._lock:
+            requests_made = self.requests
+            new_connections = self.new_connections
+        pool_hits = max(requests_made - new_connections, 0)
+        return {
+            'requests': requests_made,
+            'new_connections': new_connections,
+            'pool_hits': pool_hits,
+            'hit_ratio': round(pool_hits / requests_made, 4) if requests_made else 0.0,
+        }
+
+
+_stats = _PoolStats()
+
+
+class _CountingHTTPConnection(HTTPConnection):
+    def connect(self):
+        _stats.record_connect()
+        with accesslog.phase('connect'):
+            super().connect()
+
+
+class _CountingHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        _stats.record_connect()
+        with accesslog.phase('connect'):
+            super().connect()
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _CountingHTTPConnection
+
+    def _get_conn(self, timeout=None):
+        _stats.record_request()
+        return super()._get_conn(timeout=timeout)
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _CountingHTTPSConnection
+
+    def _get_conn(self, timeout=None):
+        _stats.record_request()
+        return super()._get_conn(timeout=timeout)
+
+
+def shared_ssl_context():
+    """
+    Build one TLS context for every upstream connection, with the CA bundle
+    loaded once instead of on every handshake
+    """
+    context = create_urllib3_context(cert_reqs=ssl.CERT_REQUIRED)
+    context.load_verify_locations(cafile=certifi.where())
+    return context
+
+
+class PooledAdapter(HTTPAdapter):
+    """
+    Transport adapter with bounded per-host keep-alive pools that share a
+    single TLS context and report connection reuse.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._ssl_context = shared_ssl_context()
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        pool_kwargs.setdefault('ssl_context', self._ssl_context)
+        super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _CountingHTTPConnectionPool,
+            'https': _CountingHTTPSConnectionPool,
+        }
+
+    def cert_verify(self, conn, url, verify, cert):
+        super().cert_verify(conn, url, verify, cert)
+        if verify is True:
+            # The shared context already trusts the default bundle
+            conn.ca_certs = None
+            conn.ca_cert_dir = None
+
+    def open_pools(self):
+        return len(self.poolmanager.pools)
+
+
+def _release_with(response, lease):
+    """
+    Release ``lease`` once a streamed response is done with its connection:
+    the body was read to the end, the response was closed, or it was dropped
+    """
+    raw_release = response.raw.release_conn
+    close = response.close
+
+    def release_conn():
+        try:
+            raw_release()
+        finally:
+            lease.release()
+
+    def close_response():
+        try:
+            close()
+        finally:
+            lease.release()
+
+    response.raw.release_conn = release_conn
+    response.close = close_response
+    weakref.finalize(response, lease.release)
+
+
+def _body_complete(response, flight):
+    """Whether the leader's body has been read to the end"""
+    if response.status_code in (204, 304):
+        return True
+    length = response.headers.get('Content-Length')
+    if length is not None and length.isdigit() and flight.size >= int(length):
+        return True
+    return is_fp_closed(response.raw._fp)
+
+
+def _share_body(response, flight):
+    """
+    Feed a leader's body to ``flight`` as it is read, in the origin's
+    content coding. If the leader closes the response early while followers
+    still read, the rest is downloaded for them on a background thread.
+    """
+    raw = response.raw
+    decode = raw._decode
+    error_catcher = raw._error_catcher
+    release_conn = raw.release_conn
+    close = response.close
+
+    def tee(data, decode_content, flush_decoder):
+        flight.append(data)
+        return decode(data, decode_content, flush_decoder)
+
+    @contextlib.contextmanager
+    def catch_errors():
+        # Every body read runs in here; a failed one ends the flight, so a
+        # connection urllib3 closed on error never passes for a finished body
+        try:
+            with error_catcher():
+                yield
+        except Exception as e:
+            flight.fail(e)
+            raise
+
+    def release():
+        # urllib3 hands the connection back once the body has been read
+        if _body_complete(response, flight):
+            flight.finish()
+        release_conn()
+
+    def drain():
+        try:
+            while flight.followers and not flight.done and not _body_complete(response, flight):
+                if not raw.read(config.RESOURCE_STREAM_CHUNK_SIZE, decode_content=False):
+                    break
+        except Exception:
+            # catch_errors has failed the flight already
+            pass
+        finally:
+            if _body_complete(response, flight):
+                flight.finish()
+            else:
+                flight.fail()
+            close()
+
+    def close_response():
+        if not flight.done:
+            if _body_complete(response, flight):
+                flight.finish()
+            elif flight.followers:
+                flights.record_drained()
+                threading.Thread(target=drain, name='coalesce-drain', daemon=True).start()
+                return
+            else:
+                flight.fail()
+        close()
+
+    raw._decode = tee
+    raw._error_catcher = catch_errors
+    raw.release_conn = release
+    response.close = close_response
+    weakref.finalize(response, flight.fail)
+
+
+class _FlightReader:
+    """
+    File-like view of a follower's shared body, read by urllib3 as it would
+    read a socket: a stalled leader surfaces as a read timeout and a body
+    cut short as a broken connection
+    """
+
+    def __init__(self, follower, timeout):
+        self.follower = follower
+        self.timeout = timeout
+
+    def read(self, amt=None):
+        try:
+            if amt is None:
+                return self.follower.read_all(self.timeout)
+            return self.follower.read(amt, self.timeout)
+        except FlightTimeout as e:
+            raise socket.timeout(str(e)) from None
+        except FlightAborted as e:
+            raise ProtocolError(f"Connection broken: {str(e)}") from None
+
+    @property
+    def closed(self):
+        return self.follower.closed or self.follower.at_end()
+
+    def close(self):
+        self.follower.close()
+
+
+def _follower_response(flight, follower, method, timeout):
+    """A ``requests.Response`` replaying ``flight`` for one follower"""
+    read_timeout = timeout[1] if isinstance(timeout, tuple) else timeout
+    response = requests.Response()
+    response.raw = HTTPResponse(
+        body=_FlightReader(follower, read_timeout),
+        headers=flight.headers,
+        status=flight.status,
+        reason=flight.reason,
+        preload_content=False,
+        request_method=method,
+        request_url=flight.url,
+    )
+    response.status_code = flight.status
+    response.reason = flight.reason
+    response.headers = CaseInsensitiveDict(flight.headers)
+    response.encoding = get_encoding_from_headers(response.headers)
+    response.url = flight.url
+    weakref.finalize(response, follower.close)
+    return response
+
+
+class UpstreamClient:
+    """
+    Process-wide entry point for outbound requests.
+
+    Each call gets its own lightweight ``requests.Session`` so cookies set
+    during a redirect chain never leak between users, while the underlying
+    connection pools are shared by every session.
+    """
+
+    def __init__(self, pool_hosts, pool_maxsize, pool_block=False, max_retries=0):
+        self.pool_hosts = pool_hosts
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self._adapter = PooledAdapter(
+            pool_connections=pool_hosts,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+            max_retries=max_retries,
+        )
+
+    def session(self):
+        """Create a session bound to the shared pools"""
+        session = requests.Session()
+        session.mount('https://', self._adapter)
+        session.mount('http://', self._adapter)
+        return session
+
+    def request(self, method, url, coalesce=False, **kwargs):
+        """
+        Issue a request under the host's guard lease. Raises
+        ``UpstreamUnavailable`` without contacting the origin when its
+        breaker is open or its queue is full. With ``coalesce``, a streamed
+        GET identical to one in flight follows it instead.
+        """
+        if coalesce and config.COALESCE_ENABLED and method == 'GET' and kwargs.get('stream'):
+            return self._coalesced(method, url, kwargs)
+        return self._send(method, url, **kwargs)
+
+    def _coalesced(self, method, url, kwargs):
+        key = flight_key(method, url, kwargs.get('headers'), kwargs.get('allow_redirects'))
+        flight, follower = flights.join(key)
+        if follower is not None:
+            try:
+                published = flight.wait_published(flights.wait_timeout)
+            except BaseException:
+                follower.close()
+                raise
+            if published:
+                accesslog.note_coalesced()
+                return _follower_response(flight, follower, method, kwargs.get('timeout'))
+            follower.close()
+            return self._send(method, url, **kwargs)
+        try:
+            response = self._send(method, url, **kwargs)
+        except Exception as e:
+            flight.fail(e)
+            raise
+        except BaseException:
+            flight.fail()
+            raise
+        flight.publish(response.status_code, response.reason, response.url, response.raw.headers)
+        _share_body(response, flight)
+        return response
+
+    def _send(self, method, url, **kwargs):
+        lease = guard.acquire(url)
+        try:
+            response = self.session().request(method, url, **kwargs)
+        except requests.RequestException:
+            lease.failure()
+            lease.release()
+            raise
+        except BaseException:
+            lease.release()
+            raise
+        lease.record_status(response.status_code)
+        if kwargs.get('stream'):
+            _release_with(response, lease)
+        else:
+            lease.release()
+        return response
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        stats = _stats.snapshot()
+        stats.update({
+            'open_pools': self._adapter.open_pools(),
+            'pool_hosts': self.pool_hosts,
+            'pool_maxsize': self.pool_maxsize,
+            'pool_block': self.pool_block,
+        })
+        return stats
+
+
+upstream = UpstreamClient(
+    pool_hosts=config.UPSTREAM_POOL_HOSTS,
+    pool_maxsize=config.UPSTREAM_POOL_MAXSIZE,
+    pool_block=config.UPSTREAM_POOL_BLOCK,
+    max_retries=config.UPSTREAM_MAX_RETRIES,
+)
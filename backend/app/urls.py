@@ -0,0 +1,203 @@
+"""
+URL helpers shared by the proxy routes and the HTML rewriters.
+
+Everything that canonicalizes a URL lives here: the HTTPS upgrade,
+unwrapping of nested proxy URLs, absolutizing references against the page
+URL, host classification and the encoding of ``/proxy`` and
+``/proxy-resource`` links. A results page repeats the same hosts and links
+many times over, so the pure functions are memoized in bounded LRU caches
+whose hit rate is published by ``memo_stats``.
+"""
+import functools
+import re
+from urllib.parse import quote, quote_plus, unquote, urljoin, urlsplit, urlunsplit
+
+import config
+
+# YouTube domains for special handling
+YOUTUBE_DOMAINS = [
+    'youtube.com',
+    'www.youtube.com',
+    'youtu.be',
+    'm.youtube.com',
+    'youtube-nocookie.com',
+    'www.youtube-nocookie.com'
+]
+
+# Hosts that serve YouTube's video streams
+VIDEO_DOMAINS = [
+    'googlevideo.com',
+]
+
+# Prefixes of URLs that point back at the proxy itself
+PROXY_PREFIXES = ('/proxy', f'http://localhost:{config.PORT}/proxy')
+
+# Plain-HTTP origins that are left alone by ensure_https
+_PLAIN_HTTP_PREFIXES = tuple(f"http://{host}{end}" for host in config.PLAIN_HTTP_HOSTS for end in (':', '/'))
+
+_NESTED_PROXY_RE = re.compile(r'[/=](https?[^&]+)')
+_YOUTUBE_VIDEO_RE = re.compile(r'https?://(www\.)?(youtube\.com|youtu\.be)(/watch\?v=|/)([a-zA-Z0-9_-]{11})')
+
+# Nested proxy URLs are decoded at most this many times
+_MAX_UNQUOTE_ROUNDS = 8
+
+_MEMOIZED = []
+
+
+def _memo(fn):
+    cached = functools.lru_cache(maxsize=config.URL_MEMO_SIZE)(fn)
+    _MEMOIZED.append(cached)
+    return cached
+
+
+class HostInfo:
+    """What the proxy needs to know about a host"""
+
+    __slots__ = ('host', 'is_google', 'is_youtube', 'is_video')
+
+    def __init__(self, host, is_google=False, is_youtube=False, is_video=False):
+        self.host = host
+        self.is_google = is_google
+        self.is_youtube = is_youtube
+        self.is_video = is_video
+
+
+def is_youtube_host(host):
+    """
+    Check whether a hostname belongs to YouTube
+    """
+    return any(host.endswith(yt_domain) for yt_domain in YOUTUBE_DOMAINS)
+
+
+@_memo
+def classify_host(host):
+    host = host.lower()
+    return HostInfo(
+        host,
+        is_google='google.' in host,
+        is_youtube=is_youtube_host(host),
+        is_video=any(host.endswith(domain) for domain in VIDEO_DOMAINS),
+    )
+
+
+def host_info(url):
+    """``HostInfo`` for the host of ``url``"""
+    return classify_host(urlsplit(url).netloc)
+
+
+def ensure_https(url):
+    """
+    Ensure a URL uses HTTPS instead of HTTP
+    """
+    if url and url.startswith('http://') and not url.startswith(_PLAIN_HTTP_PREFIXES):
+        return 'https://' + url[7:]
+    return url
+
+
+@_memo
+def absolute_url(base_url, url):
+    """``url`` resolved against the page it appears on"""
+    return urljoin(base_url, url)
+
+
+@_memo
+def link_target(href):
+    """
+    HTTPS target of a link, or None for links that stay relative to the
+    proxied page (fragments, ``javascript:``, relative paths)
+    """
+    if href.startswith('http'):
+        return ensure_https(href)
+    if href.startswith('//'):
+        # Protocol-relative URLs, make them explicit HTTPS
+        return f"https:{href}"
+    return None
+
+
+@_memo
+def form_target(base_url, action):
+    """Absolute URL a form submits to, forced to HTTPS for root-relative actions"""
+    if action.startswith('http'):
+        return ensure_https(action)
+    if action.startswith('/'):
+        return ensure_https(f"http://{urlsplit(base_url).netloc}{action}")
+    return urljoin(base_url, action)
+
+
+@_memo
+def proxy_url(url):
+    """
+    Path that loads page ``url`` through the ``/proxy`` endpoint
+    """
+    return f"/proxy?url={quote_plus(url)}"
+
+
+@_memo
+def proxy_resource_url(url):
+    """
+    Path that fetches ``url`` through the ``/proxy-resource`` endpoint
+    """
+    return f"/proxy-resource?url={quote(url)}"
+
+
+def is_proxy_url(url):
+    return url.startswith(PROXY_PREFIXES)
+
+
+@_memo
+def unwrap_proxy_url(url):
+    """
+    Target of a nested proxy URL, decoded however many times it was
+    encoded and upgraded to HTTPS; None when no target can be found
+    """
+    match = _NESTED_PROXY_RE.search(url)
+    if not match:
+        return None
+    target = match.group(1)
+    for _ in range(_MAX_UNQUOTE_ROUNDS):
+        if '%' not in target:
+            break
+        decoded = unquote(target)
+        if decoded == target:
+            break
+        target = decoded
+    return ensure_https(target)
+
+
+def youtube_video_id(url):
+    """Video ID of a YouTube watch or short link, or None"""
+    match = _YOUTUBE_VIDEO_RE.match(url)
+    return match.group(4) if match else None
+
+
+def normalize_url(url):
+    """
+    Normalize a URL for use as a cache key: lower-case scheme and host,
+    drop default ports and the fragment
+    """
+    parsed = urlsplit(url)
+    scheme = parsed.scheme.lower()
+    host = (parsed.hostname or '').lower()
+    port = parsed.port
+    if port and not ((scheme == 'https' and port == 443) or (scheme == 'http' and port == 80)):
+        host = f"{host}:{port}"
+    if '@' in parsed.netloc:
+        host = f"{parsed.netloc.rsplit('@', 1)[0]}@{host}"
+    return urlunsplit((scheme, host, parsed.path or '/', parsed.query, ''))
+
+
+def memo_stats():
+    hits = misses = size = 0
+    for cached in _MEMOIZED:
+        info = cached.cache_info()
+        hits += info.hits
+        misses += info.misses
+        size += info.currsize
+    lookups = hits + misses
+    return {
+        'entries': size,
+        'max_entries': config.URL_MEMO_SIZE * len(_MEMOIZED),
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': round(hits / lookups, 4) if lookups else 0.0,
+    }
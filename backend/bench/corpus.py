@@ -0,0 +1,118 @@
+"""
+Fixed benchmark corpus served by the stand-in origin.
+
+Every document is generated from a seeded RNG, so the same corpus (and the
+same bytes) is produced on every run and every machine. Links point back
+at the origin itself, so a proxied page never reaches the network.
+"""
+import hashlib
+import random
+
+SEED = 20240601
+
+VIDEO_BYTES = 32 * 1024 * 1024
+
+_WORDS = ('berry proxy search result video stream page cache rewrite style '
+          'image script form query link host origin browser render socket').split()
+
+
+def _text(rng, words):
+    return ' '.join(rng.choice(_WORDS) for _ in range(words))
+
+
+def _page(title, head, body):
+    return (f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>{title}</title>{head}</head>'
+            f'<body>{body}</body></html>').encode('utf-8')
+
+
+def _noise(label, size):
+    """Deterministic incompressible bytes"""
+    return hashlib.shake_256(f'{SEED}-{label}'.encode('ascii')).digest(size)
+
+
+def small_page(base):
+    rng = random.Random(SEED)
+    body = ''.join(f'<p>{_text(rng, 40)} <a href="{base}/small.html?p={i}">more</a></p>' for i in range(20))
+    head = f'<link rel="stylesheet" href="/styles.css"><script src="{base}/app.js"></script>'
+    return _page('Small page', head, f'<h1>Small</h1>{body}<img src="/img/0.png">')
+
+
+def huge_page(base):
+    """About 2 MB of nested markup, links and images"""
+    rng = random.Random(SEED + 1)
+    sections = []
+    for i in range(1500):
+        links = ''.join(f'<li><a href="{base}/huge.html?s={i}&l={j}">{_text(rng, 3)}</a></li>' for j in range(6))
+        sections.append(f'<section id="s{i}"><h2>{_text(rng, 4)}</h2><p>{_text(rng, 120)}</p>'
+                        f'<ul>{links}</ul><img src="/img/{i % 50}.png" alt="{_text(rng, 2)}"></section>')
+    head = '<link rel="stylesheet" href="/styles.css">'
+    return _page('Huge page', head, ''.join(sections))
+
+
+def search_page(base, query='berry'):
+    """A results page: hundreds of links that repeat a handful of hosts"""
+    rng = random.Random(SEED + 2)
+    hosts = [f'http://site{n}.example' for n in range(8)] + [base]
+    results = []
+    for i in range(400):
+        host = rng.choice(hosts)
+        results.append(f'<div class="g"><a href="{host}/article/{i}?q={query}"><h3>{_text(rng, 6)}</h3></a>'
+                       f'<span style="background:url(/img/{i % 10}.png)">{_text(rng, 25)}</span>'
+                       f'<a href="//cdn{i % 4}.example/cache/{i}">cached</a></div>')
+    form = f'<form action="{base}/search"><input name="q" value="{query}"></form>'
+    return _page('Search results', '<link rel="stylesheet" href="/styles.css">', form + ''.join(results))
+
+
+def forms_page(base):
+    """Many forms and inline styles"""
+    rng = random.Random(SEED + 3)
+    forms = []
+    for i in range(300):
+        action = rng.choice([f'{base}/submit/{i}', f'/submit/{i}', f'submit/{i}'])
+        forms.append(f'<form action="{action}" method="post" style="border:1px solid #{i:06x};'
+                     f'background-image:url(/img/{i % 20}.png)"><input name="f{i}" value="{_text(rng, 2)}">'
+                     f'<button style="color:red">go</button></form>')
+    return _page('Forms', '', ''.join(forms))
+
+
+def stylesheet():
+    """CSS with many url() and @import references"""
+    rng = random.Random(SEED + 4)
+    rules = ['@import url("/base.css");', "@import 'print.css' print;"]
+    for i in range(2000):
+        rules.append(f'.c{i}{{color:#{rng.randrange(0xffffff):06x};background:url("/img/{i % 50}.png") no-repeat;'
+                     f'/* {_text(rng, 4)} */}}')
+        if i % 10 == 0:
+            rules.append(f'@font-face{{font-family:f{i};src:url(/fonts/{i}.woff2) format("woff2"),url(\'/fonts/{i}.woff\')}}')
+    return '\n'.join(rules).encode('utf-8')
+
+
+def script():
+    rng = random.Random(SEED + 5)
+    return '\n'.join(f'var v{i} = "{_text(rng, 8)}";' for i in range(2000)).encode('utf-8')
+
+
+def image(index):
+    """A small PNG-sized blob; the content is never decoded"""
+    return b'\x89PNG\r\n\x1a\n' + _noise(f'image-{index}', 2048)
+
+
+def video():
+    return _noise('video', VIDEO_BYTES)
+
+
+def build(base):
+    """Map each path served by the origin to ``(content_type, body)``"""
+    documents = {
+        '/small.html': ('text/html; charset=utf-8', small_page(base)),
+        '/huge.html': ('text/html; charset=utf-8', huge_page(base)),
+        '/search': ('text/html; charset=utf-8', search_page(base)),
+        '/forms.html': ('text/html; charset=utf-8', forms_page(base)),
+        '/styles.css': ('text/css', stylesheet()),
+        '/base.css': ('text/css', b'body{margin:0}'),
+        '/app.js': ('application/javascript', script()),
+        '/video.mp4': ('video/mp4', video()),
+    }
+    for i in range(50):
+        documents[f'/img/{i}.png'] = ('image/png', image(i))
+    return documents
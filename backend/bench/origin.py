@@ -0,0 +1,115 @@
+"""
+Stand-in origin server for the benchmark.
+
+Serves the fixed corpus from ``corpus.py`` over keep-alive HTTP/1.1 with
+the behaviour the proxy depends on: strong ETags and 304s, gzip for text
+when it is accepted, and single byte ranges. Run it on its own with::
+
+    python bench/origin.py --port 8900
+"""
+import argparse
+import gzip
+import hashlib
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import corpus
+
+_RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+class Document:
+    __slots__ = ('content_type', 'body', 'gzipped', 'etag', 'cache_control')
+
+    def __init__(self, content_type, body):
+        self.content_type = content_type
+        self.body = body
+        compressible = content_type.startswith(('text/', 'application/javascript'))
+        self.gzipped = gzip.compress(body, compresslevel=6, mtime=0) if compressible else None
+        self.etag = f'"{hashlib.sha1(body).hexdigest()[:16]}"'
+        self.cache_control = 'no-cache' if content_type.startswith('text/html') else 'max-age=300'
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    documents = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        document = self.documents.get(self.path.split('?', 1)[0])
+        if document is None:
+            self._send(404, {'Content-Type': 'text/plain'}, b'not found')
+            return
+        headers = {
+            'Content-Type': document.content_type,
+            'ETag': document.etag,
+            'Cache-Control': document.cache_control,
+            'Accept-Ranges': 'bytes',
+        }
+        if self.headers.get('If-None-Match') == document.etag:
+            self._send(304, headers, b'')
+            return
+
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        match = _RANGE_RE.match(range_header or '')
+        if match and (if_range is None or if_range == document.etag):
+            length = len(document.body)
+            first, last = match.groups()
+            if first:
+                start, end = int(first), min(int(last), length - 1) if last else length - 1
+            else:
+                start, end = max(length - int(last or 0), 0), length - 1
+            if start >= length or start > end:
+                headers['Content-Range'] = f'bytes */{length}'
+                self._send(416, headers, b'')
+                return
+            headers['Content-Range'] = f'bytes {start}-{end}/{length}'
+            self._send(206, headers, document.body[start:end + 1])
+            return
+
+        body = document.body
+        if document.gzipped is not None and 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+            headers['Content-Encoding'] = 'gzip'
+            headers['Vary'] = 'Accept-Encoding'
+            body = document.gzipped
+        self._send(200, headers, body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.do_GET()
+
+    def _send(self, status, headers, body):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD' and body:
+            self.wfile.write(body)
+
+
+def start(host='127.0.0.1', port=0):
+    """Start the origin on a background thread; returns ``(server, base_url)``"""
+    server = ThreadingHTTPServer((host, port), OriginHandler)
+    server.daemon_threads = True
+    base = f'http://{host}:{server.server_address[1]}'
+    OriginHandler.documents = {path: Document(*entry) for path, entry in corpus.build(base).items()}
+    threading.Thread(target=server.serve_forever, name='bench-origin', daemon=True).start()
+    return server, base
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the benchmark corpus')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    args = parser.parse_args()
+    server, base = start(args.host, args.port)
+    print(f'Serving the benchmark corpus on {base}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,356 @@
+"""
+Offline benchmark for the proxy backend.
+
+Starts the stand-in origin (``origin.py``) and the backend as a child
+process configured to use it, then drives each scenario with a fixed number
+of concurrent clients for a fixed time. Throughput, latency percentiles and
+the backend's CPU time and peak RSS are written to a JSON file, which can
+be compared with an earlier run::
+
+    python bench/run.py --server flask --concurrency 16 --duration 10
+    python bench/run.py --baseline bench/results/<earlier>.json
+
+Nothing leaves the machine: the backend is pointed at the origin with
+``BERRY_PLAIN_HTTP_HOSTS`` and ``BERRY_SEARCH_URL``. Other ``BERRY_``
+variables in the environment are passed through and recorded in the
+results, so configurations can be benchmarked against each other.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import time
+from urllib.parse import quote, quote_plus
+
+import aiohttp
+
+import origin
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(os.path.dirname(HERE), 'app')
+RESULTS_DIR = os.path.join(HERE, 'results')
+
+SERVERS = {
+    'flask': ("import main; main.app.run(host='127.0.0.1', port={port}, threaded=True, "
+              "debug=False, use_reloader=False)"),
+    'async': "import async_app; async_app.web.run_app(async_app.create_app(), host='127.0.0.1', port={port}, print=None)",
+    # Production launcher; BERRY_SERVER_APP picks the app
+    'gunicorn': "import runpy; runpy.run_path('serve.py', run_name='__main__')",
+}
+
+VIDEO_WINDOW = 256 * 1024
+
+
+class Scenario:
+    """A named request generator; ``request(rng, n)`` returns ``(method, path, headers)``"""
+
+    def __init__(self, name, request):
+        self.name = name
+        self.request = request
+
+
+def scenarios(base, cold):
+    def page(path):
+        def request(rng, n):
+            url = f'{base}{path}?bench={n}' if cold else f'{base}{path}'
+            return 'GET', f'/proxy?url={quote_plus(url)}', {}
+        return request
+
+    def search(rng, n):
+        query = f'berry {n}' if cold else 'berry'
+        return 'GET', f'/search?q={quote_plus(query)}', {}
+
+    def resource(path):
+        return lambda rng, n: ('GET', f'/proxy-resource?url={quote(base + path)}', {})
+
+    def image(rng, n):
+        return 'GET', f'/proxy-resource?url={quote(f"{base}/img/{rng.randrange(50)}.png")}', {}
+
+    def video(rng, n):
+        start = rng.randrange(0, origin.corpus.VIDEO_BYTES - VIDEO_WINDOW)
+        headers = {'Range': f'bytes={start}-{start + VIDEO_WINDOW - 1}'}
+        return 'GET', f'/proxy-resource?url={quote(base + "/video.mp4")}', headers
+
+    return [
+        Scenario('proxy_small', page('/small.html')),
+        Scenario('proxy_huge', page('/huge.html')),
+        Scenario('proxy_links', page('/search')),
+        Scenario('proxy_forms', page('/forms.html')),
+        Scenario('search', search),
+        Scenario('resource_css', resource('/styles.css')),
+        Scenario('resource_image', image),
+        Scenario('video_range', video),
+    ]
+
+
+# Backend process
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_backend(server, port, base, verbose=False):
+    env = dict(os.environ)
+    env.update({
+        'BERRY_HOST': '127.0.0.1',
+        'BERRY_PORT': str(port),
+        'BERRY_PLAIN_HTTP_HOSTS': '127.0.0.1',
+        'BERRY_SEARCH_URL': f'{base}/search',
+        'BERRY_WARM_ORIGINS': base,
+    })
+    env.setdefault('BERRY_LOG_LEVEL', 'WARNING')
+    env.setdefault('BERRY_ACCESS_LOG_ENABLED', 'false')
+    return subprocess.Popen([sys.executable, '-c', SERVERS[server].format(port=port)], cwd=APP_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=None if verbose else subprocess.DEVNULL)
+
+
+async def wait_ready(session, url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'backend exited with status {process.returncode}')
+        try:
+            async with session.get(url) as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError('backend did not become ready')
+
+
+def _process_tree(pid):
+    """``pid`` and its descendants (gunicorn workers), from /proc"""
+    parents = {}
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return [pid]
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                parents.setdefault(int(f.read().rsplit(')', 1)[1].split()[1]), []).append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+    tree = [pid]
+    for parent in tree:
+        tree.extend(parents.get(parent, ()))
+    return tree
+
+
+def cpu_seconds(pid):
+    """User plus system CPU time of a process and its children, from /proc (None elsewhere)"""
+    total = 0.0
+    try:
+        for member in _process_tree(pid):
+            with open(f'/proc/{member}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            total += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return None
+    return total
+
+
+def memory_kb(pid):
+    """
+    ``(rss, peak_rss)`` in KiB from /proc (None elsewhere), summed over
+    the process and its children
+    """
+    totals = {}
+    for member in _process_tree(pid):
+        try:
+            with open(f'/proc/{member}/status') as f:
+                for line in f:
+                    name, _, value = line.partition(':')
+                    if name in ('VmRSS', 'VmHWM'):
+                        totals[name] = totals.get(name, 0) + int(value.split()[0])
+        except (OSError, ValueError):
+            continue
+    return totals.get('VmRSS'), totals.get('VmHWM')
+
+
+# Load generation
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+async def drive(session, server_url, scenario, concurrency, duration, seed):
+    latencies = []
+    statuses = {}
+    errors = 0
+    received = 0
+    counter = iter(range(sys.maxsize))
+    deadline = time.perf_counter() + duration
+
+    async def client(index):
+        nonlocal errors, received
+        rng = random.Random(seed + index)
+        while time.perf_counter() < deadline:
+            method, path, headers = scenario.request(rng, next(counter))
+            start = time.perf_counter()
+            try:
+                async with session.request(method, server_url + path, headers=headers, allow_redirects=False) as response:
+                    body = await response.read()
+                latencies.append(time.perf_counter() - start)
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+                received += len(body)
+                if response.status >= 500:
+                    errors += 1
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'bytes_received': received,
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+            'p50': round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+            'p90': round(percentile(latencies, 0.90) * 1000, 3) if latencies else None,
+            'p99': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+            'max': round(latencies[-1] * 1000, 3) if latencies else None,
+        },
+    }
+
+
+async def benchmark(args):
+    origin_server, base = origin.start()
+    port = free_port()
+    process = start_backend(args.server, port, base, args.verbose)
+    server_url = f'http://127.0.0.1:{port}'
+    selected = set(args.scenarios.split(',')) if args.scenarios else None
+    results = {}
+    try:
+        connector = aiohttp.TCPConnector(limit=args.concurrency)
+        timeout = aiohttp.ClientTimeout(total=args.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, auto_decompress=False) as session:
+            await wait_ready(session, f'{server_url}/status', process)
+            for scenario in scenarios(base, args.cold):
+                if selected is not None and scenario.name not in selected:
+                    continue
+                if args.warmup:
+                    await drive(session, server_url, scenario, args.concurrency, args.warmup, args.seed)
+                cpu_before = cpu_seconds(process.pid)
+                result = await drive(session, server_url, scenario, args.concurrency, args.duration, args.seed)
+                cpu_after = cpu_seconds(process.pid)
+                rss, peak_rss = memory_kb(process.pid)
+                if cpu_before is not None and cpu_after is not None:
+                    result['cpu_seconds'] = round(cpu_after - cpu_before, 3)
+                    result['cpu_percent'] = round((cpu_after - cpu_before) / result['seconds'] * 100, 1)
+                    result['cpu_ms_per_request'] = (round((cpu_after - cpu_before) * 1000 / result['requests'], 3)
+                                                    if result['requests'] else None)
+                result['rss_kb'] = rss
+                result['peak_rss_kb'] = peak_rss
+                results[scenario.name] = result
+                print(f"{scenario.name:16} {result['throughput_rps']:>9.1f} req/s  "
+                      f"p50 {result['latency_ms']['p50']} ms  p99 {result['latency_ms']['p99']} ms  "
+                      f"errors {result['errors']}", flush=True)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        origin_server.shutdown()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, current):
+    """Print throughput and latency changes against an earlier result file"""
+    print(f"\nAgainst {baseline['meta'].get('commit')} ({baseline['meta'].get('server')}):")
+    for name, result in current['scenarios'].items():
+        old = baseline['scenarios'].get(name)
+        if not old:
+            continue
+
+        def change(new_value, old_value):
+            if not new_value or not old_value:
+                return '   n/a'
+            return f'{(new_value - old_value) / old_value * 100:+6.1f}%'
+
+        print(f"{name:16} throughput {change(result['throughput_rps'], old['throughput_rps'])}  "
+              f"p50 {change(result['latency_ms']['p50'], old['latency_ms']['p50'])}  "
+              f"p99 {change(result['latency_ms']['p99'], old['latency_ms']['p99'])}  "
+              f"cpu/req {change(result.get('cpu_ms_per_request'), old.get('cpu_ms_per_request'))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the proxy backend against a local origin')
+    parser.add_argument('--server', choices=sorted(SERVERS), default='flask')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per scenario')
+    parser.add_argument('--warmup', type=float, default=2.0, help='untimed seconds before each scenario')
+    parser.add_argument('--timeout', type=float, default=60.0, help='per-request timeout, seconds')
+    parser.add_argument('--scenarios', help='comma-separated scenario names (default: all)')
+    parser.add_argument('--cold', action='store_true', help='give every page request a unique URL, defeating the page cache')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='result file (default: bench/results/<commit>-<server>-<time>.json)')
+    parser.add_argument('--baseline', help='earlier result file to compare with')
+    parser.add_argument('--verbose', action='store_true', help="show the backend's log output")
+    args = parser.parse_args()
+
+    started = time.time()
+    results = asyncio.run(benchmark(args))
+    commit = git_commit()
+    report = {
+        'meta': {
+            'commit': commit,
+            'server': args.server,
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'warmup': args.warmup,
+            'cold': args.cold,
+            'seed': args.seed,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(started)),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'environment': {name: value for name, value in sorted(os.environ.items()) if name.startswith('BERRY_')},
+        },
+        'scenarios': results,
+    }
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime(started))
+        output = os.path.join(RESULTS_DIR, f'{commit or "unknown"}-{args.server}-{stamp}.json')
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()